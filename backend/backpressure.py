@@ -0,0 +1,189 @@
+"""Outbound backpressure for slow Socket.IO clients.
+
+Every connection has an unbounded Engine.IO send queue, so a client on a
+bad network that reads slower than its rooms talk makes the server hold
+more and more packets for it. OutboundGuard looks at the queue depth of
+each recipient as an event is emitted:
+
+- above `high_water` packets, events that only describe current state
+  (COLLAPSIBLE: member lists, typing, reaction lists) are not queued; the
+  latest one per subject is kept aside and sent once the client has caught
+  up, so it ends up with the same state with fewer packets. Chat messages,
+  signaling and everything else still go out;
+- above `hard_limit` packets, nothing more is queued for the client and it
+  is disconnected. Clients reconnect and load what they missed over REST.
+
+Engine.IO closes a websocket only once the client has read its queue, which
+a client that stopped reading never does, so the queue would stay for as
+long as the TCP connection does. WebSocketTransports, an ASGI middleware
+around the Socket.IO app, keeps the ASGI `send` of each websocket so the
+guard can close the connection itself. The server drops the connection,
+and the queue with it, once the client has not taken the close frame within
+the websocket close timeout.
+"""
+import asyncio
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs
+
+from socketio import packet
+
+import metrics
+from logs import get_logger
+
+log = get_logger('backpressure')
+
+# event -> payload keys naming what it describes (full and compact)
+COLLAPSIBLE = {
+    'room_users': ('room', 'r'),
+    'typing_state': ('room', 'r'),
+    'user_typing': ('userId', 's'),
+    'reaction_updated': ('messageId', 'm'),
+}
+
+COLLAPSED = metrics.registry.counter(
+    'socketio_outbound_collapsed_total', 'Events held back from slow clients', ('event',))
+SLOW_DISCONNECTS = metrics.registry.counter(
+    'socketio_slow_consumer_disconnects_total', 'Clients disconnected for not reading their events')
+
+# (namespace, sid, event, data) of the latest held-back event
+Deferred = Tuple[str, str, str, List[Any]]
+
+
+class WebSocketTransports:
+    """ASGI middleware that can close the websocket of an Engine.IO session"""
+
+    def __init__(self, app):
+        self.app = app
+        self._sends: Dict[str, Callable[[dict], Awaitable[None]]] = {}  # eio sid -> ASGI send
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            return await self.app(scope, receive, send)
+        # an upgrade from long-polling names its session in the query; a
+        # websocket-only one learns it from the open packet it is sent
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        sids = query.get('sid', [])[:1]
+
+        async def watch(message):
+            if not sids and message['type'] == 'websocket.send':
+                sids.append(open_packet_sid(message.get('text')))
+                self._sends[sids[0]] = send
+            await send(message)
+
+        if sids:
+            self._sends[sids[0]] = send
+        try:
+            await self.app(scope, receive, watch)
+        finally:
+            if sids:
+                self._sends.pop(sids[0], None)
+
+    async def close(self, eio_sid: str) -> bool:
+        """Close the session's websocket, if it has one"""
+        send = self._sends.pop(eio_sid, None)
+        if send is None:
+            return False
+        try:
+            await send({'type': 'websocket.close', 'code': 1008})
+        except Exception:
+            pass  # already closed
+        return True
+
+
+def open_packet_sid(text: Optional[str]) -> str:
+    """The session id in an Engine.IO open packet (`0{"sid": ...}`)"""
+    if not text or text[0] != '0':
+        return ''
+    try:
+        return json.loads(text[1:]).get('sid', '')
+    except ValueError:
+        return ''
+
+
+class OutboundGuard:
+    """Per recipient admission of emitted events, by send queue depth"""
+
+    def __init__(self, server, high_water: int = 200, hard_limit: int = 2000, tick: float = 0.1,
+                 close_timeout: float = 1.0, transports: Optional[WebSocketTransports] = None):
+        self.server = server
+        self.transports = transports
+        self.high_water = high_water
+        self.hard_limit = hard_limit
+        self.tick = tick
+        self.close_timeout = close_timeout
+        self._deferred: Dict[str, Dict[Tuple[str, Any], Deferred]] = {}  # eio sid -> subject -> event
+        self._evicting: Set[str] = set()
+        self.collapsed = 0
+        self.disconnected = 0
+
+    def depth(self, eio_sid: str) -> int:
+        socket = self.server.eio.sockets.get(eio_sid)
+        return socket.queue.qsize() if socket is not None else 0
+
+    def admit(self, sid: str, eio_sid: str, namespace: str, event: str, data: List[Any]) -> bool:
+        """Whether to queue `event` for this recipient now"""
+        depth = self.depth(eio_sid)
+        if depth < self.high_water:
+            return True
+        if depth >= self.hard_limit:
+            if eio_sid not in self._evicting:
+                self._evicting.add(eio_sid)
+                asyncio.ensure_future(self._evict(sid, eio_sid, depth))
+            return False
+        keys = COLLAPSIBLE.get(event)
+        if keys is None:
+            return True
+        payload = data[0] if data and isinstance(data[0], dict) else {}
+        subject = next((payload[key] for key in keys if key in payload), None)
+        self._deferred.setdefault(eio_sid, {})[(event, subject)] = (namespace, sid, event, data)
+        self.collapsed += 1
+        COLLAPSED.inc(event)
+        return False
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('outbound_flush_failed')
+
+    async def flush(self):
+        """Send what was held back from clients that have caught up"""
+        for eio_sid in list(self._deferred):
+            if eio_sid not in self.server.eio.sockets or eio_sid in self._evicting:
+                del self._deferred[eio_sid]
+            elif self.depth(eio_sid) < self.high_water:
+                for namespace, sid, event, data in self._deferred.pop(eio_sid).values():
+                    await self.server._send_packet(eio_sid, self.server.packet_class(
+                        packet.EVENT, namespace=namespace, data=[event] + data))
+
+    def stats(self) -> Dict[str, Any]:
+        depths = [socket.queue.qsize() for socket in self.server.eio.sockets.values()]
+        return {
+            'high_water': self.high_water,
+            'hard_limit': self.hard_limit,
+            'deepest_queue': max(depths, default=0),
+            'congested': sum(depth >= self.high_water for depth in depths),
+            'collapsed': self.collapsed,
+            'disconnected': self.disconnected,
+        }
+
+    async def _evict(self, sid: str, eio_sid: str, depth: int):
+        try:
+            if eio_sid not in self.server.eio.sockets:
+                return
+            self.disconnected += 1
+            SLOW_DISCONNECTS.inc()
+            log.info('slow_consumer_disconnected', sid=sid, queued=depth)
+            # Closes the session and runs the Socket.IO disconnect handlers
+            # right away, then waits for the client to read its queue
+            try:
+                await asyncio.wait_for(self.server.eio.disconnect(eio_sid), self.close_timeout)
+            except asyncio.TimeoutError:
+                if self.transports is not None:
+                    await self.transports.close(eio_sid)
+        finally:
+            self._evicting.discard(eio_sid)
+            self._deferred.pop(eio_sid, None)
@@ -0,0 +1,128 @@
+"""Batching of chat messages in busy rooms.
+
+Every message sent to a room is one frame to each of its members, so in a
+room with hundreds of members a fast conversation means a flood of small
+frames. MessageBatcher watches each room's message rate; while it is above
+a threshold, messages are held for a short window and handed over as one
+batch (sent as a single `message_batch` event). Quiet rooms are not
+delayed at all.
+
+Messages leave in the order they arrived, so each sender's messages keep
+their order: once a batch is open, every message for the room joins it
+until it goes out. No message waits longer than the window, and a batch
+that reaches `max_batch` messages goes out at once.
+
+Rates are measured per server process, over the messages sent through it.
+"""
+import asyncio
+import math
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from logs import get_logger
+
+log = get_logger('batching')
+
+# Called with (room, messages)
+SendBatch = Callable[[str, List[Dict[str, Any]]], Awaitable[None]]
+
+RATE_HALF_LIFE = 1.0  # seconds; how quickly the measured rate follows changes
+IDLE_AFTER = 60.0  # seconds without messages before a room's rate is forgotten
+
+
+class PendingMessages:
+    __slots__ = ('messages', 'timer')
+
+    def __init__(self):
+        self.messages: List[Dict[str, Any]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MessageBatcher:
+    """Per room buffers of messages, used while a room is busy"""
+
+    def __init__(self, send: SendBatch, threshold: float = 20.0,
+                 window: float = 0.05, max_batch: int = 100):
+        self.send = send
+        self.threshold = threshold  # messages per second; 0 never batches
+        self.window = window
+        self.max_batch = max_batch
+        self._flushing: Set[asyncio.Task] = set()  # timed flushes in progress
+        self._pending: Dict[str, PendingMessages] = {}
+        self._rates: Dict[str, Tuple[float, float]] = {}  # room -> (messages per second, as of)
+        self.messages = 0
+        self.batches = 0
+        self.unbatched = 0
+
+    async def add(self, room: str, message: Dict[str, Any]) -> bool:
+        """Queue `message` for a batch. False if the room is quiet and the
+        caller should send it right away."""
+        self.messages += 1
+        rate = self._count(room)
+        batch = self._pending.get(room)
+        if batch is None:
+            if not self.threshold or rate < self.threshold:
+                self.unbatched += 1
+                return False
+            batch = self._pending[room] = PendingMessages()
+            batch.timer = asyncio.get_running_loop().call_later(
+                self.window, self._flush_later, room)
+        batch.messages.append(message)
+        if len(batch.messages) >= self.max_batch:
+            await self._flush(room)
+        return True
+
+    async def flush(self, room: str):
+        """Send the room's pending batch now, e.g. before an edit of one of its messages"""
+        await self._flush(room)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            'threshold': self.threshold,
+            'window_ms': self.window * 1000,
+            'batching_rooms': len(self._pending),
+            'messages': self.messages,
+            'unbatched': self.unbatched,
+            'batches': self.batches,
+            'busiest': sorted(((round(rate * _decay(now - updated), 1), room)
+                               for room, (rate, updated) in self._rates.items()), reverse=True)[:5],
+        }
+
+    def _count(self, room: str) -> float:
+        """Add a message to the room's exponentially decaying rate"""
+        now = time.monotonic()
+        rate, updated = self._rates.get(room, (0.0, now))
+        rate = rate * _decay(now - updated) + math.log(2) / RATE_HALF_LIFE
+        self._rates[room] = (rate, now)
+        if self.messages % 1000 == 0:
+            self._forget_idle(now)
+        return rate
+
+    def _forget_idle(self, now: float):
+        for room in [room for room, (_, updated) in self._rates.items() if now - updated > IDLE_AFTER]:
+            del self._rates[room]
+
+    def _flush_later(self, room: str):
+        """Flush from the window timer, keeping the task until it is done"""
+        task = asyncio.ensure_future(self._timed_flush(room))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _timed_flush(self, room: str):
+        try:
+            await self._flush(room)
+        except Exception:
+            log.exception('batch_flush_failed', room=room)
+
+    async def _flush(self, room: str):
+        batch = self._pending.pop(room, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        self.batches += 1
+        await self.send(room, batch.messages)
+
+
+def _decay(elapsed: float) -> float:
+    return 0.5 ** (max(0.0, elapsed) / RATE_HALF_LIFE)
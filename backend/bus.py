@@ -0,0 +1,490 @@
+"""Message bus shared by every server process.
+
+A broker offers publish/subscribe on named channels plus an atomic,
+expiring claim on a key (used to settle races between processes, e.g. two
+workers trying to match the same stranger). Three brokers are available:
+
+- MemoryBroker: in-process only. Useful for tests, where several simulated
+  nodes can share one instance.
+- SocketBroker: talks to a BrokerServer over TCP or a unix socket. This is
+  what `WORKERS=N` uses out of the box, and a stand-in for Redis on a single
+  machine.
+- RedisBroker: Redis pub/sub, for running on several machines. Needs the
+  optional `redis` package.
+
+Everything on the bus is JSON, never pickle, so a peer that can reach the
+broker cannot make the workers run code. A BrokerServer listening on
+anything but loopback or a unix socket also needs a shared secret, which
+clients send first.
+
+BrokerClientManager plugs any broker into python-socketio, so room
+broadcasts reach clients connected to other processes. Like
+LocalClientManager (the single-process manager), it only encodes a packet
+when a room has members on this process.
+"""
+import asyncio
+import hmac
+import ipaddress
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from engineio import packet as eio_packet
+from socketio import packet
+from socketio.async_manager import AsyncManager
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+from logs import get_logger
+
+log = get_logger('bus')
+
+
+class Broker:
+    """Publish/subscribe plus atomic claims"""
+
+    async def publish(self, channel: str, data: bytes):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str) -> 'Subscription':
+        """Subscribe to `channel`; messages published after this returns,
+        including by this process, are delivered to the subscription"""
+        raise NotImplementedError
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        """Take `key` for `ttl` seconds; False if someone else holds it.
+        Raises OSError or asyncio.TimeoutError if the broker cannot be
+        asked."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class Subscription:
+    """Async iterator over the messages of one subscription"""
+
+    def __init__(self, queue: asyncio.Queue, on_close: Callable[[], None]):
+        self._queue = queue
+        self._on_close = on_close
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        return await self._queue.get()
+
+    def close(self):
+        self._on_close()
+
+
+class ClaimTable:
+    """Expiring claims, shared by the in-process broker and the broker server"""
+
+    PRUNE_SIZE = 4096
+
+    def __init__(self):
+        self._claims: Dict[str, Tuple[str, float]] = {}
+
+    def claim(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.monotonic()
+        current = self._claims.get(key)
+        if current is not None and current[1] > now:
+            return False
+        self._claims[key] = (owner, now + ttl)
+        if len(self._claims) > self.PRUNE_SIZE:
+            self._claims = {k: v for k, v in self._claims.items() if v[1] > now}
+        return True
+
+
+class MemoryBroker(Broker):
+    """Broker for nodes living in the same process"""
+
+    def __init__(self):
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+        self._claims = ClaimTable()
+
+    async def publish(self, channel: str, data: bytes):
+        for subscriber in self._subscribers.get(channel, ()):
+            subscriber.put_nowait(data)
+
+    async def subscribe(self, channel: str) -> Subscription:
+        subscriber: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(channel, []).append(subscriber)
+        return Subscription(subscriber, lambda: self._subscribers[channel].remove(subscriber))
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        return self._claims.claim(key, owner, ttl)
+
+
+# Socket protocol: every frame is a 4-byte big-endian length followed by a
+# JSON header line and an optional binary payload. With a secret, a
+# client's first frame is {"op": "auth", "secret": ...}.
+MAX_FRAME = 16 * 1024 * 1024
+
+def _encode_frame(header: Dict[str, Any], payload: bytes = b'') -> bytes:
+    body = json.dumps(header).encode() + b'\n' + payload
+    return struct.pack('>I', len(body)) + body
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Tuple[Dict[str, Any], bytes]:
+    size = struct.unpack('>I', await reader.readexactly(4))[0]
+    if size > MAX_FRAME:
+        raise ConnectionError(f"broker frame of {size} bytes")
+    body = await reader.readexactly(size)
+    header, _, payload = body.partition(b'\n')
+    return json.loads(header), payload
+
+
+async def _open_connection(address: str):
+    if address.startswith('unix://'):
+        return await asyncio.open_unix_connection(address[len('unix://'):])
+    host, _, port = address[len('tcp://'):].rpartition(':')
+    return await asyncio.open_connection(host, int(port))
+
+
+class SocketBroker(Broker):
+    """Client for a BrokerServer.
+
+    A lost connection fails the claims waiting on it and is reopened in the
+    background, with backoff, as long as anything is subscribed.
+    """
+
+    CONNECT_ATTEMPTS = 50
+    RECONNECT_DELAY = 0.1  # seconds, doubled after every failed attempt
+    RECONNECT_MAX_DELAY = 5.0
+    CLAIM_TIMEOUT = 5.0
+
+    def __init__(self, address: str, secret: Optional[str] = None):
+        self.address = address
+        self.secret = secret
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closed = False
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_request = 0
+
+    async def _connection(self, attempts: int = CONNECT_ATTEMPTS) -> asyncio.StreamWriter:
+        if self._writer is not None:
+            return self._writer
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is None:
+                self._reader, self._writer = await self._open(attempts)
+                if self.secret:
+                    self._writer.write(_encode_frame({'op': 'auth', 'secret': self.secret}))
+                # Subscriptions belong to a connection; renew them on a new one
+                for channel, subscribers in self._subscribers.items():
+                    if subscribers:
+                        self._writer.write(_encode_frame({'op': 'subscribe', 'channel': channel}))
+                self._read_task = asyncio.create_task(self._read_loop(self._reader))
+        return self._writer
+
+    async def _open(self, attempts: int):
+        # The broker may still be starting up alongside the workers
+        for attempt in range(attempts):
+            try:
+                return await _open_connection(self.address)
+            except (ConnectionError, FileNotFoundError):
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def _send(self, header: Dict[str, Any], payload: bytes = b''):
+        writer = await self._connection()
+        writer.write(_encode_frame(header, payload))
+        await writer.drain()
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                header, payload = await _read_frame(reader)
+                if header['op'] == 'message':
+                    for subscriber in self._subscribers.get(header['channel'], ()):
+                        subscriber.put_nowait(payload)
+                elif header['op'] == 'claimed':
+                    future = self._pending.pop(header['id'], None)
+                    if future is not None and not future.done():
+                        future.set_result(header['ok'])
+        except (asyncio.IncompleteReadError, OSError, ValueError):
+            log.error('broker_connection_lost', address=self.address)
+        self._connection_lost()
+
+    def _connection_lost(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('broker connection lost'))
+        if not self._closed and any(self._subscribers.values()):
+            self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self.RECONNECT_DELAY
+        while self._writer is None and not self._closed:
+            try:
+                await self._connection(attempts=1)
+                log.info('broker_reconnected', address=self.address)
+            except OSError as e:
+                log.warning('broker_reconnect_failed', address=self.address, error=str(e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+    async def publish(self, channel: str, data: bytes):
+        await self._send({'op': 'publish', 'channel': channel}, data)
+
+    async def subscribe(self, channel: str) -> Subscription:
+        subscriber: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(channel, []).append(subscriber)
+        # Frames on one connection are handled in order, so anything we
+        # publish after this is seen by the new subscription
+        await self._send({'op': 'subscribe', 'channel': channel})
+        return Subscription(subscriber, lambda: self._subscribers[channel].remove(subscriber))
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        """Raises ConnectionError or asyncio.TimeoutError when the broker does not answer"""
+        self._next_request += 1
+        request_id = self._next_request
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+
+        async def request():
+            await self._send({'op': 'claim', 'id': request_id, 'key': key, 'owner': owner, 'ttl': ttl})
+            return await future
+
+        try:
+            return await asyncio.wait_for(request(), self.CLAIM_TIMEOUT)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def close(self):
+        self._closed = True
+        for task in (self._read_task, self._reconnect_task):
+            if task is not None:
+                task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class BrokerServer:
+    """Minimal pub/sub broker for processes on one machine"""
+
+    def __init__(self, secret: Optional[str] = None):
+        self.secret = secret
+        self._channels: Dict[str, Set[asyncio.StreamWriter]] = {}
+        self._claims = ClaimTable()
+
+    async def serve(self, address: str):
+        if address.startswith('unix://'):
+            path = address[len('unix://'):]
+            if os.path.exists(path):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(self._handle, path)
+            os.chmod(path, 0o600)
+        else:
+            host, _, port = address[len('tcp://'):].rpartition(':')
+            if not self.secret and not is_loopback(host):
+                raise ValueError(f"A broker on {host} needs a secret (BROKER_SECRET)")
+            server = await asyncio.start_server(self._handle, host, int(port))
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        channels: Set[str] = set()
+        try:
+            if self.secret:
+                header, _ = await _read_frame(reader)
+                if header.get('op') != 'auth' or not hmac.compare_digest(
+                        str(header.get('secret', '')).encode(), self.secret.encode()):
+                    log.warning('broker_auth_failed', peer=str(writer.get_extra_info('peername')))
+                    return
+            while True:
+                header, payload = await _read_frame(reader)
+                op = header['op']
+                if op == 'publish':
+                    frame = _encode_frame({'op': 'message', 'channel': header['channel']}, payload)
+                    for subscriber in list(self._channels.get(header['channel'], ())):
+                        subscriber.write(frame)
+                elif op == 'subscribe':
+                    channels.add(header['channel'])
+                    self._channels.setdefault(header['channel'], set()).add(writer)
+                elif op == 'claim':
+                    ok = self._claims.claim(header['key'], header['owner'], header['ttl'])
+                    writer.write(_encode_frame({'op': 'claimed', 'id': header['id'], 'ok': ok}))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            for channel in channels:
+                self._channels[channel].discard(writer)
+            writer.close()
+
+
+def is_loopback(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host.strip('[]')).is_loopback
+    except ValueError:
+        return False
+
+
+def start_broker_thread(address: str, secret: Optional[str] = None) -> threading.Thread:
+    """Run a BrokerServer on its own event loop in a daemon thread"""
+    thread = threading.Thread(target=lambda: asyncio.run(BrokerServer(secret).serve(address)),
+                              name='message-broker', daemon=True)
+    thread.start()
+    return thread
+
+
+class RedisBroker(Broker):
+    """Redis pub/sub broker for multi-machine deployments"""
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError('Redis broker requested, but the "redis" package is not installed '
+                               '(pip install redis)')
+        self.redis = aioredis.Redis.from_url(url)
+
+    async def publish(self, channel: str, data: bytes):
+        await self.redis.publish(channel, data)
+
+    async def subscribe(self, channel: str) -> Subscription:
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(channel)
+        # Wait for the subscription to be confirmed before returning
+        while await pubsub.get_message(timeout=1.0) is None:
+            pass
+        subscriber: asyncio.Queue = asyncio.Queue()
+
+        async def pump():
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    subscriber.put_nowait(message['data'])
+
+        task = asyncio.create_task(pump())
+
+        def close():
+            task.cancel()
+            asyncio.ensure_future(pubsub.close())
+
+        return Subscription(subscriber, close)
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        return bool(await self.redis.set(key, owner, nx=True, px=int(ttl * 1000)))
+
+    async def close(self):
+        await self.redis.close()
+
+
+def create_broker(url: str, secret: Optional[str] = None) -> Broker:
+    if url.startswith('memory://'):
+        return MemoryBroker()
+    if url.startswith(('tcp://', 'unix://')):
+        return SocketBroker(url, secret)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisBroker(url)
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+
+class LocalClientManager(AsyncManager):
+    """Socket.IO client manager that skips rooms with no member here.
+
+    python-socketio encodes a packet before it looks for recipients, so an
+    emit to an empty room (e.g. the channel for a protocol feature nobody in
+    the room uses) would still cost a full encode.
+
+    With `outbound` set (a backpressure.OutboundGuard), every recipient of
+    an emit is checked with it before the packet is queued for them.
+    """
+
+    outbound = None
+
+    async def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        if room is not None and not self.has_members(namespace, room):
+            return
+        if self.outbound is None or callback is not None:
+            return await super().emit(event, data, namespace, room=room, skip_sid=skip_sid,
+                                      callback=callback, **kwargs)
+        # AsyncManager.emit, asking `outbound` about each recipient
+        if namespace not in self.rooms:
+            return
+        if isinstance(data, tuple):
+            data = list(data)
+        elif data is not None:
+            data = [data]
+        else:
+            data = []
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+        encoded = self.server.packet_class(packet.EVENT, namespace=namespace, data=[event] + data).encode()
+        eio_packets = [eio_packet.Packet(eio_packet.MESSAGE, part)
+                       for part in (encoded if isinstance(encoded, list) else [encoded])]
+        tasks = []
+        for sid, eio_sid in self.get_participants(namespace, room):
+            if sid in skip_sid or not self.outbound.admit(sid, eio_sid, namespace, event, data):
+                continue
+            for eio_pkt in eio_packets:
+                tasks.append(asyncio.create_task(self.server._send_eio_packet(eio_sid, eio_pkt)))
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def has_members(self, namespace, room) -> bool:
+        """Whether a room, or any of a list of rooms, has a socket connected here"""
+        rooms = self.rooms.get(namespace or '/', {})
+        if isinstance(room, str):
+            return room in rooms
+        return any(name in rooms for name in room)
+
+
+class BrokerClientManager(AsyncPubSubManager, LocalClientManager):
+    """Socket.IO client manager that shares emits through a Broker"""
+
+    name = 'broker'
+
+    def __init__(self, broker: Broker, channel: str = 'socketio', write_only: bool = False,
+                 logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.broker = broker
+
+    async def _publish(self, data):
+        await self.broker.publish(self.channel, json.dumps(data).encode())
+
+    async def _listen(self):
+        # Decoded here: AsyncPubSubManager would try pickle on raw bytes
+        subscription = await self.broker.subscribe(self.channel)
+        try:
+            async for message in subscription:
+                try:
+                    data = json.loads(message)
+                except ValueError:
+                    log.warning('bus_message_invalid', channel=self.channel)
+                    continue
+                if isinstance(data, dict):
+                    yield data
+        finally:
+            subscription.close()
+
+
+if __name__ == '__main__':
+    # Standalone broker for several server processes, e.g.
+    #   python bus.py tcp://127.0.0.1:7000
+    # Other interfaces need BROKER_SECRET, set the same on every server.
+    broker_address = sys.argv[1] if len(sys.argv) > 1 else 'tcp://127.0.0.1:7000'
+    try:
+        print(f"📡 Message broker listening on {broker_address}")
+        asyncio.run(BrokerServer(os.environ.get('BROKER_SECRET') or None).serve(broker_address))
+    except ValueError as e:
+        sys.exit(str(e))
@@ -0,0 +1,197 @@
+"""Serving stored uploads.
+
+Content-addressed files never change, so they are served with their hash
+as a strong ETag and cached as immutable. Range requests are supported, so
+audio and video players can seek without downloading the whole file, and
+conditional requests (If-None-Match, If-Range) are answered from the key
+alone; so are the previews derived from them (previews/<key>). Files from
+before content addressing are still served, with an ETag from their size
+and modification time.
+
+The body goes out through the ASGI zero-copy extension when the server
+offers it. Behind nginx, UploadFiles can instead hand the transfer over
+with X-Accel-Redirect and let nginx sendfile it; otherwise the file is read
+in blocks on the upload I/O pool.
+"""
+import asyncio
+import mimetypes
+import os
+import re
+import stat
+from email.utils import formatdate
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+import metrics
+from uploads import CONTENT_KEY_RE, IO_POOL
+
+READ_BLOCK_SIZE = 256 * 1024
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, no-cache'
+
+# Files written before uploads were content-addressed: flat, no hidden names
+LEGACY_NAME_RE = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9._-]{0,254}$')
+PREVIEW_PREFIX = 'previews/'
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+RESPONSES = metrics.registry.counter(
+    'chat_upload_responses_total', 'Responses served for /uploads', ('status',))
+SENT_BYTES = metrics.registry.counter(
+    'chat_upload_sent_bytes_total', 'File bytes sent from /uploads')
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """The (start, end) byte range a single-range header asks for, end
+    exclusive. None if it cannot be satisfied; ValueError if it is not a
+    single byte range."""
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if match is None:
+        raise ValueError(header)
+    first, last = match.groups()
+    if not first:
+        if not last:
+            raise ValueError(header)
+        # Suffix range: the last N bytes
+        length = min(int(last), size)
+        return (size - length, size) if length else None
+    start = int(first)
+    end = min(int(last) + 1, size) if last else size
+    if start >= size or end <= start:
+        return None
+    return start, end
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Weak comparison, as used by If-None-Match"""
+    if header.strip() == '*':
+        return True
+    opaque = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == opaque for tag in header.split(','))
+
+
+class UploadFiles:
+    """ASGI app serving the upload directory"""
+
+    def __init__(self, directory: Path, accel_redirect: str = '',
+                 touch: Optional[Callable[[str], None]] = None):
+        self.directory = directory
+        # nginx internal location the directory is aliased to, e.g. "/protected-uploads/"
+        self.accel_redirect = accel_redirect
+        # Told about every file sent, for least-recently-used eviction
+        self.touch = touch
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        method = scope['method']
+        if method not in ('GET', 'HEAD'):
+            await self._respond(send, 405, [(b'allow', b'GET, HEAD')])
+            return
+
+        key = scope['path'].lstrip('/')
+        immutable = CONTENT_KEY_RE.match(key.removeprefix(PREVIEW_PREFIX)) is not None
+        if not immutable and not LEGACY_NAME_RE.match(key):
+            await self._respond(send, 404)
+            return
+        path = self.directory / key
+        try:
+            info = await _run(os.stat, path)
+        except (FileNotFoundError, NotADirectoryError):
+            info = None
+        if info is None or not stat.S_ISREG(info.st_mode):
+            await self._respond(send, 404)
+            return
+
+        if self.touch is not None:
+            self.touch(key)
+        size = info.st_size
+        if immutable:
+            etag = f'"{key.removeprefix(PREVIEW_PREFIX).replace("/", "-")}"'
+        else:
+            etag = f'W/"{info.st_mtime_ns:x}-{size:x}"'
+        headers = [
+            (b'etag', etag.encode()),
+            (b'cache-control', (IMMUTABLE if immutable else REVALIDATE).encode()),
+            (b'last-modified', formatdate(info.st_mtime, usegmt=True).encode()),
+            (b'accept-ranges', b'bytes'),
+        ]
+        request_headers = {name.decode('latin-1'): value.decode('latin-1')
+                           for name, value in scope['headers']}
+
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match is not None and etag_matches(if_none_match, etag):
+            await self._respond(send, 304, headers)
+            return
+
+        content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        headers.append((b'content-type', content_type.encode()))
+
+        if self.accel_redirect:
+            # nginx serves the body (and the range) itself, with sendfile
+            location = self.accel_redirect.rstrip('/') + '/' + key
+            headers.append((b'x-accel-redirect', location.encode()))
+            await self._respond(send, 200, headers)
+            return
+
+        status, start, end = 200, 0, size
+        range_header = request_headers.get('range')
+        if_range = request_headers.get('if-range')
+        # A range only applies to the representation the client already
+        # has part of; If-Range needs a strong validator
+        if range_header and (if_range is None or (immutable and if_range.strip() == etag)):
+            try:
+                satisfiable = parse_range(range_header, size)
+            except ValueError:
+                # Multiple or malformed ranges: send the whole file
+                satisfiable = (0, size)
+            if satisfiable is None:
+                headers.append((b'content-range', f'bytes */{size}'.encode()))
+                await self._respond(send, 416, headers)
+                return
+            start, end = satisfiable
+            if (start, end) != (0, size):
+                status = 206
+                headers.append((b'content-range', f'bytes {start}-{end - 1}/{size}'.encode()))
+
+        headers.append((b'content-length', str(end - start).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        RESPONSES.inc(str(status))
+        if method == 'HEAD' or start == end:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        SENT_BYTES.inc(amount=end - start)
+
+        handle = await _run(open, path, 'rb')
+        try:
+            if 'http.response.zerocopysend' in scope.get('extensions', {}):
+                await send({
+                    'type': 'http.response.zerocopysend',
+                    'file': handle,
+                    'offset': start,
+                    'count': end - start,
+                })
+                return
+            position = start
+            while position < end:
+                block = await _run(os.pread, handle.fileno(), min(READ_BLOCK_SIZE, end - position), position)
+                if not block:
+                    break
+                position += len(block)
+                await send({'type': 'http.response.body', 'body': block, 'more_body': position < end})
+            if position < end:
+                # Truncated underneath us; end the response cleanly
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await _run(handle.close)
+
+    async def _respond(self, send, status: int, headers: Optional[List[Tuple[bytes, bytes]]] = None):
+        headers = list(headers or [])
+        if status != 304:
+            headers.append((b'content-length', b'0'))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''})
+        RESPONSES.inc(str(status))
+
+
+async def _run(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(IO_POOL, function, *args)
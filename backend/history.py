@@ -0,0 +1,384 @@
+"""Bounded in-memory message history for chat rooms.
+
+Each room keeps its messages in a ring buffer: new messages are appended at
+the tail and old ones are evicted from the head, either because the room is
+over its message cap, the whole store is over its global cap, or the
+message is older than the configured maximum age. Deleting a message only
+drops it from the id index and leaves a tombstone in the ring, which is
+compacted lazily once tombstones make up a large part of the buffer.
+
+Message ids come from MessageIdGenerator and sort in creation order, which
+lets a room seek to a cursor with a binary search over its ring.
+"""
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+# Listener signature: (message, reason) where reason is 'evicted' or 'deleted'
+HistoryListener = Callable[[Dict[str, Any], str], None]
+
+
+class MessageIdGenerator:
+    """Time-ordered, collision-free message ids.
+
+    Ids are the creation time in milliseconds followed by a per-millisecond
+    sequence number, both as fixed-width hex, so plain string comparison
+    orders them by creation time. The clock never moves backwards: if the
+    wall clock does, or a millisecond runs out of sequence numbers, ids keep
+    counting from the last millisecond used.
+    """
+
+    SEQUENCE_LIMIT = 0x10000
+
+    def __init__(self, suffix: str = ''):
+        # Optional suffix (e.g. a node id) keeps ids unique across processes
+        self.suffix = suffix
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next(self) -> str:
+        with self._lock:
+            now_ms = int(time.time() * 1000)
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            else:
+                self._sequence += 1
+                if self._sequence >= self.SEQUENCE_LIMIT:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return f"{self._last_ms:012x}{self._sequence:04x}{self.suffix}"
+
+
+def estimate_message_size(message: Dict[str, Any]) -> int:
+    """Rough number of bytes held by a message dict and its values"""
+    size = sys.getsizeof(message)
+    for key, value in message.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+        if isinstance(value, dict):
+            for inner_key, inner_value in value.items():
+                size += sys.getsizeof(inner_key) + sys.getsizeof(inner_value)
+    return size
+
+
+class RoomHistory:
+    """Ring buffer of messages for a single room"""
+
+    # Don't bother compacting tiny buffers
+    COMPACT_MIN_SLOTS = 64
+
+    def __init__(self, room: str, max_messages: int, max_age: float):
+        self.room = room
+        self.max_messages = max_messages
+        self.max_age = max_age
+
+        # Ring slots, oldest first. Slots before _head are already evicted,
+        # slots whose id is missing from _messages are tombstones.
+        self._ids: List[str] = []
+        self._times: List[float] = []
+        self._head = 0
+        self._tombstones = 0
+
+        self._messages: Dict[str, Dict[str, Any]] = {}
+        self._sizes: Dict[str, int] = {}
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._messages
+
+    def get(self, message_id: str) -> Optional[Dict[str, Any]]:
+        return self._messages.get(message_id)
+
+    def append(self, message_id: str, message: Dict[str, Any], now: float):
+        if self._ids and message_id < self._ids[-1]:
+            # Messages replicated from another worker can arrive slightly out
+            # of order; keep the ring sorted so cursors still work
+            index = bisect_right(self._ids, message_id, self._head)
+            self._ids.insert(index, message_id)
+            self._times.insert(index, now)
+        else:
+            self._ids.append(message_id)
+            self._times.append(now)
+        self._messages[message_id] = message
+        size = estimate_message_size(message)
+        self._sizes[message_id] = size
+        self.bytes += size
+
+    def resize(self, message_id: str):
+        """Recompute the size of a message after it was edited in place"""
+        message = self._messages.get(message_id)
+        if message is None:
+            return
+        size = estimate_message_size(message)
+        self.bytes += size - self._sizes[message_id]
+        self._sizes[message_id] = size
+
+    def delete(self, message_id: str) -> Optional[Dict[str, Any]]:
+        """Drop a message, leaving a tombstone in its ring slot"""
+        message = self._messages.pop(message_id, None)
+        if message is None:
+            return None
+        self.bytes -= self._sizes.pop(message_id)
+        self._tombstones += 1
+        self._maybe_compact()
+        return message
+
+    def oldest_time(self) -> Optional[float]:
+        self._skip_tombstones()
+        if self._head < len(self._ids):
+            return self._times[self._head]
+        return None
+
+    def pop_oldest(self) -> Optional[Dict[str, Any]]:
+        """Evict the oldest live message"""
+        self._skip_tombstones()
+        if self._head >= len(self._ids):
+            return None
+        message_id = self._ids[self._head]
+        self._head += 1
+        message = self._messages.pop(message_id)
+        self.bytes -= self._sizes.pop(message_id)
+        self._maybe_compact()
+        return message
+
+    def messages(self) -> List[Dict[str, Any]]:
+        """All live messages, oldest first"""
+        return [self._messages[message_id]
+                for message_id in self._ids[self._head:]
+                if message_id in self._messages]
+
+    def recent(self, limit: int) -> List[Dict[str, Any]]:
+        """The newest `limit` live messages, oldest first"""
+        result = []
+        index = len(self._ids) - 1
+        while index >= self._head and len(result) < limit:
+            message = self._messages.get(self._ids[index])
+            if message is not None:
+                result.append(message)
+            index -= 1
+        result.reverse()
+        return result
+
+    def page(self, limit: int, before: Optional[str] = None,
+             after: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        """Seek to a cursor and return up to `limit` live messages, oldest first.
+
+        `before` pages backwards from the newest message older than the
+        cursor, `after` pages forwards from the oldest message newer than it;
+        without a cursor the newest messages are returned. The flag tells
+        whether more messages exist past the returned page in the paging
+        direction. Cursors are message ids and need not exist any more.
+        """
+        if after is not None:
+            index = bisect_right(self._ids, after, self._head)
+            result = []
+            while index < len(self._ids) and len(result) < limit:
+                message = self._messages.get(self._ids[index])
+                if message is not None:
+                    result.append(message)
+                index += 1
+            return result, self._has_live(index, len(self._ids), 1)
+
+        if before is not None:
+            end = bisect_left(self._ids, before, self._head)
+        else:
+            end = len(self._ids)
+        result = []
+        index = end - 1
+        while index >= self._head and len(result) < limit:
+            message = self._messages.get(self._ids[index])
+            if message is not None:
+                result.append(message)
+            index -= 1
+        result.reverse()
+        return result, self._has_live(index, self._head - 1, -1)
+
+    def _has_live(self, start: int, stop: int, step: int) -> bool:
+        # Only tombstones can sit between a page and the next live message,
+        # and compaction keeps those to at most half the ring
+        for index in range(start, stop, step):
+            if self._ids[index] in self._messages:
+                return True
+        return False
+
+    def _skip_tombstones(self):
+        while self._head < len(self._ids) and self._ids[self._head] not in self._messages:
+            self._head += 1
+            self._tombstones -= 1
+
+    def _maybe_compact(self):
+        dead = self._head + self._tombstones
+        if dead < self.COMPACT_MIN_SLOTS or dead * 2 < len(self._ids):
+            return
+        ids = []
+        times = []
+        for index in range(self._head, len(self._ids)):
+            message_id = self._ids[index]
+            if message_id in self._messages:
+                ids.append(message_id)
+                times.append(self._times[index])
+        self._ids = ids
+        self._times = times
+        self._head = 0
+        self._tombstones = 0
+
+
+class HistoryStore:
+    """Message history for all rooms with per-room and global caps"""
+
+    def __init__(self, max_per_room: int = 1000, max_total: int = 100000,
+                 max_age: float = 24 * 3600):
+        self.max_per_room = max_per_room
+        self.max_total = max_total
+        self.max_age = max_age
+
+        self._rooms: Dict[str, RoomHistory] = {}
+        self._room_of: Dict[str, str] = {}  # message_id -> room
+        # Global append order, used to evict the oldest message across rooms.
+        # Entries for messages that are already gone are skipped lazily.
+        self._order: Deque[Tuple[str, str]] = deque()
+        self._listeners: List[HistoryListener] = []
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._room_of)
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._room_of
+
+    def add_listener(self, listener: HistoryListener):
+        """Call `listener(message, reason)` whenever a message leaves history"""
+        self._listeners.append(listener)
+
+    def room(self, room: str) -> Optional[RoomHistory]:
+        return self._rooms.get(room)
+
+    def rooms(self) -> List[str]:
+        return list(self._rooms)
+
+    def get(self, message_id: str) -> Optional[Dict[str, Any]]:
+        room = self._room_of.get(message_id)
+        if room is None:
+            return None
+        return self._rooms[room].get(message_id)
+
+    def append(self, room: str, message: Dict[str, Any], now: Optional[float] = None):
+        """Store a message and evict whatever no longer fits"""
+        now = time.time() if now is None else now
+        message_id = message['id']
+        history = self._rooms.get(room)
+        if history is None:
+            history = RoomHistory(room, self.max_per_room, self.max_age)
+            self._rooms[room] = history
+
+        history.append(message_id, message, now)
+        self._room_of[message_id] = room
+        self._order.append((room, message_id))
+
+        while len(history) > history.max_messages:
+            self._evict_from(history)
+        self._expire_room(history, now)
+        while len(self._room_of) > self.max_total:
+            self._evict_global()
+        self._maybe_compact_order()
+
+    def update(self, message_id: str):
+        """Account for an in-place edit of a stored message"""
+        room = self._room_of.get(message_id)
+        if room is not None:
+            self._rooms[room].resize(message_id)
+
+    def delete(self, message_id: str) -> Optional[Dict[str, Any]]:
+        room = self._room_of.pop(message_id, None)
+        if room is None:
+            return None
+        history = self._rooms[room]
+        message = history.delete(message_id)
+        if not len(history):
+            del self._rooms[room]
+        self._notify(message, 'deleted')
+        return message
+
+    def recent(self, room: str, limit: int) -> List[Dict[str, Any]]:
+        history = self._rooms.get(room)
+        if history is None or limit <= 0:
+            return []
+        return history.recent(limit)
+
+    def page(self, room: str, limit: int, before: Optional[str] = None,
+             after: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        history = self._rooms.get(room)
+        if history is None or limit <= 0:
+            return [], False
+        return history.page(limit, before=before, after=after)
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Evict messages older than max_age from every room"""
+        now = time.time() if now is None else now
+        before = self.evicted
+        for history in list(self._rooms.values()):
+            self._expire_room(history, now)
+        self._maybe_compact_order()
+        return self.evicted - before
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'messages': len(self._room_of),
+            'rooms': len(self._rooms),
+            'bytes': sum(history.bytes for history in self._rooms.values()),
+            'evicted': self.evicted,
+            'max_per_room': self.max_per_room,
+            'max_total': self.max_total,
+            'max_age': self.max_age,
+        }
+
+    def room_stats(self) -> Dict[str, Dict[str, int]]:
+        """Message count and estimated memory use per room"""
+        return {room: {'messages': len(history), 'bytes': history.bytes}
+                for room, history in self._rooms.items()}
+
+    def _expire_room(self, history: RoomHistory, now: float):
+        cutoff = now - history.max_age
+        while True:
+            oldest = history.oldest_time()
+            if oldest is None or oldest >= cutoff:
+                break
+            self._evict_from(history)
+
+    def _evict_from(self, history: RoomHistory):
+        message = history.pop_oldest()
+        if message is None:
+            return
+        del self._room_of[message['id']]
+        if not len(history):
+            del self._rooms[history.room]
+        self.evicted += 1
+        self._notify(message, 'evicted')
+
+    def _evict_global(self):
+        while self._order:
+            room, message_id = self._order.popleft()
+            if self._room_of.get(message_id) != room:
+                continue
+            history = self._rooms[room]
+            # Per-room buffers are append-ordered too, so the globally oldest
+            # live message is also the oldest one in its room.
+            self._evict_from(history)
+            return
+
+    def _maybe_compact_order(self):
+        if len(self._order) <= 2 * len(self._room_of) + RoomHistory.COMPACT_MIN_SLOTS:
+            return
+        self._order = deque(entry for entry in self._order
+                            if self._room_of.get(entry[1]) == entry[0])
+
+    def _notify(self, message: Dict[str, Any], reason: str):
+        for listener in self._listeners:
+            listener(message, reason)
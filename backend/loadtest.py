@@ -0,0 +1,484 @@
+"""Load generator for the Socket.IO server.
+
+Connects many Socket.IO clients and drives one scenario at a time:
+
+- rooms: clients spread over rooms of --room-size, sending chat messages
+  (join_room + send_message); latency is from sending a message to each
+  member receiving it
+- private: pairs of clients exchanging private_message
+- stranger: find_stranger / skip_stranger churn; latency is from starting
+  a search to stranger_found
+- signaling: matched strangers relaying webrtc_offer and
+  webrtc_ice_candidate to each other
+
+Every scenario reports p50/p95/p99 end-to-end latency, delivered events per
+second and the server's resident memory, and the whole run is written to a
+JSON file, so two versions can be compared:
+
+    python loadtest.py --clients 1000 --duration 30 --output before.json
+    python loadtest.py --compare before.json after.json
+
+By default the server (main:socket_app) is started on a free local port,
+without rate limits and with LOG_LEVEL=warning (--server-env to change
+that); --url targets a server that is already running, and --in-process
+runs it in this process, where memory figures include the clients.
+Clients need aiohttp (pip install aiohttp). Thousands of clients need as
+many file descriptors; the soft limit is raised to the hard one.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+from array import array
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import socketio
+
+SCENARIOS = ('rooms', 'private', 'stranger', 'signaling')
+# Every class in main.RATE_LIMIT_DEFAULTS, unlimited
+UNLIMITED = 'message=0,typing=0,reaction=0,signaling=0,session=0,teardown=0,default=0'
+PREFIX = 'bench '  # content of generated messages: PREFIX + send time
+
+
+def stamp() -> str:
+    return f"{PREFIX}{time.perf_counter()!r}"
+
+
+def percentile(ordered: List[float], q: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class Stats:
+    """Events sent and received in one scenario, with their latencies"""
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.latencies = array('d')
+
+    def observe(self, started: float):
+        self.received += 1
+        self.latencies.append(time.perf_counter() - started)
+
+    def receive(self, content: Any):
+        """Count a delivered event carrying a stamp()"""
+        if isinstance(content, str) and content.startswith(PREFIX):
+            self.observe(float(content[len(PREFIX):]))
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+        ms = lambda value: None if value is None else round(value * 1000, 3)
+        return {
+            'sent': self.sent,
+            'received': self.received,
+            'errors': self.errors,
+            'events_per_sec': round(self.received / elapsed, 1),
+            'latency_ms': {
+                'p50': ms(percentile(ordered, 50)),
+                'p95': ms(percentile(ordered, 95)),
+                'p99': ms(percentile(ordered, 99)),
+                'max': ms(ordered[-1] if ordered else None),
+            },
+        }
+
+
+class Memory:
+    """Resident memory of the server process, sampled while a scenario runs"""
+
+    def __init__(self, pid: Optional[int], interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[float] = []
+
+    def rss_mb(self) -> Optional[float]:
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/status") as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        if self.pid == os.getpid():
+            import resource  # peak rather than current, where /proc is missing
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return None
+
+    async def run(self):
+        while True:
+            rss = self.rss_mb()
+            if rss is not None:
+                self.samples.append(rss)
+            await asyncio.sleep(self.interval)
+
+    def report(self) -> Optional[Dict[str, float]]:
+        if not self.samples:
+            return None
+        return {'start': round(self.samples[0], 1), 'peak': round(max(self.samples), 1),
+                'end': round(self.samples[-1], 1)}
+
+
+async def connect_clients(url: str, count: int, features: List[str], concurrency: int,
+                          connect_stats: Stats) -> List[socketio.AsyncClient]:
+    limit = asyncio.Semaphore(concurrency)
+
+    async def connect_one():
+        client = socketio.AsyncClient(reconnection=False)
+        async with limit:
+            started = time.perf_counter()
+            await client.connect(url, transports=['websocket'], wait_timeout=30,
+                                 auth={'features': features} if features else None)
+            connect_stats.observe(started)
+        return client
+
+    return list(await asyncio.gather(*(connect_one() for _ in range(count))))
+
+
+async def disconnect_clients(clients: List[socketio.AsyncClient]):
+    await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+
+
+async def request(client: socketio.AsyncClient, event: str, data: Any, reply: str,
+                  timeout: float = 30):
+    """Emit `event` and wait for the server's `reply` event"""
+    done = asyncio.get_running_loop().create_future()
+    client.on(reply, lambda payload=None: done.done() or done.set_result(payload))
+    await client.emit(event, data)
+    return await asyncio.wait_for(done, timeout)
+
+
+async def drive(senders: List[Callable], rate: float, duration: float, stats: Stats):
+    """Call each sender in turn for `duration`, `rate` times per second in total"""
+    if not senders or rate <= 0:
+        await asyncio.sleep(duration)
+        return
+    interval = len(senders) / rate
+    stop = time.perf_counter() + duration
+
+    async def loop(send):
+        await asyncio.sleep(random.uniform(0, interval))
+        while time.perf_counter() < stop:
+            try:
+                await send()
+                stats.sent += 1
+            except Exception:
+                stats.errors += 1
+            await asyncio.sleep(interval)
+
+    await asyncio.gather(*(loop(send) for send in senders))
+
+
+async def rooms(clients, args, stats: Stats):
+    def on_message(data):
+        stats.receive(data.get('content', data.get('c')))
+
+    def on_batch(data):
+        for message in data.get('messages', data.get('ms', [])):
+            on_message(message)
+
+    for client in clients:
+        client.on('message', on_message)
+        client.on('message_batch', on_batch)
+    await asyncio.gather(*(
+        request(client, 'join_room', {'room': f"bench-{i // args.room_size}", 'username': f"user{i}"},
+                'join_success')
+        for i, client in enumerate(clients)))
+    senders = [lambda client=client: client.emit('send_message', {'message': stamp()})
+               for client in clients]
+    await drive(senders, args.rate, args.duration, stats)
+
+
+async def private(clients, args, stats: Stats):
+    def on_private(data):
+        if not data.get('fromSelf'):
+            stats.receive(data.get('content'))
+
+    for client in clients:
+        client.on('private_message', on_private)
+    pairs = len(clients) // 2 * 2
+    senders = [lambda client=client, to=clients[i ^ 1].get_sid():
+               client.emit('private_message', {'to': to, 'message': stamp()})
+               for i, client in enumerate(clients[:pairs])]
+    await drive(senders, args.rate, args.duration, stats)
+
+
+class Stranger:
+    """One client in the stranger scenarios"""
+
+    def __init__(self, client: socketio.AsyncClient, stats: Stats, hold: Optional[float]):
+        self.client = client
+        self.stats = stats
+        self.hold = hold  # seconds before skipping a partner; None keeps it
+        self.partner: Optional[str] = None
+        self.generation = 0
+        self.searching = 0.0
+        self.running = True
+        self.matched = asyncio.Event()
+        client.on('stranger_found', self.on_found)
+        client.on('stranger_disconnected', self.on_partner_left)
+
+    async def search(self, event: str = 'find_stranger'):
+        self.searching = time.perf_counter()
+        self.stats.sent += 1
+        await self.client.emit(event, {'interests': []})
+
+    async def on_found(self, data):
+        self.partner = data.get('partner_id')
+        self.generation += 1
+        self.stats.observe(self.searching)
+        self.matched.set()
+        if self.hold is not None:
+            asyncio.ensure_future(self.skip_later(self.generation))
+
+    async def on_partner_left(self, data=None):
+        self.partner = None
+        if self.running:
+            await self.search()
+
+    async def skip_later(self, generation: int):
+        await asyncio.sleep(random.uniform(0, 2 * self.hold))
+        if self.running and self.partner is not None and self.generation == generation:
+            self.partner = None
+            await self.search('skip_stranger')
+
+
+async def enter_stranger_mode(clients, stats: Stats, hold: Optional[float]) -> List[Stranger]:
+    await asyncio.gather(*(request(client, 'enter_stranger_mode', {}, 'stranger_mode_entered')
+                           for client in clients))
+    strangers = [Stranger(client, stats, hold) for client in clients]
+    for stranger in strangers:
+        await stranger.search()
+    return strangers
+
+
+async def stranger(clients, args, stats: Stats):
+    strangers = await enter_stranger_mode(clients, stats, args.hold)
+    await asyncio.sleep(args.duration)
+    for each in strangers:
+        each.running = False
+
+
+async def signaling(clients, args, stats: Stats):
+    # Pair everyone up first; matches are not part of this scenario's figures
+    strangers = await enter_stranger_mode(clients, Stats(), None)
+    await asyncio.wait([asyncio.ensure_future(each.matched.wait()) for each in strangers], timeout=30)
+    paired = [each for each in strangers if each.partner is not None]
+
+    def on_offer(data):
+        stats.receive((data.get('offer') or {}).get('sdp'))
+
+    def on_candidate(data):
+        stats.receive((data.get('candidate') or {}).get('candidate'))
+
+    def on_candidates(data):
+        for candidate in data.get('candidates', []):
+            stats.receive((candidate or {}).get('candidate'))
+
+    for each in paired:
+        each.client.on('webrtc_offer', on_offer)
+        each.client.on('webrtc_ice_candidate', on_candidate)
+        each.client.on('webrtc_ice_candidates', on_candidates)
+
+    async def send(client, count=[0]):
+        # One offer for every ten candidates, as in a renegotiation
+        count[0] += 1
+        if count[0] % 10 == 0:
+            await client.emit('webrtc_offer', {'offer': {'type': 'offer', 'sdp': stamp()}})
+        else:
+            await client.emit('webrtc_ice_candidate', {'candidate': {
+                'candidate': stamp(), 'sdpMid': '0', 'sdpMLineIndex': 0}})
+
+    await drive([lambda client=each.client: send(client) for each in paired],
+                args.rate, args.duration, stats)
+    for each in strangers:
+        each.running = False
+
+
+async def run_scenario(name: str, url: str, args, memory: Memory) -> Dict[str, Any]:
+    load = f"skips every ~{args.hold:g}s" if name == 'stranger' else f"{args.rate:g} events/s"
+    print(f"▶️  {name}: {args.clients} clients, {load} for {args.duration:g}s")
+    connect_stats = Stats()
+    clients = await connect_clients(url, args.clients, args.features, args.concurrency, connect_stats)
+    stats = Stats()
+    memory.samples = []
+    sampler = asyncio.ensure_future(memory.run())
+    started = time.perf_counter()
+    try:
+        await globals()[name](clients, args, stats)
+        await asyncio.sleep(args.drain)  # let events in flight arrive
+    finally:
+        elapsed = time.perf_counter() - started - args.drain
+        sampler.cancel()
+        await disconnect_clients(clients)
+    result = stats.report(elapsed)
+    result['connect_ms'] = connect_stats.report(1)['latency_ms']
+    result['rss_mb'] = memory.report()
+    latency = result['latency_ms']
+    print(f"   {result['events_per_sec']:g} events/s, "
+          f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+          f"rss {result['rss_mb']}")
+    return result
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+async def wait_until_up(url: str, timeout: float = 30):
+    import aiohttp
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server at {url} did not start")
+            await asyncio.sleep(0.2)
+
+
+def server_env(overrides: List[str]) -> Dict[str, str]:
+    env = {'RATE_LIMITS': UNLIMITED, 'LOG_LEVEL': 'warning'}
+    for item in overrides:
+        key, _, value = item.partition('=')
+        env[key] = value
+    return env
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def raise_file_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+async def benchmark(args) -> Dict[str, Any]:
+    env = server_env(args.server_env)
+    process = server = None
+    if args.url:
+        url, pid = args.url, None
+    elif args.in_process:
+        os.environ.update(env)
+        import uvicorn
+        import main
+        port = free_port()
+        server = uvicorn.Server(uvicorn.Config(main.socket_app, host='127.0.0.1', port=port,
+                                               log_level='warning'))
+        serving = asyncio.ensure_future(server.serve())
+        url, pid = f"http://127.0.0.1:{port}", os.getpid()
+    else:
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:socket_app', '--host', '127.0.0.1',
+             '--port', str(port), '--log-level', 'warning'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, **env})
+        url, pid = f"http://127.0.0.1:{port}", process.pid
+
+    results = {}
+    try:
+        await wait_until_up(url)
+        memory = Memory(pid)
+        for name in (SCENARIOS if args.scenario == 'all' else [args.scenario]):
+            results[name] = await run_scenario(name, url, args, memory)
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await serving
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    return {
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'server': {'url': args.url, 'in_process': args.in_process,
+                   'env': {} if args.url else env},
+        'config': {'clients': args.clients, 'duration': args.duration, 'rate': args.rate,
+                   'room_size': args.room_size, 'hold': args.hold, 'features': args.features},
+        'scenarios': results,
+    }
+
+
+def compare(before_path: str, after_path: str):
+    """Print the change of each figure between two result files"""
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(f"{before.get('revision')} -> {after.get('revision')}")
+    figures = [('events/s', ('events_per_sec',)), ('p50 ms', ('latency_ms', 'p50')),
+               ('p95 ms', ('latency_ms', 'p95')), ('p99 ms', ('latency_ms', 'p99')),
+               ('rss peak MB', ('rss_mb', 'peak'))]
+    for name in after['scenarios']:
+        if name not in before['scenarios']:
+            continue
+        print(name)
+        for label, path in figures:
+            old, new = before['scenarios'][name], after['scenarios'][name]
+            for key in path:
+                old, new = (old or {}).get(key), (new or {}).get(key)
+            change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else ''
+            print(f"  {label:<12} {old!s:>10} {new!s:>10} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Socket.IO load test')
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=20, help='seconds per scenario')
+    parser.add_argument('--rate', type=float, default=200,
+                        help='events per second sent by all clients together')
+    parser.add_argument('--room-size', type=int, default=50, help='clients per room (rooms)')
+    parser.add_argument('--hold', type=float, default=1.0,
+                        help='average seconds before skipping a stranger (stranger)')
+    parser.add_argument('--features', type=lambda value: [f for f in value.split(',') if f],
+                        default=[], help='opt-in features the clients ask for, e.g. message_batch,compact')
+    parser.add_argument('--concurrency', type=int, default=100, help='connections opened at once')
+    parser.add_argument('--drain', type=float, default=2.0,
+                        help='seconds to wait for events in flight after sending stops')
+    parser.add_argument('--url', help='server to test instead of starting one')
+    parser.add_argument('--in-process', action='store_true', help='run the server in this process')
+    parser.add_argument('--server-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='environment of the started server')
+    parser.add_argument('--output', default='loadtest-results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    raise_file_limit()
+    results = asyncio.run(benchmark(args))
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f"📄 Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
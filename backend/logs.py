@@ -0,0 +1,147 @@
+"""Structured, level-gated logging that never blocks the event loop.
+
+Log calls take an event name plus key/value fields:
+
+    log.info('user_joined', sid=sid, room=room)
+
+Disabled levels cost a single level check. Enabled records are put on a
+queue as-is; formatting and writing to stdout happen on a listener thread.
+Noisy events can be sampled, e.g. LOG_SAMPLE="message_received=0.01"
+keeps one in a hundred of them.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from typing import Any, Dict, Optional
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+}
+
+ROOT_LOGGER = 'chat'
+
+# event name -> fraction of records kept
+_sample_rates: Dict[str, float] = {}
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = f"{self.formatTime(record)} {record.levelname:<7} {record.name} {record.getMessage()}"
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            text += '\n' + self.formatException(record.exc_info)
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            'ts': record.created,
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records unformatted; the listener thread does the formatting"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class EventLogger:
+    """Logger taking an event name and key/value fields"""
+
+    def __init__(self, logger: logging.Logger):
+        self._logger = logger
+
+    def enabled(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def debug(self, event: str, /, **fields):
+        self._log(DEBUG, event, fields)
+
+    def info(self, event: str, /, **fields):
+        self._log(INFO, event, fields)
+
+    def warning(self, event: str, /, **fields):
+        self._log(WARNING, event, fields)
+
+    def error(self, event: str, /, **fields):
+        self._log(ERROR, event, fields)
+
+    def exception(self, event: str, /, **fields):
+        """Log at error level with the exception being handled"""
+        if self._logger.isEnabledFor(ERROR):
+            self._logger.error(event, exc_info=True, extra={'fields': fields})
+
+    def _log(self, level: int, event: str, fields: Dict[str, Any]):
+        if not self._logger.isEnabledFor(level):
+            return
+        rate = _sample_rates.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        self._logger.log(level, event, extra={'fields': fields})
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    """Parse "event=rate,event=rate" into a dict"""
+    rates = {}
+    for item in spec.split(','):
+        if '=' in item:
+            event, _, rate = item.partition('=')
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(level: str = 'info', fmt: str = 'text', sample_rates: Optional[Dict[str, float]] = None):
+    """Route every `chat.*` logger through a queue to a stdout writer thread"""
+    global _listener
+    stop_logging()
+
+    _sample_rates.clear()
+    _sample_rates.update(sample_rates or {})
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, stream)
+    _listener.start()
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(LEVELS.get(level.lower(), INFO))
+    root.handlers = [DeferredQueueHandler(records)]
+    root.propagate = False
+
+
+@atexit.register
+def stop_logging():
+    """Write out queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name: str) -> EventLogger:
+    return EventLogger(logging.getLogger(f"{ROOT_LOGGER}.{name}"))
@@ -1,7 +1,7 @@
 import socketio
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.requests import ClientDisconnect
 import uvicorn
 from datetime import datetime
 import json
@@ -12,9 +12,92 @@ import mimetypes
 import random
 from typing import Dict, List, Optional, Any 
 from pydantic import BaseModel
+import asyncio
+import time
+from urllib.parse import parse_qs
+from history import HistoryStore, MessageIdGenerator
+from storage import create_storage
+from search import SearchIndex
+from bus import BrokerClientManager, LocalClientManager, create_broker, start_broker_thread
+from state import create_state
+from matchmaking import BatchMatcher, TrendingInterests
+import logs
+import metrics
+from signaling import CandidateBatcher
+from batching import MessageBatcher
+from ratelimit import RateLimiter, parse_limits
+from backpressure import OutboundGuard, WebSocketTransports
+from serialization import COMPACT_EVENTS, COMPACT_KEYS, FastJSONResponse, SocketIOJson, compact
+from typing_indicators import TypingTracker
+from presence import PresenceTracker
+from reactions import ReactionIndex
+from fileserver import UploadFiles
+from previews import PreviewCache
+from retention import UploadCollector
+from uploads import CONTENT_KEY_RE, ResumableUploads, UploadError, UploadStore, file_key, receive_file
+
+# Structured logging: LOG_LEVEL (debug/info/warning/error), LOG_FORMAT
+# (text/json), LOG_SAMPLE ("event=rate,..." keeps that fraction of an event)
+logs.setup_logging(
+    level=os.environ.get("LOG_LEVEL", "info"),
+    fmt=os.environ.get("LOG_FORMAT", "text"),
+    sample_rates=logs.parse_sample_rates(os.environ.get("LOG_SAMPLE", ""))
+)
+log = logs.get_logger('server')
+
 # Create uploads directory
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
+# Uploads are stored once per content and deleted with their last message.
+# Files in progress go to uploads/.incoming, on the same filesystem, so the
+# final move is atomic.
+upload_store = UploadStore(UPLOAD_DIR)
+upload_store.tmp_dir.mkdir(exist_ok=True)
+MAX_UPLOAD_SIZE = int(os.environ.get("UPLOAD_MAX_BYTES", 10 * 1024 * 1024))
+# Documents may be larger; they are written to disk as they arrive either way
+MAX_DOCUMENT_SIZE = int(os.environ.get("UPLOAD_DOCUMENT_MAX_BYTES", 100 * 1024 * 1024))
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # multipart boundaries and headers
+# Resumable uploads: suggested chunk size, and how long an idle session is kept
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_BYTES", 4 * 1024 * 1024))
+UPLOAD_SESSION_TTL = float(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))  # seconds
+UPLOAD_SESSION_EXPIRE_INTERVAL = 600  # seconds between sweeps for idle sessions
+resumable_uploads = ResumableUploads(UPLOAD_DIR / ".sessions", ttl=UPLOAD_SESSION_TTL)
+resumable_uploads.directory.mkdir(exist_ok=True)
+# Thumbnails and audio waveforms are made in worker processes, starting
+# with the upload; messages get theirs with a file_preview event once ready
+PREVIEW_WORKERS = int(os.environ.get("PREVIEW_WORKERS", 2))
+previews = PreviewCache(UPLOAD_DIR, workers=PREVIEW_WORKERS)
+upload_store.add_listener(previews.discard)
+# Unsent uploads are deleted after UPLOAD_ORPHAN_GRACE seconds; with
+# UPLOAD_QUOTA_BYTES set, the least recently used files go first when over it
+upload_collector = UploadCollector(
+    upload_store,
+    orphan_grace=float(os.environ.get("UPLOAD_ORPHAN_GRACE", 24 * 3600)),
+    quota=int(os.environ.get("UPLOAD_QUOTA_BYTES", 0)),
+    interval=float(os.environ.get("UPLOAD_GC_INTERVAL", 3600))
+)
+
+# Enhanced allowed types including voice messages
+ALLOWED_UPLOAD_TYPES = {
+    # Images
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp',
+    # Documents
+    'application/pdf', 'text/plain', 
+    'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    # Audio files (including voice messages)
+    'audio/mpeg', 'audio/wav', 'audio/ogg', 'audio/mp4', 'audio/aac',
+    'audio/webm', 'audio/webm;codecs=opus'  # Voice message formats
+}
+DOCUMENT_TYPES = {
+    'application/pdf', 'text/plain',
+    'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+}
+
+def upload_limit(content_type: str) -> int:
+    return MAX_DOCUMENT_SIZE if content_type in DOCUMENT_TYPES else MAX_UPLOAD_SIZE
+
+UPLOADS = metrics.registry.counter('chat_uploads_total', 'Files uploaded')
+UPLOAD_BYTES = metrics.registry.counter('chat_upload_bytes_total', 'Bytes uploaded')
 
 class EditMessageRequest(BaseModel):
     message_id: str
@@ -25,12 +108,68 @@ class DeleteMessageRequest(BaseModel):
     message_id: str
     room: str
 
+class CreateUploadRequest(BaseModel):
+    filename: str
+    content_type: str
+    size: int
 
-messages_storage: Dict[str, Dict[str, Any]] = {}
-rooms_storage: Dict[str, list] = {}
+
+# Bounded per-room message history (see history.py)
+HISTORY_MAX_PER_ROOM = int(os.environ.get("HISTORY_MAX_PER_ROOM", 1000))
+HISTORY_MAX_TOTAL = int(os.environ.get("HISTORY_MAX_TOTAL", 100000))
+HISTORY_MAX_AGE = float(os.environ.get("HISTORY_MAX_AGE", 24 * 3600))  # seconds
+HISTORY_EXPIRE_INTERVAL = 60  # seconds between age-based eviction sweeps
+MAX_PAGE_SIZE = 200  # messages per GET /messages/{room_id} page
+
+message_history = HistoryStore(
+    max_per_room=HISTORY_MAX_PER_ROOM,
+    max_total=HISTORY_MAX_TOTAL,
+    max_age=HISTORY_MAX_AGE
+)
+
+# Full-text index over room history, bounded by a postings budget
+SEARCH_MAX_POSTINGS = int(os.environ.get("SEARCH_MAX_POSTINGS", 2000000))
+search_index = SearchIndex(max_postings=SEARCH_MAX_POSTINGS)
+# Messages leaving history (deleted or evicted) leave the index too, and
+# release the upload they point at
+message_history.add_listener(lambda message, reason: search_index.remove(message['id']))
+message_history.add_listener(lambda message, reason: upload_store.release(message))
+message_history.add_listener(lambda message, reason: message_reactions.discard(message['id']))
+
+# Time-ordered, collision-free ids for every message the server creates
+message_ids = MessageIdGenerator()
+
+# Durable storage: 'memory' (default, nothing survives a restart) or 'sqlite'
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "memory")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "chat.db")
+
+storage = create_storage(STORAGE_BACKEND, SQLITE_PATH)
+
+# Scale-out: with WORKERS > 1 (or CLUSTER_BROKER set) every process shares
+# room broadcasts and connection state through a message broker. Without an
+# explicit broker, `python main.py` starts a local one for its workers.
+WORKERS = int(os.environ.get("WORKERS", 1))
+CLUSTER_BROKER = os.environ.get("CLUSTER_BROKER", "")
+LOCAL_BROKER_ADDRESS = "unix:///tmp/mumegle-broker.sock"
+# Shared secret of a tcp:// broker; needed when it listens beyond localhost
+BROKER_SECRET = os.environ.get("BROKER_SECRET") or None
+
+broker = create_broker(CLUSTER_BROKER, BROKER_SECRET) if CLUSTER_BROKER else None
+state = create_state(broker)
+if broker is not None:
+    message_ids.suffix = f"-{state.node_id}"
+
+# Long-polling needs every request of a session to reach the process that
+# holds it, i.e. a load balancer with sticky sessions. Without
+# STICKY_SESSIONS=1, several processes only accept websocket connections.
+STICKY_SESSIONS = os.environ.get("STICKY_SESSIONS", "0") == "1"
+SOCKETIO_TRANSPORTS = ['polling', 'websocket'] if broker is None or STICKY_SESSIONS else ['websocket']
 
 # Create Socket.IO server with proper configuration for localhost
-sio = socketio.AsyncServer(
+# (MeteredServer times every handler and counts emits, see metrics.py)
+sio = metrics.MeteredServer(
+    client_manager=BrokerClientManager(broker) if broker is not None else LocalClientManager(),
+    json=SocketIOJson,
     cors_allowed_origins=[
         "https://mumegle.vercel.app",
         "http://localhost:3000",
@@ -39,12 +178,13 @@ sio = socketio.AsyncServer(
         "http://192.168.1.7:3000"
     ],
     async_mode="asgi",
+    transports=SOCKETIO_TRANSPORTS,
     logger=False,
     engineio_logger=False
 )
 
 # Create FastAPI app
-app = FastAPI(title="Multi-Feature Chat API")
+app = FastAPI(title="Multi-Feature Chat API", default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -60,39 +200,102 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Serve uploaded files
+# Serve uploaded files, with Range and ETag support (see fileserver.py)
 # CORS configuration for localhost development
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+app.mount("/uploads", UploadFiles(UPLOAD_DIR, os.environ.get("UPLOADS_ACCEL_REDIRECT", ""),
+                                  touch=upload_collector.touch), name="uploads")
 
 # EXISTING FEATURES - Store active users, rooms, and private conversations
-active_users = {}
-room_users = {}
+# Users, rooms and stranger chat live behind `state` (see state.py): read
+# them through these names, change them only through state methods.
+active_users = state.active_users
+room_users = state.room_users
 user_join_status = {}
 private_conversations = {}
-message_reactions = {}  # messageId -> {emoji: [usernames]}
+message_reactions = ReactionIndex()  # one reaction per user and message (see reactions.py)
 
 # NEW OMEGLE FEATURES - Stranger matching system
-class StrangerChat:
-    def __init__(self):
-        # Active users waiting for stranger match
-        self.waiting_queue: List[str] = []
-        
-        # Active stranger connections (paired users)
-        self.stranger_connections: Dict[str, str] = {}  # socket_id -> partner_socket_id
-        
-        # Stranger user information
-        self.stranger_users: Dict[str, dict] = {}  # socket_id -> user_info
-        
-        # Interest-based queues
-        self.interest_queues: Dict[str, List[str]] = {}  # interest -> [socket_ids]
-        
-        # Video call states
-        self.video_calls: Dict[str, dict] = {}  # room_id -> call_info
+stranger_chat = state.stranger_chat
+
+# 'immediate' pairs a searcher with the first waiting stranger sharing an
+# interest; 'batch' pairs the whole pool every MATCH_TICK_MS by interest overlap
+MATCH_MODE = os.environ.get("MATCH_MODE", "immediate")
+MATCH_TICK_MS = int(os.environ.get("MATCH_TICK_MS", 250))
+MATCH_RANDOM_AFTER = float(os.environ.get("MATCH_RANDOM_AFTER", 5))  # seconds
+batch_matcher = BatchMatcher(random_after=MATCH_RANDOM_AFTER)
+trending_interests = TrendingInterests()
+
+# Optional protocol features a client can ask for when connecting, through
+# the Socket.IO auth payload ({"features": [...]}) or a `features=a,b` query
+# parameter. Clients that ask for nothing get the original events.
+#   ice_batch: receive ICE candidates as `webrtc_ice_candidates` batches
+SUPPORTED_FEATURES = {'ice_batch', 'typing_state', 'presence_delta', 'reaction_delta', 'message_batch',
+                      'compact'}
+ICE_BATCH_WINDOW_MS = int(os.environ.get("ICE_BATCH_WINDOW_MS", 30))
+# Typing indicators go out at most once per room per tick
+TYPING_TICK_MS = int(os.environ.get("TYPING_TICK_MS", 250))
+TYPING_TIMEOUT = float(os.environ.get("TYPING_TIMEOUT", 5))  # seconds without a typing_stop
+# Room membership changes go out as one delta per room per tick
+PRESENCE_TICK_MS = int(os.environ.get("PRESENCE_TICK_MS", 250))
+# Reactions with more users than this are sent as counts; their users are fetched on demand
+REACTION_USERS_INLINE = int(os.environ.get("REACTION_USERS_INLINE", 20))
+# Rooms getting more messages per second than this send them in batches,
+# held for at most MESSAGE_BATCH_WINDOW_MS; 0 turns batching off
+MESSAGE_BATCH_RATE = float(os.environ.get("MESSAGE_BATCH_RATE", 20))
+MESSAGE_BATCH_WINDOW_MS = int(os.environ.get("MESSAGE_BATCH_WINDOW_MS", 50))
+
+# Per-connection limits on incoming events, per class: (events per second, burst).
+# RATE_LIMITS overrides them, e.g. "message=5:10,typing=10:20"; a rate of 0 is unlimited
+RATE_LIMIT_DEFAULTS = {
+    'message': (5, 10),
+    'typing': (10, 20),
+    'reaction': (5, 10),
+    'signaling': (50, 100),
+    'session': (2, 10),
+    'teardown': (5, 20),
+    'default': (10, 20),
+}
+RATE_LIMIT_CLASSES = {
+    **dict.fromkeys(('send_message', 'send_file_message', 'send_reply', 'private_message',
+                     'send_stranger_message', 'edit_message', 'delete_message'), 'message'),
+    **dict.fromkeys(('typing_start', 'typing_stop'), 'typing'),
+    **dict.fromkeys(('add_reaction', 'remove_reaction'), 'reaction'),
+    **dict.fromkeys(('webrtc_offer', 'webrtc_answer', 'webrtc_ice_candidate',
+                     'webrtc_ice_candidates'), 'signaling'),
+    **dict.fromkeys(('join_room', 'enter_stranger_mode', 'find_stranger', 'skip_stranger',
+                     'start_video_call', 'accept_video_call',
+                     'start_private_video_call', 'accept_private_video_call'), 'session'),
+    # Own bucket: skipping through strangers must never leave a call stuck
+    **dict.fromkeys(('reject_video_call', 'end_video_call',
+                     'reject_private_video_call', 'end_private_video_call'), 'teardown'),
+}
+rate_limiter = RateLimiter(parse_limits(os.environ.get("RATE_LIMITS", ""), RATE_LIMIT_DEFAULTS),
+                           RATE_LIMIT_CLASSES)
+# Events over their limit are dropped before a handler runs (see metrics.MeteredServer)
+sio.admit = rate_limiter.allow
+
+async def event_dropped(sid, event):
+    """Tell the sender its chat messages are not sent, once per wait;
+    nothing is logged"""
+    if RATE_LIMIT_CLASSES.get(event) != 'message':
+        return
+    retry_after = rate_limiter.notice(sid, event)
+    if retry_after is not None:
+        await sio.emit('throttled', {'event': event, 'retryAfter': round(retry_after, 3)}, room=sid)
 
-stranger_chat = StrangerChat()
+sio.on_dropped = event_dropped
 
-# Create Socket.IO ASGI app
-socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
+# Packets waiting to be sent to one client: above the high-water mark its
+# state updates (member lists, typing, reactions) are collapsed; past the
+# hard limit it is disconnected (see backpressure.py)
+SLOW_CLIENT_HIGH_WATER = int(os.environ.get("SLOW_CLIENT_HIGH_WATER", 200))
+SLOW_CLIENT_HARD_LIMIT = int(os.environ.get("SLOW_CLIENT_HARD_LIMIT", 2000))
+outbound_guard = OutboundGuard(sio, high_water=SLOW_CLIENT_HIGH_WATER, hard_limit=SLOW_CLIENT_HARD_LIMIT)
+sio.manager.outbound = outbound_guard
+
+# Create Socket.IO ASGI app; the outbound guard closes websockets through it
+socket_app = WebSocketTransports(socketio.ASGIApp(sio, other_asgi_app=app))
+outbound_guard.transports = socket_app
 
 def generate_anonymous_username():
     """Generate random anonymous usernames for stranger chat"""
@@ -112,47 +315,91 @@ def create_stranger_room_id(user1_id: str, user2_id: str) -> str:
 
 # DEBUG LOGGING FUNCTION
 def log_stranger_connections(event_name, sid=None, extra_info=""):
-    print(f"\n🔍 === {event_name} ===")
-    print(f"🔍 Event: {event_name}")
-    if sid:
-        print(f"🔍 User: {sid}")
-    if extra_info:
-        print(f"🔍 Info: {extra_info}")
-    print(f"🔍 Stranger connections: {stranger_chat.stranger_connections}")
-    print(f"🔍 Stranger users: {list(stranger_chat.stranger_users.keys())}")
-    print(f"🔍 Video calls: {stranger_chat.video_calls}")
-    print(f"🔍 Waiting queue: {stranger_chat.waiting_queue}")
-    print(f"🔍 === END {event_name} ===\n")
-
-# Add catch-all event handler for debugging
-@sio.event
+    """Dump the stranger chat state; skipped unless LOG_LEVEL=debug"""
+    if not log.enabled(logs.DEBUG):
+        return
+    log.debug('stranger_state', checkpoint=event_name, sid=sid, info=extra_info,
+              connections=dict(stranger_chat.stranger_connections),
+              strangers=list(stranger_chat.stranger_users),
+              video_calls=list(stranger_chat.video_calls),
+              waiting=stranger_chat.matchmaker.waiting())
+
+# Log events that have no handler
+@sio.on('*')
 async def catch_all(event, sid, *args):
-    print(f"🔍 Received event '{event}' from {sid} with args: {args}")
+    log.debug('event_unhandled', sid=sid, name=event)
+
+def requested_features(environ, auth):
+    """Supported features a connecting client asked for"""
+    requested = []
+    if isinstance(auth, dict):
+        features = auth.get('features') or []
+        requested.extend(features.split(',') if isinstance(features, str) else features)
+    for value in parse_qs(environ.get('QUERY_STRING', '')).get('features', []):
+        requested.extend(value.split(','))
+    return sorted(SUPPORTED_FEATURES.intersection(str(name).strip() for name in requested))
+
+def has_feature(sid, feature):
+    user = active_users.get(sid)
+    return user is not None and feature in user.get('features', ())
+
+def room_channel(room, event):
+    """Socket.IO room for the members of `room` that receive `event`, where
+    a feature lets clients choose between two versions of an update"""
+    return f"{room}\0{event}"
+
+# (feature, event clients without it get instead)
+ROOM_CHANNEL_FEATURES = (
+    ('typing_state', 'user_typing'),
+    ('presence_delta', 'room_users'),
+    ('reaction_delta', 'reaction_updated'),
+    ('message_batch', 'message'),
+)
+COMPACT_CHANNEL = ':compact'
+
+async def enter_room_channels(sid, room):
+    for feature, legacy in ROOM_CHANNEL_FEATURES:
+        event = feature if has_feature(sid, feature) else legacy
+        if event in COMPACT_EVENTS and has_feature(sid, 'compact'):
+            event += COMPACT_CHANNEL
+        await sio.enter_room(sid, room_channel(room, event))
+
+async def emit_to_channels(event, payload, room, channels=None, **kwargs):
+    """Emit `event` to the members of `room` on `channels` (by default the
+    event's own), with short keys to those that asked for compact events"""
+    channels = channels or (event,)
+    await sio.emit(event, payload, room=[room_channel(room, channel) for channel in channels], **kwargs)
+    if event in COMPACT_EVENTS:
+        await sio.emit(event, compact(payload),
+                       room=[room_channel(room, channel + COMPACT_CHANNEL) for channel in channels], **kwargs)
 
 @sio.event
-async def connect(sid, environ):
-    print(f"✅ Client {sid} connected")
+async def connect(sid, environ, auth=None):
+    features = requested_features(environ, auth)
+    log.info('client_connected', sid=sid, features=features)
     log_stranger_connections("CONNECT", sid)
     
     # Initialize for regular chat
-    active_users[sid] = {
+    state.put('users', sid, {
         'username': None,
         'room': None,
-        'connected_at': datetime.now(),
+        'connected_at': datetime.now().isoformat(),
         'joined': False,
-        'mode': 'regular'  # 'regular' or 'stranger'
-    }
+        'mode': 'regular',  # 'regular' or 'stranger'
+        'features': features
+    })
     user_join_status[sid] = False
     
     # Send connection options
     await sio.emit('connection_options', {
         'modes': ['chat_rooms', 'stranger_chat'],
-        'message': 'Choose your chat mode'
+        'message': 'Choose your chat mode',
+        'features': features
     }, room=sid)
 
 @sio.event
 async def disconnect(sid):
-    print(f"❌ Client {sid} disconnected")
+    log.info('client_disconnected', sid=sid)
     log_stranger_connections("DISCONNECT_START", sid)
     
     # Clean up regular chat
@@ -163,7 +410,7 @@ async def disconnect(sid):
         
         if username and room:
             if room in room_users and sid in room_users[room]:
-                room_users[room].remove(sid)
+                state.leave_room(room, sid)
                 
                 await sio.emit('message', {
                     'type': 'system',
@@ -172,10 +419,8 @@ async def disconnect(sid):
                     'timestamp': datetime.now().isoformat(),
                     'username': 'System'
                 }, room=room)
-                
-                await update_room_users(room)
         
-        del active_users[sid]
+        state.delete('users', sid)
     
     if sid in user_join_status:
         del user_join_status[sid]
@@ -183,7 +428,7 @@ async def disconnect(sid):
     # Clean up stranger chat
     if sid in stranger_chat.stranger_connections:
         partner_id = stranger_chat.stranger_connections[sid]
-        print(f"🧹 Cleaning up stranger connection: {sid} <-> {partner_id}")
+        log.debug('stranger_cleanup', sid=sid, partner=partner_id)
         
         if partner_id in stranger_chat.stranger_users:
             await sio.emit('stranger_disconnected', {
@@ -192,28 +437,26 @@ async def disconnect(sid):
             
             # Remove partner from active connections
             if partner_id in stranger_chat.stranger_connections:
-                del stranger_chat.stranger_connections[partner_id]
-                print(f"🧹 Removed partner {partner_id} from connections")
+                state.delete('connections', partner_id)
         
         # Remove user from active connections
-        del stranger_chat.stranger_connections[sid]
-        print(f"🧹 Removed user {sid} from connections")
+        state.delete('connections', sid)
+    
+    ice_batcher.discard(sid)
+    await typing_tracker.discard(sid)
+    rate_limiter.discard(sid)
     
-    # Remove from stranger waiting queue
-    if sid in stranger_chat.waiting_queue:
-        stranger_chat.waiting_queue.remove(sid)
-        print(f"🧹 Removed {sid} from waiting queue")
+    # Drop the video call the user was in, so signaling stops reaching it
+    if sid in stranger_chat.call_rooms:
+        state.delete('calls', stranger_chat.call_rooms[sid])
     
-    # Remove from interest queues
-    for interest_queue in stranger_chat.interest_queues.values():
-        if sid in interest_queue:
-            interest_queue.remove(sid)
-            print(f"🧹 Removed {sid} from interest queue")
+    # Remove from stranger waiting and interest queues
+    if sid in stranger_chat.matchmaker:
+        state.dequeue_stranger(sid)
     
     # Remove stranger user info
     if sid in stranger_chat.stranger_users:
-        del stranger_chat.stranger_users[sid]
-        print(f"🧹 Removed {sid} from stranger users")
+        state.delete('strangers', sid)
     
     log_stranger_connections("DISCONNECT_END", sid)
 
@@ -221,35 +464,37 @@ async def disconnect(sid):
 
 @sio.event
 async def join_room(sid, data):
-    print(f"🚪 Received join_room from {sid}: {data}")
+    log.debug('join_room_received', sid=sid)
     
     if user_join_status.get(sid, False):
-        print(f"⏭️ User {sid} already joined, ignoring duplicate request")
+        log.debug('join_room_duplicate', sid=sid)
         return
     
     username = data.get('username') or data.get('user') or 'Anonymous'
     room = data.get('room') or data.get('roomId') or data.get('roomName')
     
     if not room:
-        print(f"❌ No room specified in data: {data}")
+        log.warning('join_room_invalid', sid=sid, reason='no room')
         await sio.emit('error', {'message': 'Room not specified'}, room=sid)
         return
     
     user_join_status[sid] = True
     
-    active_users[sid]['username'] = username
-    active_users[sid]['room'] = room
-    active_users[sid]['joined'] = True
-    active_users[sid]['mode'] = 'regular'
+    state.patch('users', sid, username=username, room=room, joined=True, mode='regular')
     
     await sio.enter_room(sid, room)
+    await enter_room_channels(sid, room)
+    
+    state.join_room(room, sid)
     
-    if room not in room_users:
-        room_users[room] = []
-    if sid not in room_users[room]:
-        room_users[room].append(sid)
+    if has_feature(sid, 'typing_state') and room in state.room_typing:
+        # Later snapshots only come when the set changes
+        await sio.emit('typing_state', {
+            'room': room,
+            'users': [{'userId': typer, 'username': name} for typer, name in state.room_typing[room].items()]
+        }, room=sid)
     
-    print(f"✅ User {username} successfully joined room {room}")
+    log.info('user_joined', sid=sid, room=room, username=username)
     
     await sio.emit('join_success', {
         'room': room,
@@ -264,7 +509,7 @@ async def join_room(sid, data):
         'room': room,
         'timestamp': datetime.now().isoformat(),
         'username': 'System',
-        'id': f"system_{int(datetime.now().timestamp() * 1000)}"
+        'id': f"system_{message_ids.next()}"
     }, room=sid)
     
     await sio.emit('message', {
@@ -273,13 +518,60 @@ async def join_room(sid, data):
         'room': room,
         'timestamp': datetime.now().isoformat(),
         'username': 'System',
-        'id': f"system_{int(datetime.now().timestamp() * 1000)}"
+        'id': f"system_{message_ids.next()}"
     }, room=room, skip_sid=sid)
     
-    await update_room_users(room)
+    # Everyone else hears about the join from presence_tracker
+    await sio.emit('room_users', presence_tracker.snapshot(room), room=sid)
+
+# Tasks started by handlers; referenced until done so they are not collected
+background_tasks = set()
+
+def run_in_background(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def push_preview(message):
+    """Add the preview of a message's file to it once built, and send it to
+    the room as `file_preview`"""
+    key = file_key(message)
+    if key is None or 'preview' in message['file']:
+        return
+    preview = await previews.get(key, message['file'].get('type') or '')
+    if not preview or message_history.get(message['id']) is not message:
+        return
+    message['file'] = with_preview(message['file'], preview)
+    message_history.update(message['id'])
+    storage.update_message(message)
+    state.broadcast_event('message_edited', message)
+    await sio.emit('file_preview', {
+        'messageId': message['id'],
+        'room': message['room'],
+        'file': message['file']
+    }, room=message['room'])
+
+async def send_room_message(room, message):
+    """Send a chat message to a room, in a batch while the room is busy"""
+    if await message_batcher.add(room, message):
+        # Clients without message_batch still get it on its own, right away
+        await emit_to_channels('message', message, room)
+    else:
+        await emit_to_channels('message', message, room, ('message', 'message_batch'))
+
+async def send_message_batch(room, messages):
+    await emit_to_channels('message_batch', {
+        'room': room,
+        'messages': messages
+    }, room)
+
+message_batcher = MessageBatcher(send_message_batch, threshold=MESSAGE_BATCH_RATE,
+                                 window=MESSAGE_BATCH_WINDOW_MS / 1000)
+
 @sio.event
 async def send_message(sid, data):
-    print(f"📨 Received message from {sid}: {data}")
+    log.debug('message_received', sid=sid)
     
     if sid not in active_users:
         await sio.emit('error', {'message': 'User not found'}, room=sid)
@@ -299,8 +591,8 @@ async def send_message(sid, data):
     # Determine message type
     message_type = 'file' if file_info else 'message'
     
-    # Create unique message ID
-    message_id = f"{sid}_{int(datetime.now().timestamp() * 1000)}"
+    # Create unique, time-ordered message ID (doubles as a pagination cursor)
+    message_id = message_ids.next()
     
     message_data = {
         'type': message_type,
@@ -317,21 +609,23 @@ async def send_message(sid, data):
     # Add file info if present
     if file_info:
         message_data['file'] = file_info
-        print(f"📎 File message: {file_info.get('filename', 'unknown')} ({file_info.get('file_type', 'unknown')})")
+        log.debug('file_attached', filename=file_info.get('filename', 'unknown'), file_type=file_info.get('file_type', 'unknown'))
     
-    # Store message in memory (ADD THIS SECTION)
-    messages_storage[message_id] = message_data
-    if room not in rooms_storage:
-        rooms_storage[room] = []
-    rooms_storage[room].append(message_id)
+    # Store message in the bounded room history
+    message_history.append(room, message_data)
+    search_index.add(room, message_data)
+    upload_store.reference(message_data)
+    storage.save_message(room, message_data)
+    state.broadcast_event('message_stored', room, message_data)
     
-    print(f"📤 Sending message data: {message_data}")
-    await sio.emit('message', message_data, room=room)
-    print(f"✅ Message sent to room {room}")
+    await send_room_message(room, message_data)
+    if file_info:
+        run_in_background(push_preview(message_data))
+    log.debug('message_sent', room=room, message_id=message_data['id'])
 
 @sio.event
 async def edit_message(sid, data):
-    print(f"✏️ Received edit_message from {sid}: {data}")
+    log.debug('edit_message_received', sid=sid)
     
     if sid not in active_users:
         await sio.emit('error', {'message': 'User not found'}, room=sid)
@@ -349,12 +643,11 @@ async def edit_message(sid, data):
         return
     
     # Check if message exists
-    if message_id not in messages_storage:
+    message = message_history.get(message_id)
+    if message is None:
         await sio.emit('error', {'message': 'Message not found'}, room=sid)
         return
     
-    message = messages_storage[message_id]
-    
     # Check if user owns the message
     if message['userId'] != sid:
         await sio.emit('error', {'message': 'You can only edit your own messages'}, room=sid)
@@ -366,14 +659,18 @@ async def edit_message(sid, data):
         return
     
     # Update message
-    old_content = message['content']
     message['content'] = new_content.strip()
     message['edited'] = True
     message['edited_at'] = datetime.now().isoformat()
+    message_history.update(message_id)
+    search_index.update(message)
+    storage.update_message(message)
+    state.broadcast_event('message_edited', message)
     
-    print(f"✏️ Message edited: {old_content} -> {new_content}")
+    log.debug('message_edited', message_id=message_id, room=room)
     
-    # Emit updated message to all users in the room
+    # Emit updated message to all users in the room, after the message itself
+    await message_batcher.flush(room)
     await sio.emit('message_edited', {
         'message_id': message_id,
         'new_content': new_content,
@@ -382,11 +679,9 @@ async def edit_message(sid, data):
         'username': username
     }, room=room)
     
-    print(f"✅ Message edit broadcasted to room {room}")
-
 @sio.event
 async def delete_message(sid, data):
-    print(f"🗑️ Received delete_message from {sid}: {data}")
+    log.debug('delete_message_received', sid=sid)
     
     if sid not in active_users:
         await sio.emit('error', {'message': 'User not found'}, room=sid)
@@ -403,43 +698,38 @@ async def delete_message(sid, data):
         return
     
     # Check if message exists
-    if message_id not in messages_storage:
+    message = message_history.get(message_id)
+    if message is None:
         await sio.emit('error', {'message': 'Message not found'}, room=sid)
         return
     
-    message = messages_storage[message_id]
-    
     # Check if user owns the message
     if message['userId'] != sid:
         await sio.emit('error', {'message': 'You can only delete your own messages'}, room=sid)
         return
     
-    # Delete message from storage
-    del messages_storage[message_id]
-    
-    # Remove from room storage
-    if room in rooms_storage and message_id in rooms_storage[room]:
-        rooms_storage[room].remove(message_id)
+    # Delete message from history (leaves a tombstone, compacted lazily)
+    message_history.delete(message_id)
+    state.broadcast_event('message_deleted', message_id)
     
-    print(f"🗑️ Message deleted: {message_id}")
+    log.debug('message_deleted', message_id=message_id, room=room)
     
-    # Emit deletion to all users in the room
+    # Emit deletion to all users in the room, after the message itself
+    await message_batcher.flush(room)
     await sio.emit('message_deleted', {
         'message_id': message_id,
         'room': room,
         'username': username,
         'deleted_at': datetime.now().isoformat()
     }, room=room)
-    
-    print(f"✅ Message deletion broadcasted to room {room}")
 
 
 @sio.event
 async def private_message(sid, data):
-    print(f"🔒 PRIVATE MESSAGE EVENT RECEIVED from {sid}")
+    log.debug('private_message_received', sid=sid)
     
     if sid not in active_users:
-        print(f"❌ Sender {sid} not found in active_users")
+        log.warning('private_message_unknown_sender', sid=sid)
         await sio.emit('error', {'message': 'User not found'}, room=sid)
         return
     
@@ -465,7 +755,7 @@ async def private_message(sid, data):
         'to': recipient_username,
         'toId': to_user_id,
         'timestamp': datetime.now().isoformat(),
-        'id': f"private_{sid}_{int(datetime.now().timestamp() * 1000)}",
+        'id': f"private_{message_ids.next()}",
         'username': sender_username
     }
     
@@ -473,6 +763,8 @@ async def private_message(sid, data):
     if conversation_key not in private_conversations:
         private_conversations[conversation_key] = []
     private_conversations[conversation_key].append(private_msg)
+    storage.save_private_message(conversation_key, private_msg)
+    state.broadcast_event('private_message_stored', conversation_key, private_msg)
     
     try:
         await sio.emit('private_message', private_msg, room=to_user_id)
@@ -480,24 +772,22 @@ async def private_message(sid, data):
             **private_msg,
             'fromSelf': True
         }, room=sid)
-        print(f"✅ Private message sent: {sender_username} → {recipient_username}")
+        log.debug('private_message_sent', sid=sid, to=to_user_id)
         
     except Exception as e:
-        print(f"🚨 Error sending private message: {e}")
+        log.warning('private_message_failed', sid=sid, to=to_user_id, error=str(e))
         await sio.emit('error', {'message': f'Failed to send message: {str(e)}'}, room=sid)
 # ============= PRIVATE VIDEO CHAT EVENTS =============
 
 @sio.event
 async def start_private_video_call(sid, data):
     """Initiate video call with a specific user in private chat"""
-    print(f"📞 Starting private video call from {sid}")
+    log.debug('private_call_start_received', sid=sid)
     
     target_user_id = data.get('target_user_id')
 
-    print(f"🔍 Target user ID: {target_user_id}")
-    print(f"🔍 Active users: {list(active_users.keys())}")
-    print(f"🔍 Caller in active_users: {sid in active_users}")
-    print(f"🔍 Target in active_users: {target_user_id in active_users}")
+    log.debug('private_call_target', sid=sid, target=target_user_id,
+              caller_online=sid in active_users, target_online=target_user_id in active_users)
     
     if not target_user_id:
         await sio.emit('error', {'message': 'Target user ID required'}, room=sid)
@@ -511,21 +801,15 @@ async def start_private_video_call(sid, data):
     # Create video call room ID
     room_id = f"private_call_{min(sid, target_user_id)}_{max(sid, target_user_id)}"
     
-    print(f"📞 Creating private video call session for room: {room_id}")
-    
     # Store video call session
-    stranger_chat.video_calls[room_id] = {
+    state.put('calls', room_id, {
         'initiator': sid,
         'partner': target_user_id,
         'status': 'calling',
         'type': 'private',  # Distinguish from stranger calls
         'created_at': datetime.now().isoformat()
-    }
-    # Get usernames for notification
-    caller_username = active_users[sid].get('username', 'Unknown')
-    target_username = active_users[target_user_id].get('username', 'Unknown')
+    })
     
-    print(f"📞 Notifying {target_username} ({target_user_id}) about call from {caller_username} ({sid})")
     # Notify target user about incoming video call
     await sio.emit('incoming_private_video_call', {
         'caller_id': sid,
@@ -541,17 +825,17 @@ async def start_private_video_call(sid, data):
         'initiator': sid
     }, room=sid)
     
-    print(f"✅ Private video call initiated successfully")
+    log.info('private_call_initiated', room=room_id, caller=sid, target=target_user_id)
 
 @sio.event
 async def accept_private_video_call(sid, data):
     """Accept incoming private video call"""
     room_id = data.get('room_id')
-    print(f"✅ Private video call accepted by {sid} for room {room_id}")
+    log.debug('private_call_accept_received', sid=sid, room=room_id)
     
     if room_id in stranger_chat.video_calls:
         call_info = stranger_chat.video_calls[room_id]
-        call_info['status'] = 'active'
+        state.patch('calls', room_id, status='active')
         
         # Notify both users that call is accepted
         await sio.emit('private_video_call_accepted', {
@@ -566,19 +850,19 @@ async def accept_private_video_call(sid, data):
             'partner': sid
         }, room=sid)
         
-        print(f"✅ Private video call active in room {room_id}")
+        log.info('private_call_active', room=room_id)
 
 @sio.event
 async def reject_private_video_call(sid, data):
     """Reject incoming private video call"""
     room_id = data.get('room_id')
-    print(f"❌ Private video call rejected by {sid} for room {room_id}")
+    log.info('private_call_rejected', sid=sid, room=room_id)
     
     if room_id in stranger_chat.video_calls:
         initiator_id = stranger_chat.video_calls[room_id]['initiator']
         
         # Remove call session
-        del stranger_chat.video_calls[room_id]
+        state.delete('calls', room_id)
         
         # Notify initiator
         await sio.emit('private_video_call_rejected', {
@@ -589,13 +873,13 @@ async def reject_private_video_call(sid, data):
 async def end_private_video_call(sid, data):
     """End current private video call"""
     room_id = data.get('room_id')
-    print(f"📞 Ending private video call by {sid} for room {room_id}")
+    log.info('private_call_ended', sid=sid, room=room_id)
     
     if room_id in stranger_chat.video_calls:
         call_info = stranger_chat.video_calls[room_id]
         
         # Remove call session
-        del stranger_chat.video_calls[room_id]
+        state.delete('calls', room_id)
         
         # Notify both users
         await sio.emit('private_video_call_ended', {
@@ -612,67 +896,154 @@ async def end_private_video_call(sid, data):
 
 # File upload endpoint
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(request: Request):
+    """Multipart upload of a single `file` field, streamed to disk"""
+    declared_size = int(request.headers.get('content-length') or 0)
+    log.debug('upload_received', content_length=declared_size)
+    # Reject obviously oversized bodies before reading any of them; the
+    # per-type limit is enforced once the part's type is known
+    if declared_size > max(MAX_UPLOAD_SIZE, MAX_DOCUMENT_SIZE) + UPLOAD_FORM_OVERHEAD:
+        raise HTTPException(status_code=413, detail=f"File too large. Maximum size is {MAX_DOCUMENT_SIZE // (1024 * 1024)}MB.")
+    
     try:
-        print(f"📁 Received file upload: {file.filename}, type: {file.content_type}, size: {file.size}")
-        
-        if file.size > 10 * 1024 * 1024:  # 10MB limit
-            raise HTTPException(status_code=413, detail="File too large. Maximum size is 10MB.")
-        
-        # Enhanced allowed types including voice messages
-        allowed_types = {
-            # Images
-            'image/jpeg', 'image/png', 'image/gif', 'image/webp',
-            # Documents
-            'application/pdf', 'text/plain', 
-            'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            # Audio files (including voice messages)
-            'audio/mpeg', 'audio/wav', 'audio/ogg', 'audio/mp4', 'audio/aac',
-            'audio/webm', 'audio/webm;codecs=opus'  # Voice message formats
-        }
-        
-        # Check file type
-        if file.content_type not in allowed_types:
-            print(f"❌ File type not allowed: {file.content_type}")
-            raise HTTPException(status_code=400, detail=f"File type '{file.content_type}' not allowed.")
-        
-        # Generate unique filename
-        file_extension = Path(file.filename).suffix if file.filename else '.webm'
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = UPLOAD_DIR / unique_filename
-        
-        # Read and save file
-        content = await file.read()
-        with open(file_path, "wb") as f:
-            f.write(content)
-        
-        # Determine file type for frontend
-        file_type = "voice" if file.content_type.startswith("audio/") else "file"
-        
-        file_info = {
-            "id": str(uuid.uuid4()),
-            "filename": file.filename or unique_filename,
-            "unique_filename": unique_filename,
-            "url": f"/uploads/{unique_filename}",
-            "size": len(content),
-            "type": file.content_type,
-            "file_type": file_type,  # Add this for frontend handling
-            "uploaded_at": datetime.now().isoformat()
-        }
-        
-        print(f"✅ File uploaded successfully: {unique_filename}")
+        part = await receive_file(request.headers, request.stream(), 'file', upload_store.tmp_dir,
+                                  upload_limit, ALLOWED_UPLOAD_TYPES)
+        
+        # Files are named by content: identical uploads share one file
+        file_extension = Path(part.filename).suffix if part.filename else '.webm'
+        unique_filename, deduplicated = await upload_store.store(part.writer, file_extension)
+        previews.start(unique_filename, part.content_type)
+        file_info = make_file_info(unique_filename, part.filename, part.content_type, part.writer.size)
+        
+        log.info('upload_stored', filename=unique_filename, size=part.writer.size, deduplicated=deduplicated)
+        UPLOADS.inc()
+        UPLOAD_BYTES.inc(amount=part.writer.size)
         return file_info
         
-    except HTTPException:
-        raise
+    except UploadError as e:
+        log.warning('upload_rejected', status=e.status_code, reason=e.detail)
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except ClientDisconnect:
+        log.debug('upload_aborted')
+        raise HTTPException(status_code=400, detail="Upload interrupted.")
     except Exception as e:
-        print(f"❌ Upload error: {e}")
+        log.exception('upload_failed')
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 
+def make_file_info(unique_filename: str, filename: str, content_type: str, size: int) -> dict:
+    """The `file` entry clients attach to send_file_message"""
+    # Determine file type for frontend
+    file_type = "voice" if content_type.startswith("audio/") else "file"
+    file_info = {
+        "id": str(uuid.uuid4()),
+        "filename": filename or Path(unique_filename).name,
+        "unique_filename": unique_filename,
+        "url": f"/uploads/{unique_filename}",
+        "size": size,
+        "type": content_type,
+        "file_type": file_type,  # Add this for frontend handling
+        "sha256": Path(unique_filename).stem,
+        "preview_url": f"/upload/previews/{unique_filename}",
+        "uploaded_at": datetime.now().isoformat()
+    }
+    return file_info
+
+def with_preview(file_info: dict, preview: dict) -> dict:
+    """A copy of `file_info` carrying the preview of its file"""
+    file_info = {**file_info, "preview": preview_info(preview)}
+    if preview["kind"] == "audio":
+        # Where the voice message player already looks for them
+        file_info["duration"] = preview["duration"]
+        file_info["waveform"] = preview["waveform"]
+    return file_info
+
+def preview_info(preview: dict) -> dict:
+    info = dict(preview)
+    if "thumbnail" in info:
+        info["thumbnail_url"] = f"/uploads/{info.pop('thumbnail')}"
+    return info
+
+@app.get("/upload/previews/{unique_filename:path}")
+async def upload_preview(unique_filename: str):
+    """Thumbnail or waveform of a stored upload, made on first request"""
+    if not CONTENT_KEY_RE.match(unique_filename) or not upload_store.path(unique_filename).is_file():
+        raise HTTPException(status_code=404, detail="File not found.")
+    preview = await previews.get(unique_filename)
+    if not preview:
+        raise HTTPException(status_code=404, detail="No preview for this file.")
+    return preview_info(preview)
+
+
+# Resumable uploads: create a session, PUT chunks at the offset the server
+# reports (GET the session after a dropped connection or restart), then
+# complete it to get the same file info as POST /upload
+@app.post("/upload/sessions")
+async def create_upload_session(upload: CreateUploadRequest):
+    if upload.content_type not in ALLOWED_UPLOAD_TYPES:
+        raise HTTPException(status_code=400, detail=f"File type {upload.content_type} not allowed.")
+    limit = upload_limit(upload.content_type)
+    if upload.size > limit:
+        raise HTTPException(status_code=413, detail=f"File too large. Maximum size is {limit // (1024 * 1024)}MB.")
+    if upload.size <= 0:
+        raise HTTPException(status_code=400, detail="Empty file.")
+    session = await resumable_uploads.create(upload.filename, upload.content_type, upload.size)
+    log.debug('upload_session_created', upload_id=session.id, size=upload.size)
+    return {
+        **session.to_json(),
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "expires_in": resumable_uploads.ttl
+    }
+
+async def get_upload_session(upload_id: str):
+    session = await resumable_uploads.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload session not found.")
+    return session
+
+@app.get("/upload/sessions/{upload_id}")
+async def upload_session_status(upload_id: str):
+    return (await get_upload_session(upload_id)).to_json()
+
+@app.put("/upload/sessions/{upload_id}")
+async def upload_chunk(upload_id: str, offset: int, request: Request):
+    """Append the raw request body at `offset`"""
+    session = await get_upload_session(upload_id)
+    try:
+        new_offset = await resumable_uploads.append(session, offset, request.stream())
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except ClientDisconnect:
+        # What arrived is kept; the client resumes from the current offset
+        log.debug('upload_chunk_interrupted', upload_id=upload_id, offset=session.offset)
+        raise HTTPException(status_code=400, detail="Upload interrupted.")
+    return {"upload_id": upload_id, "offset": new_offset, "size": session.size}
+
+@app.post("/upload/sessions/{upload_id}/complete")
+async def complete_upload_session(upload_id: str):
+    session = await get_upload_session(upload_id)
+    try:
+        file_extension = Path(session.filename).suffix or '.webm'
+        unique_filename, deduplicated = await resumable_uploads.complete(session, upload_store, file_extension)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    
+    log.info('upload_stored', filename=unique_filename, size=session.size, deduplicated=deduplicated, resumable=True)
+    UPLOADS.inc()
+    UPLOAD_BYTES.inc(amount=session.size)
+    previews.start(unique_filename, session.content_type)
+    return make_file_info(unique_filename, session.filename, session.content_type, session.size)
+
+@app.delete("/upload/sessions/{upload_id}")
+async def cancel_upload_session(upload_id: str):
+    session = await get_upload_session(upload_id)
+    await resumable_uploads.cancel(session)
+    return {"success": True}
+
+
 @sio.event
 async def send_file_message(sid, data):
-    print(f"📎 Received file message from {sid}: {data}")
+    log.debug('file_message_received', sid=sid)
     
     if sid not in active_users:
         await sio.emit('error', {'message': 'User not found'}, room=sid)
@@ -698,17 +1069,26 @@ async def send_file_message(sid, data):
         'username': username,
         'room': room,
         'timestamp': datetime.now().isoformat(),
-        'id': f"file_{sid}_{int(datetime.now().timestamp() * 1000)}",
+        'id': message_ids.next(),
         'userId': sid,
         'file': file_info
     }
     
-    await sio.emit('message', message_data, room=room)
-    print(f"✅ File message sent to room {room}")
+    # Kept in history like any other message, so it can be deleted and its
+    # file released
+    message_history.append(room, message_data)
+    search_index.add(room, message_data)
+    upload_store.reference(message_data)
+    storage.save_message(room, message_data)
+    state.broadcast_event('message_stored', room, message_data)
+    
+    await send_room_message(room, message_data)
+    run_in_background(push_preview(message_data))
+    log.debug('file_message_sent', room=room, message_id=message_data['id'])
 
 @sio.event
 async def send_reply(sid, data):
-    print(f"💬 REPLY EVENT RECEIVED from {sid}: {data}")
+    log.debug('reply_received', sid=sid)
     
     if sid not in active_users:
         await sio.emit('error', {'message': 'User not found'}, room=sid)
@@ -733,8 +1113,10 @@ async def send_reply(sid, data):
         'username': username,
         'room': room,
         'timestamp': datetime.now().isoformat(),
-        'id': f"reply_{sid}_{int(datetime.now().timestamp() * 1000)}",
+        'id': message_ids.next(),
         'userId': sid,
+        'edited': False,
+        'edited_at': None,
         'replyTo': {
             'messageId': reply_to_id,
             'username': reply_to_username,
@@ -742,17 +1124,24 @@ async def send_reply(sid, data):
         }
     }
     
+    # Kept like any other message, so it can be edited, deleted, searched
+    # and reacted to
+    message_history.append(room, reply_message)
+    search_index.add(room, reply_message)
+    storage.save_message(room, reply_message)
+    state.broadcast_event('message_stored', room, reply_message)
+    
     try:
-        await sio.emit('message', reply_message, room=room)
-        print(f"✅ Reply sent to room {room}")
+        await send_room_message(room, reply_message)
+        log.debug('reply_sent', room=room, message_id=reply_message['id'])
         
     except Exception as e:
-        print(f"🚨 Error sending reply: {e}")
+        log.warning('reply_failed', sid=sid, error=str(e))
         await sio.emit('error', {'message': f'Failed to send reply: {str(e)}'}, room=sid)
 
 @sio.event
 async def add_reaction(sid, data):
-    print(f"🎭 Adding reaction from {sid}: {data}")
+    log.debug('reaction_received', sid=sid)
     
     if sid not in active_users:
         return
@@ -764,39 +1153,18 @@ async def add_reaction(sid, data):
     if not message_id or not emoji or not room:
         return
     
+    # Only messages in history can have reactions; they are dropped with it
+    message = message_history.get(message_id)
+    if message is None or message.get('room') != room:
+        return
+    
     user_data = active_users[sid]
     username = user_data.get('username', 'Anonymous')
     
-    if message_id not in message_reactions:
-        message_reactions[message_id] = {}
-    
-    # Remove user's existing reaction (one reaction per user)
-    for existing_emoji, users in list(message_reactions[message_id].items()):
-        if username in users:
-            users.remove(username)
-            if not users:
-                del message_reactions[message_id][existing_emoji]
-            break
-    
-    # Add new reaction
-    if emoji not in message_reactions[message_id]:
-        message_reactions[message_id][emoji] = []
-    
-    if username not in message_reactions[message_id][emoji]:
-        message_reactions[message_id][emoji].append(username)
-        
-        reactions_list = []
-        for emoji_key, users in message_reactions[message_id].items():
-            reactions_list.append({
-                'emoji': emoji_key,
-                'users': users,
-                'count': len(users)
-            })
-        
-        await sio.emit('reaction_updated', {
-            'messageId': message_id,
-            'reactions': reactions_list
-        }, room=room)
+    # Replaces the user's existing reaction (one reaction per user)
+    changes = message_reactions.set(message_id, username, emoji)
+    if changes:
+        await reactions_changed(message_id, room, username, emoji, changes)
 
 @sio.event
 async def remove_reaction(sid, data):
@@ -813,31 +1181,28 @@ async def remove_reaction(sid, data):
     user_data = active_users[sid]
     username = user_data.get('username', 'Anonymous')
     
-    if (message_id in message_reactions and 
-        emoji in message_reactions[message_id] and 
-        username in message_reactions[message_id][emoji]):
-        
-        message_reactions[message_id][emoji].remove(username)
-        
-        if not message_reactions[message_id][emoji]:
-            del message_reactions[message_id][emoji]
-        
-        if not message_reactions[message_id]:
-            del message_reactions[message_id]
-        
-        reactions_list = []
-        if message_id in message_reactions:
-            for emoji_key, users in message_reactions[message_id].items():
-                reactions_list.append({
-                    'emoji': emoji_key,
-                    'users': users,
-                    'count': len(users)
-                })
-        
-        await sio.emit('reaction_updated', {
-            'messageId': message_id,
-            'reactions': reactions_list
-        }, room=room)
+    changes = message_reactions.remove(message_id, username, emoji)
+    if changes:
+        await reactions_changed(message_id, room, username, None, changes)
+
+async def reactions_changed(message_id, room, username, emoji, changes):
+    """Store, replicate and broadcast a user's new reaction (None: removed)"""
+    storage.save_reactions(message_id, message_reactions.lists(message_id))
+    state.broadcast_event('reaction_changed', message_id, username, emoji)
+    
+    await sio.emit('reaction_delta', {
+        'messageId': message_id,
+        'room': room,
+        'username': username,
+        'changes': [{'emoji': changed, 'delta': delta, 'count': count}
+                    for changed, delta, count in changes]
+    }, room=room_channel(room, 'reaction_delta'))
+    # Clients without reaction_delta get every user list again, as before
+    await emit_to_channels('reaction_updated', {
+        'messageId': message_id,
+        'reactions': [{'emoji': changed, 'users': users, 'count': len(users)}
+                      for changed, users in message_reactions.lists(message_id).items()]
+    }, room)
 
 @sio.event
 async def typing_start(sid, data):
@@ -845,98 +1210,114 @@ async def typing_start(sid, data):
         return
         
     user_data = active_users[sid]
-    username = user_data.get('username', 'Anonymous')
     room = user_data.get('room')
-    is_private = data.get('isPrivate', False)
     target_user_id = data.get('targetUserId')
     
-    if is_private and target_user_id:
-        await sio.emit('user_typing', {
-            'username': username,
-            'userId': sid,
-            'typing': True,
-            'isPrivate': True
-        }, room=target_user_id)
+    # Only changes are sent, by typing_tracker (see send_room_typing)
+    if data.get('isPrivate', False) and target_user_id:
+        await typing_tracker.start_private(sid, target_user_id)
     elif room:
-        await sio.emit('user_typing', {
-            'username': username,
-            'userId': sid,
-            'room': room,
-            'typing': True,
-            'isPrivate': False
-        }, room=room, skip_sid=sid)
+        typing_tracker.start(sid, room, user_data.get('username', 'Anonymous'))
 
 @sio.event
 async def typing_stop(sid, data):
     if sid not in active_users:
         return
         
-    user_data = active_users[sid]
-    username = user_data.get('username', 'Anonymous')
-    room = user_data.get('room')
-    is_private = data.get('isPrivate', False)
     target_user_id = data.get('targetUserId')
     
-    if is_private and target_user_id:
-        await sio.emit('user_typing', {
-            'username': username,
-            'userId': sid,
-            'typing': False,
-            'isPrivate': True
-        }, room=target_user_id)
-    elif room:
-        await sio.emit('user_typing', {
-            'username': username,
-            'userId': sid,
-            'room': room,
-            'typing': False,
-            'isPrivate': False
-        }, room=room, skip_sid=sid)
+    if data.get('isPrivate', False) and target_user_id:
+        await typing_tracker.stop_private(sid, target_user_id)
+    else:
+        typing_tracker.stop(sid)
 
-async def update_room_users(room):
-    if room not in room_users:
-        return
-    
-    users_in_room = []
-    for user_sid in room_users[room]:
-        if user_sid in active_users:
-            user_data = active_users[user_sid]
-            users_in_room.append({
-                'username': user_data.get('username', 'Anonymous'),
-                'id': user_sid,
-                'isOnline': True
-            })
-    
-    await sio.emit('room_users', {
+async def send_room_typing(room, typers, previous):
+    """Deliver a room's typing changes to the sockets of this process"""
+    await sio.emit('typing_state', {
         'room': room,
-        'users': users_in_room,
-        'count': len(users_in_room)
-    }, room=room)
+        'users': [{'userId': sid, 'username': username} for sid, username in typers.items()]
+    }, room=room_channel(room, 'typing_state'), ignore_queue=True)
+    # Clients without typing_state get the original per-user events
+    for sid, username in typers.items():
+        if sid not in previous:
+            await emit_to_channels('user_typing', {
+                'username': username,
+                'userId': sid,
+                'room': room,
+                'typing': True,
+                'isPrivate': False
+            }, room, skip_sid=sid, ignore_queue=True)
+    for sid, username in previous.items():
+        if sid not in typers:
+            await emit_to_channels('user_typing', {
+                'username': username,
+                'userId': sid,
+                'room': room,
+                'typing': False,
+                'isPrivate': False
+            }, room, skip_sid=sid, ignore_queue=True)
+
+async def send_private_typing(sid, target_user_id, typing):
+    user_data = active_users.get(sid) or {}
+    payload = {
+        'username': user_data.get('username', 'Anonymous'),
+        'userId': sid,
+        'typing': typing,
+        'isPrivate': True
+    }
+    await sio.emit('user_typing', compact(payload) if has_feature(target_user_id, 'compact') else payload,
+                   room=target_user_id)
+
+typing_tracker = TypingTracker(state, send_room_typing, send_private_typing,
+                               timeout=TYPING_TIMEOUT, tick=TYPING_TICK_MS / 1000)
+
+async def send_presence_delta(room, delta):
+    """Deliver a room's membership change to the sockets of this process"""
+    await sio.emit('presence_delta', delta, room=room_channel(room, 'presence_delta'), ignore_queue=True)
+    # Clients without presence_delta get the whole list, as before
+    if room in room_users:
+        await sio.emit('room_users', presence_tracker.snapshot(room),
+                       room=room_channel(room, 'room_users'), ignore_queue=True)
+
+presence_tracker = PresenceTracker(state, send_presence_delta, tick=PRESENCE_TICK_MS / 1000)
+
+@sio.event
+async def presence_sync(sid, data):
+    """A client that missed presence deltas asks for them again"""
+    room = (active_users.get(sid) or {}).get('room')
+    if not room:
+        return
+    deltas = presence_tracker.since(room, data.get('epoch'), int(data.get('version') or 0))
+    if deltas is None:
+        await sio.emit('room_users', presence_tracker.snapshot(room), room=sid)
+        return
+    for delta in deltas:
+        await sio.emit('presence_delta', delta, room=sid)
 
 # ============= NEW STRANGER CHAT FEATURES =============
 
 @sio.event
 async def enter_stranger_mode(sid, data):
     """Switch to stranger chat mode"""
-    print(f"🎭 User {sid} entering stranger mode")
+    log.info('stranger_mode_entered', sid=sid)
     log_stranger_connections("ENTER_STRANGER_MODE_START", sid)
     
     # Generate anonymous username
     username = generate_anonymous_username()
     
     # Store stranger user info
-    stranger_chat.stranger_users[sid] = {
+    state.put('strangers', sid, {
         'username': username,
         'connected_at': datetime.now().isoformat(),
         'status': 'connected',
         'interests': [],
         'partner': None,
         'in_video_call': False
-    }
+    })
     
     # Update regular user mode
     if sid in active_users:
-        active_users[sid]['mode'] = 'stranger'
+        state.patch('users', sid, mode='stranger')
     
     log_stranger_connections("ENTER_STRANGER_MODE_END", sid)
     
@@ -949,7 +1330,7 @@ async def enter_stranger_mode(sid, data):
 @sio.event
 async def find_stranger(sid, data):
     """Find a random stranger to chat with"""
-    print(f"🔍 User {sid} looking for stranger")
+    log.debug('find_stranger_received', sid=sid)
     log_stranger_connections("FIND_STRANGER_START", sid)
     
     if sid not in stranger_chat.stranger_users:
@@ -958,43 +1339,42 @@ async def find_stranger(sid, data):
     
     # If already in conversation, disconnect first
     if sid in stranger_chat.stranger_connections:
-        print(f"⚠️ User {sid} already has connection, disconnecting first")
+        log.debug('find_stranger_reconnect', sid=sid)
         await disconnect_from_stranger_chat(sid)
     
     interests = data.get('interests', []) if data else []
-    stranger_chat.stranger_users[sid]['interests'] = interests
-    stranger_chat.stranger_users[sid]['status'] = 'searching'
-    
-    # Try to find match based on interests first
-    partner_id = None
-    
+    state.patch('strangers', sid, interests=interests, status='searching')
     if interests:
-        for interest in interests:
-            if interest in stranger_chat.interest_queues and stranger_chat.interest_queues[interest]:
-                partner_id = stranger_chat.interest_queues[interest].pop(0)
-                print(f"🎯 Found interest match: {sid} <-> {partner_id} (interest: {interest})")
-                break
-    
-    # If no interest match, try general queue
-    if not partner_id and stranger_chat.waiting_queue:
-        partner_id = stranger_chat.waiting_queue.pop(0)
-        print(f"🎯 Found general match: {sid} <-> {partner_id}")
-    
-    if partner_id and partner_id in stranger_chat.stranger_users:
+        trending_interests.record(interests)
+        state.broadcast_event('interests_searched', interests)
+    
+    # Searching again replaces any earlier queue entry
+    if sid in stranger_chat.matchmaker:
+        state.dequeue_stranger(sid)
+    
+    # Try to find match based on interests first, then the general queue.
+    # The lock covers everything from picking a partner to marking both as
+    # paired; the partner is also claimed so no other worker can take it.
+    async with stranger_chat.matchmaker.lock:
+        if sid not in stranger_chat.stranger_users:
+            return
+        # In batch mode everyone waits for the next matching tick
+        partner_id = await state.take_stranger(sid, interests) if MATCH_MODE != 'batch' else None
+        matched = (partner_id is not None
+                   and partner_id in stranger_chat.stranger_users
+                   and sid in stranger_chat.stranger_users)
+        if matched:
+            pair_strangers(sid, partner_id)
+        elif sid in stranger_chat.stranger_users:
+            # No match, add to appropriate queues
+            state.enqueue_stranger(sid, interests)
+    
+    if matched:
         # Match found!
-        print(f"✅ Match confirmed: {sid} <-> {partner_id}")
+        log.info('stranger_matched', sid=sid, partner=partner_id)
         await create_stranger_chat_session(sid, partner_id)
-    else:
-        # No match, add to appropriate queue
-        if interests:
-            for interest in interests:
-                if interest not in stranger_chat.interest_queues:
-                    stranger_chat.interest_queues[interest] = []
-                stranger_chat.interest_queues[interest].append(sid)
-                print(f"📝 Added {sid} to interest queue: {interest}")
-        else:
-            stranger_chat.waiting_queue.append(sid)
-            print(f"📝 Added {sid} to general waiting queue")
+    elif sid in stranger_chat.stranger_users:
+        log.debug('stranger_waiting', sid=sid, interests=len(interests))
         
         log_stranger_connections("FIND_STRANGER_WAITING", sid)
         
@@ -1003,29 +1383,24 @@ async def find_stranger(sid, data):
             'interests': interests
         }, room=sid)
 
-async def create_stranger_chat_session(user1_id: str, user2_id: str):
-    """Create a chat session between two strangers"""
-    print(f"👥 Creating stranger chat session: {user1_id} <-> {user2_id}")
-    log_stranger_connections("CREATE_SESSION_START", user1_id, f"Partner: {user2_id}")
-    
+def pair_strangers(user1_id: str, user2_id: str):
+    """Mark two strangers as chatting with each other"""
     # Update active connections - THIS IS CRITICAL
-    stranger_chat.stranger_connections[user1_id] = user2_id
-    stranger_chat.stranger_connections[user2_id] = user1_id
-    print(f"✅ Added connections: {user1_id} -> {user2_id}, {user2_id} -> {user1_id}")
+    state.put('connections', user1_id, user2_id)
+    state.put('connections', user2_id, user1_id)
     
     # Update user status
-    stranger_chat.stranger_users[user1_id]['status'] = 'chatting'
-    stranger_chat.stranger_users[user1_id]['partner'] = user2_id
-    stranger_chat.stranger_users[user2_id]['status'] = 'chatting'
-    stranger_chat.stranger_users[user2_id]['partner'] = user1_id
-    
+    state.patch('strangers', user1_id, status='chatting', partner=user2_id)
+    state.patch('strangers', user2_id, status='chatting', partner=user1_id)
+
+async def create_stranger_chat_session(user1_id: str, user2_id: str):
+    """Create a chat session between two paired strangers"""
     log_stranger_connections("CREATE_SESSION_CONNECTIONS_SET", user1_id, f"Partner: {user2_id}")
     
     # Create room
     room_id = create_stranger_room_id(user1_id, user2_id)
     await sio.enter_room(user1_id, room_id)
     await sio.enter_room(user2_id, room_id)
-    print(f"🏠 Created room: {room_id}")
     
     # Notify both users
     await sio.emit('stranger_found', {
@@ -1043,12 +1418,20 @@ async def create_stranger_chat_session(user1_id: str, user2_id: str):
     }, room=user2_id)
     
     log_stranger_connections("CREATE_SESSION_END", user1_id, f"Session created successfully with {user2_id}")
-    print(f"✅ Stranger session created successfully: {user1_id} <-> {user2_id}")
+    log.debug('stranger_session_created', room=room_id, user1=user1_id, user2=user2_id)
+
+@sio.event
+async def get_trending_interests(sid, data):
+    """Send the most searched interests right now"""
+    limit = min(int((data or {}).get('limit', 10)), 50)
+    await sio.emit('trending_interests', {
+        'interests': trending_interests.top(limit)
+    }, room=sid)
 
 @sio.event
 async def send_stranger_message(sid, data):
     """Send message to current stranger chat partner"""
-    print(f"💬 Stranger message from {sid}")
+    log.debug('stranger_message_received', sid=sid)
     log_stranger_connections("SEND_STRANGER_MESSAGE", sid)
     
     if sid not in stranger_chat.stranger_connections:
@@ -1070,16 +1453,16 @@ async def send_stranger_message(sid, data):
         'username': username,
         'userId': sid,
         'timestamp': datetime.now().isoformat(),
-        'id': f"stranger_{sid}_{int(datetime.now().timestamp() * 1000)}"
+        'id': f"stranger_{message_ids.next()}"
     }
     
     await sio.emit('stranger_message', message_data, room=room_id)
-    print(f"✅ Stranger message sent: {sid} -> {partner_id}")
+    log.debug('stranger_message_sent', sid=sid, partner=partner_id)
 
 @sio.event
 async def skip_stranger(sid, data):
     """Skip current stranger and find new one"""
-    print(f"⏭️ User {sid} skipping stranger")
+    log.debug('skip_stranger', sid=sid)
     log_stranger_connections("SKIP_STRANGER_START", sid)
     
     await disconnect_from_stranger_chat(sid)
@@ -1091,38 +1474,30 @@ async def skip_stranger(sid, data):
 
 async def disconnect_from_stranger_chat(sid):
     """Disconnect user from current stranger chat"""
-    print(f"🔌 Disconnecting {sid} from stranger chat")
+    log.debug('stranger_disconnect', sid=sid)
     log_stranger_connections("DISCONNECT_STRANGER_START", sid)
     
     if sid in stranger_chat.stranger_connections:
         partner_id = stranger_chat.stranger_connections[sid]
-        print(f"🔌 Found partner {partner_id} for {sid}")
         
         # Notify partner
         if partner_id in stranger_chat.stranger_users:
             await sio.emit('stranger_disconnected', {
                 'message': 'Stranger has disconnected'
             }, room=partner_id)
-            print(f"📢 Notified {partner_id} about disconnection")
             
             # Remove partner from active connections
             if partner_id in stranger_chat.stranger_connections:
-                del stranger_chat.stranger_connections[partner_id]
-                print(f"🧹 Removed partner {partner_id} from connections")
+                state.delete('connections', partner_id)
             
             # Update partner status
-            stranger_chat.stranger_users[partner_id]['status'] = 'connected'
-            stranger_chat.stranger_users[partner_id]['partner'] = None
-            print(f"📝 Updated partner {partner_id} status to connected")
+            state.patch('strangers', partner_id, status='connected', partner=None)
         
         # Remove user from active connections
-        del stranger_chat.stranger_connections[sid]
-        print(f"🧹 Removed user {sid} from connections")
+        state.delete('connections', sid)
         
         # Update user status
-        stranger_chat.stranger_users[sid]['status'] = 'connected'
-        stranger_chat.stranger_users[sid]['partner'] = None
-        print(f"📝 Updated user {sid} status to connected")
+        state.patch('strangers', sid, status='connected', partner=None)
     
     log_stranger_connections("DISCONNECT_STRANGER_END", sid)
 
@@ -1131,19 +1506,19 @@ async def disconnect_from_stranger_chat(sid):
 @sio.event
 async def start_video_call(sid, data):
     """Initiate video call with current stranger chat partner"""
-    print(f"📞 Starting video call from {sid}")
+    log.debug('video_call_start_received', sid=sid)
     log_stranger_connections("START_VIDEO_CALL", sid)
     
     # Validate user is in stranger mode
     if sid not in stranger_chat.stranger_users:
-        print(f"❌ User {sid} not in stranger mode")
+        log.debug('video_call_refused', sid=sid, reason='not in stranger mode')
         await sio.emit('error', {'message': 'Please enter stranger mode first'}, room=sid)
         return
     
     # Validate user has stranger connection
     if sid not in stranger_chat.stranger_connections:
-        print(f"❌ User {sid} not in stranger connections")
-        print(f"❌ User stranger status: {stranger_chat.stranger_users[sid].get('status')}")
+        log.debug('video_call_refused', sid=sid, reason='no partner',
+                  status=stranger_chat.stranger_users[sid].get('status'))
         
         # Check if user is still searching
         if stranger_chat.stranger_users[sid].get('status') == 'searching':
@@ -1155,24 +1530,19 @@ async def start_video_call(sid, data):
     partner_id = stranger_chat.stranger_connections[sid]
     room_id = create_stranger_room_id(sid, partner_id)
     
-    print(f"📞 Creating video call session for room: {room_id}")
-    print(f"📞 Partner: {partner_id}")
-    
     # Create video call session but KEEP stranger connections
-    stranger_chat.video_calls[room_id] = {
+    state.put('calls', room_id, {
         'initiator': sid,
         'partner': partner_id,
         'status': 'calling',
         'created_at': datetime.now().isoformat()
-    }
+    })
     
     # Update user video status but KEEP stranger connection
     if sid in stranger_chat.stranger_users:
-        stranger_chat.stranger_users[sid]['in_video_call'] = True
+        state.patch('strangers', sid, in_video_call=True)
     if partner_id in stranger_chat.stranger_users:
-        stranger_chat.stranger_users[partner_id]['in_video_call'] = True
-    
-    print(f"📞 Sending video call invitation to {partner_id}")
+        state.patch('strangers', partner_id, in_video_call=True)
     
     # Notify partner about incoming video call
     await sio.emit('incoming_video_call', {
@@ -1188,24 +1558,24 @@ async def start_video_call(sid, data):
     }, room=sid)
     
     log_stranger_connections("START_VIDEO_CALL_END", sid, f"Video call initiated with {partner_id}")
-    print(f"✅ Video call initiated successfully")
+    log.info('video_call_initiated', room=room_id, caller=sid, partner=partner_id)
 
 @sio.event
 async def accept_video_call(sid, data):
     """Accept incoming video call"""
     room_id = data.get('room_id')
-    print(f"✅ Video call accepted by {sid} for room {room_id}")
+    log.debug('video_call_accept_received', sid=sid, room=room_id)
     log_stranger_connections("ACCEPT_VIDEO_CALL", sid, f"Room: {room_id}")
     
     if room_id in stranger_chat.video_calls:
         call_info = stranger_chat.video_calls[room_id]
-        call_info['status'] = 'active'
+        state.patch('calls', room_id, status='active')
         
         # Update user video status but KEEP stranger connections
         if sid in stranger_chat.stranger_users:
-            stranger_chat.stranger_users[sid]['in_video_call'] = True
+            state.patch('strangers', sid, in_video_call=True)
         if call_info['initiator'] in stranger_chat.stranger_users:
-            stranger_chat.stranger_users[call_info['initiator']]['in_video_call'] = True
+            state.patch('strangers', call_info['initiator'], in_video_call=True)
         
         # Notify both users that call is accepted
         await sio.emit('video_call_accepted', {
@@ -1220,20 +1590,20 @@ async def accept_video_call(sid, data):
             'partner': sid
         }, room=sid)
         
-        print(f"✅ Video call active in room {room_id}")
+        log.info('video_call_active', room=room_id)
         log_stranger_connections("ACCEPT_VIDEO_CALL_END", sid, f"Video call accepted, connections maintained")
 
 @sio.event
 async def reject_video_call(sid, data):
     """Reject incoming video call"""
     room_id = data.get('room_id')
-    print(f"❌ Video call rejected by {sid} for room {room_id}")
+    log.info('video_call_rejected', sid=sid, room=room_id)
     
     if room_id in stranger_chat.video_calls:
         initiator_id = stranger_chat.video_calls[room_id]['initiator']
         
         # Remove call session
-        del stranger_chat.video_calls[room_id]
+        state.delete('calls', room_id)
         
         # Notify initiator
         await sio.emit('video_call_rejected', {
@@ -1244,7 +1614,7 @@ async def reject_video_call(sid, data):
 async def end_video_call(sid, data):
     """End current video call"""
     room_id = data.get('room_id')
-    print(f"📞 Ending video call by {sid} for room {room_id}")
+    log.info('video_call_ended', sid=sid, room=room_id)
     log_stranger_connections("END_VIDEO_CALL", sid, f"Room: {room_id}")
     
     if room_id in stranger_chat.video_calls:
@@ -1252,12 +1622,12 @@ async def end_video_call(sid, data):
         
         # Update user video status but KEEP stranger connections
         if call_info['initiator'] in stranger_chat.stranger_users:
-            stranger_chat.stranger_users[call_info['initiator']]['in_video_call'] = False
+            state.patch('strangers', call_info['initiator'], in_video_call=False)
         if call_info['partner'] in stranger_chat.stranger_users:
-            stranger_chat.stranger_users[call_info['partner']]['in_video_call'] = False
+            state.patch('strangers', call_info['partner'], in_video_call=False)
         
         # Remove call session
-        del stranger_chat.video_calls[room_id]
+        state.delete('calls', room_id)
         
         # Notify both users
         await sio.emit('video_call_ended', {
@@ -1268,128 +1638,302 @@ async def end_video_call(sid, data):
             'message': 'Video call ended'
         }, room=call_info['partner'])
 
+def signaling_partner(sid):
+    """Peer to relay WebRTC signaling to: the stranger chat partner, else the
+    other side of the sid's video call (private calls have no stranger pair)"""
+    partner_id = stranger_chat.stranger_connections.get(sid)
+    if partner_id is None:
+        partner_id = stranger_chat.call_partner(sid)
+    return partner_id
+
 @sio.event
 async def webrtc_offer(sid, data):
     """Forward WebRTC offer to partner in peer-to-peer connection"""
-    print(f"📡 WebRTC offer received from {sid}")
-    log_stranger_connections("WEBRTC_OFFER", sid)
-    
-    if sid not in stranger_chat.stranger_connections:
-        print(f"❌ User {sid} not in stranger connections")
-        print(f"❌ Available connections: {list(stranger_chat.stranger_connections.keys())}")
-        
-        # Try to find the connection through video calls
-        partner_id = None
-        for room_id, call_info in stranger_chat.video_calls.items():
-            if call_info['initiator'] == sid:
-                partner_id = call_info['partner']
-                print(f"📡 Found partner through video call (as initiator): {partner_id}")
-                break
-            elif call_info['partner'] == sid:
-                partner_id = call_info['initiator']
-                print(f"📡 Found partner through video call (as partner): {partner_id}")
-                break
-        
-        if partner_id:
-            print(f"📡 Using video call partner: {partner_id}")
-        else:
-            await sio.emit('error', {'message': 'Not in a stranger chat session'}, room=sid)
-            return
-    else:
-        partner_id = stranger_chat.stranger_connections[sid]
-        print(f"📡 Using stranger connection partner: {partner_id}")
-    
-    print(f"📡 Forwarding offer from {sid} to partner {partner_id}")
+    partner_id = signaling_partner(sid)
+    if not partner_id:
+        await sio.emit('error', {'message': 'Not in a stranger chat session'}, room=sid)
+        return
     
     try:
+        # Candidates gathered before this offer must not arrive after it
+        await ice_batcher.flush(sid)
         await sio.emit('webrtc_offer', {
             'offer': data.get('offer'),
             'from': sid
         }, room=partner_id)
-        
-        print(f"✅ Offer forwarded successfully to {partner_id}")
     except Exception as e:
-        print(f"❌ Error forwarding offer: {e}")
+        log.warning('webrtc_forward_failed', kind='offer', sid=sid, error=str(e))
 
 @sio.event
 async def webrtc_answer(sid, data):
     """Forward WebRTC answer to partner in peer-to-peer connection"""
-    print(f"📡 WebRTC answer received from {sid}")
-    log_stranger_connections("WEBRTC_ANSWER", sid)
-    
-    partner_id = None
-    
-    # Try stranger connections first
-    if sid in stranger_chat.stranger_connections:
-        partner_id = stranger_chat.stranger_connections[sid]
-        print(f"📡 Found partner via stranger connections: {partner_id}")
-    else:
-        # Try to find through video calls
-        for room_id, call_info in stranger_chat.video_calls.items():
-            if call_info['initiator'] == sid:
-                partner_id = call_info['partner']
-                print(f"📡 Found partner via video call (as initiator): {partner_id}")
-                break
-            elif call_info['partner'] == sid:
-                partner_id = call_info['initiator']
-                print(f"📡 Found partner via video call (as partner): {partner_id}")
-                break
-    
+    partner_id = signaling_partner(sid)
     if not partner_id:
-        print(f"❌ No partner found for {sid}")
         return
     
-    print(f"📡 Forwarding answer from {sid} to partner {partner_id}")
-    
     try:
+        await ice_batcher.flush(sid)
         await sio.emit('webrtc_answer', {
             'answer': data.get('answer'),
             'from': sid
         }, room=partner_id)
-        
-        print(f"✅ Answer forwarded successfully to {partner_id}")
     except Exception as e:
-        print(f"❌ Error forwarding answer: {e}")
+        log.warning('webrtc_forward_failed', kind='answer', sid=sid, error=str(e))
 
 @sio.event
 async def webrtc_ice_candidate(sid, data):
     """Forward ICE candidate to partner in peer-to-peer connection"""
-    print(f"🧊 ICE candidate received from {sid}")
-    
-    partner_id = None
-    
-    # Try stranger connections first
-    if sid in stranger_chat.stranger_connections:
-        partner_id = stranger_chat.stranger_connections[sid]
-    else:
-        # Try to find through video calls
-        for room_id, call_info in stranger_chat.video_calls.items():
-            if call_info['initiator'] == sid:
-                partner_id = call_info['partner']
-                break
-            elif call_info['partner'] == sid:
-                partner_id = call_info['initiator']
-                break
-    
+    partner_id = signaling_partner(sid)
     if not partner_id:
         return
     
     try:
+        await relay_ice_candidates(sid, partner_id, [data.get('candidate')])
+    except Exception as e:
+        log.warning('webrtc_forward_failed', kind='ice_candidate', sid=sid, error=str(e))
+
+@sio.event
+async def webrtc_ice_candidates(sid, data):
+    """Forward a batch of ICE candidates (clients with the ice_batch feature)"""
+    partner_id = signaling_partner(sid)
+    candidates = data.get('candidates') if isinstance(data, dict) else None
+    if not partner_id or not isinstance(candidates, list):
+        return
+    
+    try:
+        await relay_ice_candidates(sid, partner_id, candidates)
+    except Exception as e:
+        log.warning('webrtc_forward_failed', kind='ice_candidates', sid=sid, error=str(e))
+
+async def relay_ice_candidates(sid, partner_id, candidates):
+    """Batch candidates for partners that accept batches, else send them one by one"""
+    if has_feature(partner_id, 'ice_batch'):
+        for candidate in candidates:
+            await ice_batcher.add(sid, partner_id, candidate)
+        return
+    for candidate in candidates:
         await sio.emit('webrtc_ice_candidate', {
-            'candidate': data.get('candidate'),
+            'candidate': candidate,
+            'from': sid
+        }, room=partner_id)
+
+async def send_ice_batch(sid, partner_id, candidates):
+    try:
+        await sio.emit('webrtc_ice_candidates', {
+            'candidates': candidates,
             'from': sid
         }, room=partner_id)
-        
-        print(f"✅ ICE candidate forwarded to {partner_id}")
     except Exception as e:
-        print(f"❌ Error forwarding ICE candidate: {e}")
+        log.warning('webrtc_forward_failed', kind='ice_candidates', sid=sid, error=str(e))
+
+ice_batcher = CandidateBatcher(send_ice_batch, window=ICE_BATCH_WINDOW_MS / 1000)
 
 @sio.event
 async def ping(sid, data):
     """Handle ping for debugging"""
-    print(f"🏓 Ping received from {sid}: {data}")
+    log.debug('ping', sid=sid)
     await sio.emit('pong', {'message': 'Server received ping'}, room=sid)
 
+# ============= BACKGROUND TASKS =============
+
+async def expire_history_loop():
+    """Periodically evict messages older than HISTORY_MAX_AGE"""
+    while True:
+        await asyncio.sleep(HISTORY_EXPIRE_INTERVAL)
+        evicted = message_history.expire()
+        if evicted:
+            log.info('history_expired', evicted=evicted)
+
+async def expire_upload_sessions_loop():
+    """Drop resumable uploads idle for longer than UPLOAD_SESSION_TTL"""
+    while True:
+        await asyncio.sleep(UPLOAD_SESSION_EXPIRE_INTERVAL)
+        expired = await resumable_uploads.expire()
+        if expired:
+            log.info('upload_sessions_expired', expired=expired)
+
+def restore_from_storage():
+    """Reload persisted history and keep storage in sync with evictions"""
+    # Deleted and evicted messages leave durable storage too
+    message_history.add_listener(lambda message, reason: storage.delete_message(message['id']))
+    
+    stored = storage.load()
+    for room, message, created in stored.messages:
+        message_history.append(room, message, now=created)
+        if message['id'] in message_history:
+            search_index.add(room, message)
+            upload_store.reference(message)
+    private_conversations.update(stored.private_conversations)
+    for message_id, reactions in stored.message_reactions.items():
+        if message_id in message_history:
+            message_reactions.load(message_id, reactions)
+    
+    if stored.messages or stored.private_conversations:
+        log.info('storage_restored', backend=storage.name, messages=len(stored.messages),
+                 private_conversations=len(stored.private_conversations))
+
+async def batch_match_loop():
+    """Pair the waiting pool every MATCH_TICK_MS (MATCH_MODE=batch)"""
+    tick_seconds = MATCH_TICK_MS / 1000
+    while True:
+        await asyncio.sleep(tick_seconds)
+        matchmaker = stranger_chat.matchmaker
+        if len(matchmaker) < 2:
+            continue
+        # With several workers only one of them runs each tick
+        tick = int(time.time() / tick_seconds)
+        try:
+            if not await state.claim(f"batch-match:{tick}", ttl=tick_seconds * 4):
+                continue
+        except (OSError, asyncio.TimeoutError) as e:
+            log.warning('batch_match_claim_failed', error=str(e))
+            continue
+        
+        paired = []
+        async with matchmaker.lock:
+            for user1_id, user2_id in batch_matcher.plan(matchmaker.pool()):
+                if user1_id in stranger_chat.stranger_users and user2_id in stranger_chat.stranger_users:
+                    state.dequeue_stranger(user1_id)
+                    state.dequeue_stranger(user2_id)
+                    pair_strangers(user1_id, user2_id)
+                    paired.append((user1_id, user2_id))
+        
+        for user1_id, user2_id in paired:
+            try:
+                await create_stranger_chat_session(user1_id, user2_id)
+            except Exception as e:
+                log.warning('stranger_session_failed', user1=user1_id, user2=user2_id, error=str(e))
+
+def expire_attachments(key, message_ids):
+    """Flag the messages whose file the upload quota had to evict"""
+    log.info('upload_evicted_in_use', filename=key, messages=len(message_ids))
+    for message_id in message_ids:
+        message = message_history.get(message_id)
+        if message is None or not isinstance(message.get('file'), dict):
+            continue
+        message['file'] = {**message['file'], 'expired': True}
+        message_history.update(message_id)
+        storage.update_message(message)
+        state.broadcast_event('message_edited', message)
+
+upload_store.add_eviction_listener(expire_attachments)
+
+# Other workers keep their own copy of history, search index and reactions.
+# These apply the changes they broadcast; storage is written by the origin.
+
+def apply_remote_message(room, message):
+    message_history.append(room, message)
+    search_index.add(room, message)
+    upload_store.reference(message)
+
+def apply_remote_edit(message):
+    local_message = message_history.get(message['id'])
+    if local_message is not None:
+        if file_key(local_message) is not None and file_key(message) is None:
+            # Its file was evicted; the origin already deleted it
+            upload_store.release(local_message)
+        local_message.update(message)
+        message_history.update(message['id'])
+        search_index.update(local_message)
+
+def apply_remote_private_message(conversation_key, message):
+    private_conversations.setdefault(conversation_key, []).append(message)
+
+def apply_remote_reaction(message_id, username, emoji):
+    if message_id not in message_history:
+        return
+    if emoji is not None:
+        message_reactions.set(message_id, username, emoji)
+    else:
+        previous = message_reactions.choice(message_id, username)
+        if previous is not None:
+            message_reactions.remove(message_id, username, previous)
+
+async def handle_lost_connections(sids, rooms):
+    """Clean up after users whose worker went away without a disconnect"""
+    for sid, partner_id in list(stranger_chat.stranger_connections.items()):
+        if partner_id in sids:
+            state.delete('connections', sid)
+            state.patch('strangers', sid, status='connected', partner=None)
+            await sio.emit('stranger_disconnected', {
+                'message': 'Stranger has disconnected'
+            }, room=sid)
+    # Their rooms hear about it from presence_tracker
+
+state.on_event('message_stored', apply_remote_message)
+state.on_event('message_edited', apply_remote_edit)
+state.on_event('message_deleted', message_history.delete)
+state.on_event('private_message_stored', apply_remote_private_message)
+state.on_event('reaction_changed', apply_remote_reaction)
+state.on_event('interests_searched', trending_interests.record)
+state.on_lost(handle_lost_connections)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    restore_from_storage()
+    await state.start()
+    asyncio.create_task(expire_history_loop())
+    asyncio.create_task(expire_upload_sessions_loop())
+    asyncio.create_task(upload_collector.run())
+    asyncio.create_task(typing_tracker.run())
+    asyncio.create_task(presence_tracker.run())
+    asyncio.create_task(outbound_guard.run())
+    if MATCH_MODE == 'batch':
+        asyncio.create_task(batch_match_loop())
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await state.stop()
+    # Flush queued writes before the process exits
+    await asyncio.to_thread(storage.close)
+    previews.close()
+
+# ============= METRICS =============
+
+# Rooms and interests are named by users: only the largest get their own series
+METRICS_TOP_LABELS = 50
+
+def count_video_calls():
+    counts = {'stranger': 0, 'private': 0}
+    for call in stranger_chat.video_calls.values():
+        call_type = call.get('type', 'stranger')
+        counts[call_type] = counts.get(call_type, 0) + 1
+    return counts
+
+metrics.registry.gauge('chat_active_users', 'Users connected to regular chat',
+                       lambda: len(active_users))
+metrics.registry.gauge('chat_rooms', 'Rooms with members', lambda: len(room_users))
+metrics.registry.gauge('chat_room_users', 'Members of the largest rooms',
+                       lambda: metrics.top_n({room: len(members) for room, members in room_users.items()},
+                                             METRICS_TOP_LABELS),
+                       labels=('room',))
+metrics.registry.gauge('chat_stranger_users', 'Users in stranger mode',
+                       lambda: len(stranger_chat.stranger_users))
+metrics.registry.gauge('chat_stranger_chats', 'Paired stranger conversations',
+                       lambda: len(stranger_chat.stranger_connections) // 2)
+metrics.registry.gauge('chat_waiting_strangers', 'Strangers waiting for a match',
+                       lambda: len(stranger_chat.matchmaker))
+metrics.registry.gauge('chat_match_queue_depth', 'Strangers waiting per interest queue (largest queues)',
+                       lambda: metrics.top_n(stranger_chat.matchmaker.depths(), METRICS_TOP_LABELS),
+                       labels=('queue',))
+metrics.registry.gauge('chat_video_calls', 'Video calls in progress', count_video_calls,
+                       labels=('type',))
+metrics.registry.gauge('chat_history_messages', 'Messages kept in room history',
+                       lambda: len(message_history))
+metrics.registry.gauge('chat_history_bytes', 'Estimated memory used by room history',
+                       lambda: message_history.stats()['bytes'])
+metrics.registry.gauge('chat_search_postings', 'Postings in the message search index',
+                       lambda: search_index.total_postings)
+metrics.registry.gauge('chat_upload_files', 'Stored upload files, as of the last collector pass',
+                       lambda: upload_collector.usage.get('files', 0))
+metrics.registry.gauge('chat_upload_disk_bytes', 'Bytes in stored uploads, as of the last collector pass',
+                       lambda: upload_collector.usage.get('bytes', 0))
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
 # ============= API ENDPOINTS =============
 
 @app.get("/")
@@ -1408,7 +1952,12 @@ async def root():
             "Peer-to-peer video chat with WebRTC",
             "Interest-based matching",
             "Anonymous usernames"
-        ]
+        ],
+        # What a client needs to know before connecting
+        "protocol": {
+            "features": sorted(SUPPORTED_FEATURES),
+            "compact_keys": COMPACT_KEYS
+        }
     }
 
 @app.get("/health")
@@ -1419,9 +1968,30 @@ async def health():
         "total_connections": len(active_users) + len(stranger_chat.stranger_users),
         "regular_chat_active": len(active_users),
         "stranger_chat_active": len(stranger_chat.stranger_users),
+        "cluster": state.stats(),
         "timestamp": datetime.now().isoformat()
     }
 
+@app.get("/rooms/{room}/users")
+async def get_room_users(room: str, since_version: Optional[int] = None, epoch: Optional[str] = None):
+    """Room members, or only the presence deltas after `since_version` when
+    this process still has them for that epoch"""
+    if since_version is not None:
+        deltas = presence_tracker.since(room, epoch, since_version)
+        if deltas is not None:
+            return {
+                "room": room,
+                "epoch": epoch,
+                "version": deltas[-1]["version"] if deltas else since_version,
+                "deltas": deltas
+            }
+    return presence_tracker.snapshot(room)
+
+@app.get("/stranger/trending")
+async def trending(limit: int = 10):
+    """Most searched stranger chat interests, with decayed search counts"""
+    return {"interests": trending_interests.top(max(1, min(limit, 50)))}
+
 @app.get("/debug/connections")
 async def debug_connections():
     return {
@@ -1433,7 +2003,7 @@ async def debug_connections():
             'in_video_call': v.get('in_video_call'),
             'partner': v.get('partner')
         } for k, v in stranger_chat.stranger_users.items()},
-        "waiting_queue": stranger_chat.waiting_queue,
+        "waiting_queue": stranger_chat.matchmaker.waiting(),
         "total_connections": len(stranger_chat.stranger_connections)
     }
 
@@ -1445,14 +2015,10 @@ async def debug_user(user_id: str):
         "partner": stranger_chat.stranger_connections.get(user_id),
         "in_stranger_users": user_id in stranger_chat.stranger_users,
         "user_data": stranger_chat.stranger_users.get(user_id),
-        "in_video_calls": any(
-            call['initiator'] == user_id or call['partner'] == user_id 
-            for call in stranger_chat.video_calls.values()
-        ),
+        "in_video_calls": user_id in stranger_chat.call_rooms,
         "video_call_details": [
-            call for call in stranger_chat.video_calls.values()
-            if call['initiator'] == user_id or call['partner'] == user_id
-        ]
+            stranger_chat.video_calls[stranger_chat.call_rooms[user_id]]
+        ] if user_id in stranger_chat.call_rooms else []
     }
 
 @app.get("/debug")
@@ -1463,14 +2029,33 @@ async def debug():
             "active_users": len(active_users),
             "room_users": {k: len(v) for k, v in room_users.items()},
             "private_conversations": len(private_conversations),
-            "message_reactions": len(message_reactions)
+            "message_reactions": message_reactions.stats()
+        },
+        "history": {
+            **message_history.stats(),
+            "per_room": message_history.room_stats()
         },
+        "storage": storage.stats(),
+        "cluster": state.stats(),
+        "search": search_index.stats(),
+        "message_batching": message_batcher.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "outbound": outbound_guard.stats(),
+        "uploads": upload_store.stats(),
+        "upload_sessions": resumable_uploads.stats(),
+        "previews": previews.stats(),
+        "upload_storage": upload_collector.stats(),
+        "typing": typing_tracker.stats(),
+        "presence": presence_tracker.stats(),
         "stranger_chat": {
             "total_stranger_users": len(stranger_chat.stranger_users),
-            "waiting_users": len(stranger_chat.waiting_queue),
+            "waiting_users": len(stranger_chat.matchmaker),
             "active_stranger_chats": len(stranger_chat.stranger_connections) // 2,
             "video_calls": len(stranger_chat.video_calls),
-            "interest_queues": {k: len(v) for k, v in stranger_chat.interest_queues.items()},
+            "interest_queues": stranger_chat.matchmaker.depths(),
+            "match_mode": MATCH_MODE,
+            "batch_matcher": batch_matcher.stats(),
+            "ice_batcher": ice_batcher.stats(),
             "stranger_connections": stranger_chat.stranger_connections,
             "video_call_details": stranger_chat.video_calls
         }
@@ -1483,11 +2068,13 @@ async def get_stats():
         "regular_chat": {
             "total_users": len(active_users),
             "active_rooms": len(room_users),
-            "private_conversations": len(private_conversations)
+            "private_conversations": len(private_conversations),
+            "stored_messages": len(message_history),
+            "history_bytes": message_history.stats()['bytes']
         },
         "stranger_chat": {
             "total_stranger_users": len(stranger_chat.stranger_users),
-            "waiting_users": len(stranger_chat.waiting_queue),
+            "waiting_users": len(stranger_chat.matchmaker),
             "active_chats": len(stranger_chat.stranger_connections) // 2,
             "video_calls": len(stranger_chat.video_calls)
         }
@@ -1503,22 +2090,24 @@ async def edit_message_rest(request: EditMessageRequest):
         room = request.room
         
         # Check if message exists
-        if message_id not in messages_storage:
+        message = message_history.get(message_id)
+        if message is None:
             raise HTTPException(status_code=404, detail="Message not found")
         
-        message = messages_storage[message_id]
-        
         # Check if message is a file message (files can't be edited)
         if message['type'] == 'file':
             raise HTTPException(status_code=400, detail="File messages cannot be edited")
         
         # Update message
-        old_content = message['content']
         message['content'] = new_content.strip()
         message['edited'] = True
         message['edited_at'] = datetime.now().isoformat()
+        message_history.update(message_id)
+        search_index.update(message)
+        storage.update_message(message)
+        state.broadcast_event('message_edited', message)
         
-        print(f"✏️ Message edited via REST: {old_content} -> {new_content}")
+        log.debug('message_edited', message_id=message_id, room=room, via='rest')
         
         return {
             "success": True,
@@ -1541,17 +2130,14 @@ async def delete_message_rest(request: DeleteMessageRequest):
         room = request.room
         
         # Check if message exists
-        if message_id not in messages_storage:
+        if message_id not in message_history:
             raise HTTPException(status_code=404, detail="Message not found")
         
-        # Delete message from storage
-        del messages_storage[message_id]
-        
-        # Remove from room storage
-        if room in rooms_storage and message_id in rooms_storage[room]:
-            rooms_storage[room].remove(message_id)
+        # Delete message from history
+        message_history.delete(message_id)
+        state.broadcast_event('message_deleted', message_id)
         
-        print(f"🗑️ Message deleted via REST: {message_id}")
+        log.debug('message_deleted', message_id=message_id, room=room, via='rest')
         
         return {
             "success": True,
@@ -1565,23 +2151,78 @@ async def delete_message_rest(request: DeleteMessageRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete message: {str(e)}")
 
-@app.get("/messages/{room_id}")
-async def get_messages(room_id: str, limit: int = 50):
-    """Get recent messages for a room"""
+@app.get("/messages/{message_id}/reactions")
+async def get_reactions(message_id: str, emoji: Optional[str] = None, offset: int = 0, limit: int = 100):
+    """Reactions to a message.
+    
+    Without `emoji`, every reaction with its count, and its users when
+    there are at most REACTION_USERS_INLINE of them. With `emoji`, a page
+    of the users who reacted with it.
+    """
+    if emoji is None:
+        return {
+            "messageId": message_id,
+            "reactions": message_reactions.summary(message_id, REACTION_USERS_INLINE)
+        }
+    offset = max(0, offset)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    users, count = message_reactions.users(message_id, emoji, offset, limit)
+    return {
+        "messageId": message_id,
+        "emoji": emoji,
+        "users": users,
+        "count": count,
+        "has_more": offset + len(users) < count
+    }
+
+@app.get("/messages/{room_id}/search")
+async def search_messages(room_id: str, q: str, limit: int = 20, before: Optional[int] = None):
+    """Full-text search over a room's history, newest matches first.
+    
+    Every word of `q` matches as a prefix. Pass `next_before` from the
+    previous response as `before` to get the next page. `truncated` means a
+    word was too short to search for every word it starts; matches may be
+    missing, and a longer prefix narrows the search.
+    """
     try:
-        if room_id not in rooms_storage:
-            return {"messages": []}
-        
-        # Get message IDs for the room
-        message_ids = rooms_storage[room_id][-limit:]  # Get last N messages
-        
-        # Get actual messages
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        message_ids, next_before, truncated = search_index.search(room_id, q, limit, before=before)
         messages = []
-        for msg_id in message_ids:
-            if msg_id in messages_storage:
-                messages.append(messages_storage[msg_id])
-        
-        return {"messages": messages}
+        for message_id in message_ids:
+            message = message_history.get(message_id)
+            if message is not None:
+                messages.append(message)
+        
+        return FastJSONResponse({
+            "messages": messages,
+            "has_more": next_before is not None,
+            "next_before": next_before,
+            "truncated": truncated
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to search messages: {str(e)}")
+
+@app.get("/messages/{room_id}")
+async def get_messages(room_id: str, limit: int = 50,
+                       before: Optional[str] = None, after: Optional[str] = None):
+    """Get a page of messages for a room.
+    
+    Without cursors the newest messages are returned. Pass the id of the
+    oldest message you have as `before` to scroll back, or the newest as
+    `after` to catch up. `has_more` tells whether another page exists in
+    that direction.
+    """
+    try:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        messages, has_more = message_history.page(room_id, limit, before=before, after=after)
+        
+        # Plain JSON data already: skip FastAPI's jsonable_encoder pass
+        return FastJSONResponse({
+            "messages": messages,
+            "has_more": has_more,
+            "oldest_id": messages[0]['id'] if messages else None,
+            "newest_id": messages[-1]['id'] if messages else None
+        })
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get messages: {str(e)}")
     
@@ -1619,5 +2260,11 @@ if __name__ == "__main__":
     
     print("📋 Features: Regular Rooms + Stranger Chat + Peer-to-Peer Video Calls")
     
+    if WORKERS > 1 and not CLUSTER_BROKER:
+        # Workers are spawned as fresh processes and pick this up on import
+        start_broker_thread(LOCAL_BROKER_ADDRESS, BROKER_SECRET)
+        os.environ["CLUSTER_BROKER"] = LOCAL_BROKER_ADDRESS
+        print(f"📡 Local message broker for {WORKERS} workers: {LOCAL_BROKER_ADDRESS}")
+    
     # Start the server
-    uvicorn.run("main:socket_app", host=HOST, port=PORT, log_level="info")
+    uvicorn.run("main:socket_app", host=HOST, port=PORT, log_level="info", workers=WORKERS)
@@ -0,0 +1,258 @@
+"""Queues of strangers waiting for a match.
+
+Every waiting socket has exactly one queue entry, shared by the general
+queue or by each of its interest queues. Cancelling or matching a socket
+only marks that entry dead and drops it from the membership index, which
+takes it out of all its queues at once; dead entries are skipped when they
+reach the head of a queue and swept out once they outnumber live ones.
+
+Matching happens either immediately, when a searcher arrives (first waiting
+socket sharing an interest wins), or in batches: BatchMatcher looks at the
+whole pool on every tick and pairs sockets by interest overlap. Both modes
+feed TrendingInterests, a decayed count of the interests people search for.
+"""
+import asyncio
+import heapq
+import math
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+# Queue key for searchers without interests
+GENERAL = ''
+
+
+class QueueEntry:
+    __slots__ = ('sid', 'interests', 'token', 'active', 'queued_at')
+
+    def __init__(self, sid: str, interests: Tuple[str, ...], token: str):
+        self.sid = sid
+        self.interests = interests
+        self.token = token
+        self.active = True
+        self.queued_at = time.monotonic()
+
+    def queues(self) -> Tuple[str, ...]:
+        return self.interests or (GENERAL,)
+
+
+class Matchmaker:
+    """FIFO stranger queues with O(1) cancel"""
+
+    COMPACT_MIN_STALE = 64
+
+    def __init__(self):
+        self._queues: Dict[str, Deque[QueueEntry]] = {}  # interest (or GENERAL) -> entries
+        self._live: Dict[str, int] = {}  # queue key -> live entries
+        self._entries: Dict[str, QueueEntry] = {}  # sid -> its entry
+        self._stale = 0
+        # Held from picking a partner until both are marked as paired, so a
+        # waiting socket can never be handed to two searchers
+        self.lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, sid: str) -> bool:
+        return sid in self._entries
+
+    def token(self, sid: str) -> Optional[str]:
+        entry = self._entries.get(sid)
+        return entry.token if entry is not None else None
+
+    def interests(self, sid: str) -> List[str]:
+        entry = self._entries.get(sid)
+        return list(entry.interests) if entry is not None else []
+
+    def add(self, sid: str, interests: List[str], token: str):
+        self.remove(sid)
+        entry = QueueEntry(sid, tuple(dict.fromkeys(interests)), token)
+        self._entries[sid] = entry
+        for key in entry.queues():
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+            queue.append(entry)
+            self._live[key] = self._live.get(key, 0) + 1
+
+    def remove(self, sid: str) -> bool:
+        """Take a socket out of every queue it is waiting in"""
+        entry = self._entries.pop(sid, None)
+        if entry is None:
+            return False
+        entry.active = False
+        for key in entry.queues():
+            self._live[key] -= 1
+            if not self._live[key]:
+                # Nobody left waiting here: drop the queue and its dead entries
+                del self._live[key]
+                self._stale -= len(self._queues.pop(key)) - 1
+            else:
+                self._stale += 1
+        if self._stale > self.COMPACT_MIN_STALE and self._stale > len(self._entries):
+            self._compact()
+        return True
+
+    def candidates(self, interests: List[str]) -> Iterator[str]:
+        """Waiting sockets in match order: each interest queue, then the
+        general queue, oldest first"""
+        keys = list(dict.fromkeys(interests))
+        keys.append(GENERAL)
+        for key in keys:
+            queue = self._queues.get(key)
+            if not queue:
+                continue
+            while queue and not queue[0].active:
+                queue.popleft()
+                self._stale -= 1
+            # Index instead of iterating: the queue may grow while the
+            # caller is suspended between candidates
+            index = 0
+            while index < len(queue):
+                entry = queue[index]
+                if entry.active:
+                    yield entry.sid
+                index += 1
+
+    def waiting(self) -> List[str]:
+        return list(self._entries)
+
+    def pool(self) -> List[QueueEntry]:
+        """Live entries, longest waiting first"""
+        return list(self._entries.values())
+
+    def depths(self) -> Dict[str, int]:
+        """Live entries per queue; the general queue is reported as 'general'"""
+        return {key or 'general': count for key, count in self._live.items()}
+
+    def _compact(self):
+        for key, queue in self._queues.items():
+            self._queues[key] = deque(entry for entry in queue if entry.active)
+        self._stale = 0
+
+
+class BatchMatcher:
+    """Pairs the whole waiting pool at once, by maximum interest overlap.
+
+    Searchers are visited longest-waiting first and paired with the
+    unmatched searcher sharing the most interests (ties go to whoever has
+    waited longer). Searchers without interests, and those who have waited
+    more than `random_after` seconds without an overlap, are paired at
+    random.
+    """
+
+    # Candidates looked at per interest before settling for the best so far
+    SCAN_LIMIT = 16
+
+    def __init__(self, random_after: float = 5.0, rng: Optional[random.Random] = None):
+        self.random_after = random_after
+        self.rng = rng or random.Random()
+        self.ticks = 0
+        self.matched = 0
+        self.last_pool = 0
+        self.last_tick_ms = 0.0
+
+    def plan(self, pool: List[QueueEntry], now: Optional[float] = None) -> List[Tuple[str, str]]:
+        now = time.monotonic() if now is None else now
+        started = time.perf_counter()
+        unmatched: Dict[str, QueueEntry] = {entry.sid: entry for entry in pool}
+        by_interest: Dict[str, List[QueueEntry]] = {}
+        for entry in pool:
+            for interest in entry.interests:
+                by_interest.setdefault(interest, []).append(entry)
+        # Per interest, everything before this index is already matched
+        heads: Dict[str, int] = dict.fromkeys(by_interest, 0)
+
+        pairs: List[Tuple[str, str]] = []
+        for entry in pool:
+            if entry.sid not in unmatched or not entry.interests:
+                continue
+            mine = set(entry.interests)
+            best, best_overlap = None, 0
+            for interest in entry.interests:
+                candidates = by_interest[interest]
+                index = heads[interest]
+                while index < len(candidates) and candidates[index].sid not in unmatched:
+                    index += 1
+                heads[interest] = index
+                scanned = 0
+                while index < len(candidates) and scanned < self.SCAN_LIMIT:
+                    other = candidates[index]
+                    index += 1
+                    if other is entry or other.sid not in unmatched:
+                        continue
+                    scanned += 1
+                    overlap = len(mine.intersection(other.interests))
+                    if overlap > best_overlap:
+                        best, best_overlap = other, overlap
+                if best_overlap == len(mine):
+                    break
+            if best is not None:
+                del unmatched[entry.sid]
+                del unmatched[best.sid]
+                pairs.append((entry.sid, best.sid))
+
+        eligible = [entry for entry in unmatched.values()
+                    if not entry.interests or now - entry.queued_at >= self.random_after]
+        if len(eligible) % 2:
+            # Leave out whoever arrived last; they get the next tick
+            eligible.pop()
+        self.rng.shuffle(eligible)
+        pairs.extend((eligible[i].sid, eligible[i + 1].sid) for i in range(0, len(eligible), 2))
+
+        self.ticks += 1
+        self.matched += 2 * len(pairs)
+        self.last_pool = len(pool)
+        self.last_tick_ms = (time.perf_counter() - started) * 1000
+        return pairs
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'ticks': self.ticks,
+            'matched': self.matched,
+            'last_pool': self.last_pool,
+            'last_tick_ms': round(self.last_tick_ms, 3),
+            'random_after': self.random_after,
+        }
+
+
+class TrendingInterests:
+    """Exponentially decayed search counts per interest.
+
+    Uses forward decay: a search at time t adds 2 ** ((t - t0) / half_life),
+    so old scores never need updating; dividing by the same factor for
+    "now" gives the decayed count.
+    """
+
+    def __init__(self, half_life: float = 600.0, max_tracked: int = 10000):
+        self.half_life = half_life
+        self.max_tracked = max_tracked
+        self._scores: Dict[str, float] = {}
+        self._origin = time.time()
+
+    def record(self, interests: List[str], now: Optional[float] = None):
+        now = time.time() if now is None else now
+        weight = self._weight(now)
+        if weight > 1e100:
+            self._rebase(now)
+            weight = 1.0
+        for interest in dict.fromkeys(interests):
+            self._scores[interest] = self._scores.get(interest, 0.0) + weight
+        if len(self._scores) > self.max_tracked:
+            # Forget the long tail
+            keep = heapq.nlargest(self.max_tracked // 2, self._scores.items(), key=lambda item: item[1])
+            self._scores = dict(keep)
+
+    def top(self, k: int, now: Optional[float] = None) -> List[Dict[str, float]]:
+        weight = self._weight(time.time() if now is None else now)
+        best = heapq.nlargest(k, self._scores.items(), key=lambda item: item[1])
+        return [{'interest': interest, 'score': round(score / weight, 3)} for interest, score in best]
+
+    def _weight(self, now: float) -> float:
+        return math.pow(2.0, (now - self._origin) / self.half_life)
+
+    def _rebase(self, now: float):
+        weight = self._weight(now)
+        self._scores = {interest: score / weight for interest, score in self._scores.items()}
+        self._origin = now
@@ -0,0 +1,242 @@
+"""Prometheus metrics, rendered in the text exposition format.
+
+Counters and histograms are updated in place by the code they measure;
+gauges over server state are registered as callbacks and evaluated only
+when /metrics is scraped. Every worker process keeps its own registry, so
+with WORKERS > 1 each scrape describes the worker that answered it.
+
+MeteredServer is a drop-in socketio.AsyncServer that times every event
+handler and counts emits; MeteredPacket adds up the encoded size of the
+event packets it builds. MeteredServer also drops the events its `admit`
+check refuses (rate limits, see ratelimit.py) before they reach a handler.
+"""
+import functools
+import math
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import socketio
+from socketio import packet
+
+# Seconds; tuned for handlers that normally finish well under a millisecond
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: Labels, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}'
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [per-bucket counts (non-cumulative, last is +Inf), sum]
+        self._values: Dict[Labels, List] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, *labels: str) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry is not None else 0
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.labels, labels)} {cumulative}'
+
+
+class Gauge:
+    """Gauge read from a callback at scrape time.
+
+    The callback returns a number, or a dict of label values -> number.
+    """
+
+    def __init__(self, name: str, help: str, read: Callable[[], Any],
+                 labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.read = read
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        value = self.read()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, sample in value.items():
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            yield f'{self.name}{_format_labels(self.labels, labels)} {_format_value(sample)}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, read: Callable[[], Any],
+              labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._add(Gauge(name, help, read, labels))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+def top_n(values: Dict[str, int], n: int) -> Dict[str, int]:
+    """The n largest entries, to keep user-named labels (rooms, interests)
+    from growing without bound"""
+    if len(values) <= n:
+        return values
+    return dict(sorted(values.items(), key=lambda item: item[1], reverse=True)[:n])
+
+
+registry = Registry()
+
+HANDLER_CALLS = registry.counter(
+    'socketio_handler_calls_total', 'Socket.IO events handled', ('event',))
+HANDLER_ERRORS = registry.counter(
+    'socketio_handler_errors_total', 'Socket.IO handlers that raised', ('event',))
+HANDLER_LATENCY = registry.histogram(
+    'socketio_handler_seconds', 'Socket.IO handler run time', ('event',))
+EMITS = registry.counter(
+    'socketio_emits_total', 'Calls to emit, per event name', ('event',))
+EMIT_BYTES = registry.counter(
+    'socketio_emit_bytes_total', 'Encoded size of emitted event packets', ('event',))
+
+
+class MeteredPacket(packet.Packet):
+    """Socket.IO packet that counts what it encodes, per event name"""
+
+    def encode(self):
+        encoded = super().encode()
+        if self.packet_type in (packet.EVENT, packet.BINARY_EVENT) and self.data:
+            event = self.data[0]
+            size = len(encoded) if isinstance(encoded, (str, bytes)) else sum(len(part) for part in encoded)
+            EMIT_BYTES.inc(event, amount=size)
+        return encoded
+
+
+class MeteredServer(socketio.AsyncServer):
+    """AsyncServer that times event handlers and counts emits"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('serializer', MeteredPacket)
+        super().__init__(*args, **kwargs)
+        # Called with (sid, event) before each handler; False drops the event
+        self.admit: Optional[Callable[[str, str], bool]] = None
+        # Awaited with (sid, event) for every event admit dropped
+        self.on_dropped: Optional[Callable[[str, str], Awaitable[None]]] = None
+
+    def on(self, event, handler=None, namespace=None):
+        def set_handler(handler):
+            timed = _timed(event, handler)
+            if event not in ('connect', 'disconnect'):
+                timed = self._admitted(event, timed)
+            super(MeteredServer, self).on(event, timed, namespace)
+            # The module keeps the plain function, so handlers calling each
+            # other are only measured once
+            return handler
+
+        if handler is None:
+            return set_handler
+        set_handler(handler)
+
+    async def emit(self, event, *args, **kwargs):
+        EMITS.inc(event)
+        return await super().emit(event, *args, **kwargs)
+
+    def _admitted(self, event: str, handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        async def admitted(*args):
+            if self.admit is not None:
+                # A catch-all ('*') handler gets the event name first
+                sid, name = (args[1], args[0]) if event == '*' else (args[0], event)
+                if not self.admit(sid, name):
+                    if self.on_dropped is not None:
+                        await self.on_dropped(sid, name)
+                    return None
+            return await handler(*args)
+
+        return admitted
+
+
+def _timed(event: str, handler: Callable) -> Callable:
+    @functools.wraps(handler)
+    async def timed(*args):
+        started = time.perf_counter()
+        try:
+            return await handler(*args)
+        except Exception:
+            HANDLER_ERRORS.inc(event)
+            raise
+        finally:
+            HANDLER_CALLS.inc(event)
+            HANDLER_LATENCY.observe(time.perf_counter() - started, event)
+
+    return timed
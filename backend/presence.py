@@ -0,0 +1,136 @@
+"""Versioned room presence.
+
+Sending every member the full member list on every join and leave costs
+O(N^2) bytes per unit of churn. PresenceTracker instead follows membership
+changes in shared state and, once per tick, turns each room's changes into
+a numbered delta ({joined, left}); a join and leave within the same tick
+cancel out. Clients apply deltas in order and ask for the deltas they
+missed (or a full snapshot, if those are no longer kept) when they see a
+gap in the version numbers. Applying a delta is idempotent (joined adds or
+updates a member, left removes one), so a snapshot taken between ticks may
+already contain what the next delta announces.
+
+Versions are counted by each server process over its own copy of the
+state, so they are only meaningful together with the room's `epoch`, which
+changes whenever a process starts tracking a room afresh.
+"""
+import asyncio
+import uuid
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from logs import get_logger
+
+log = get_logger('presence')
+
+# Called with (room, delta) for every new delta
+SendDelta = Callable[[str, Dict[str, Any]], Awaitable[None]]
+
+
+class RoomPresence:
+    __slots__ = ('epoch', 'version', 'deltas', 'joined', 'left')
+
+    def __init__(self, history: int):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.deltas: Deque[Dict[str, Any]] = deque(maxlen=history)
+        # Changes since the last delta
+        self.joined: Dict[str, None] = {}
+        self.left: Dict[str, None] = {}
+
+
+class PresenceTracker:
+    """Room membership as numbered deltas, for rooms in `state.room_users`"""
+
+    def __init__(self, state, send: SendDelta, tick: float = 0.25, history: int = 256):
+        self.state = state
+        self.send = send
+        self.tick = tick
+        self.history = history
+        self._rooms: Dict[str, RoomPresence] = {}
+        self._changed: Dict[str, None] = {}  # rooms with changes not yet sent
+        self.deltas_sent = 0
+        self.snapshots = 0
+        state.on_room_change(self.record)
+
+    def record(self, room: str, sid: str, joined: bool):
+        presence = self._rooms.get(room)
+        if presence is None:
+            presence = self._rooms[room] = RoomPresence(self.history)
+        if joined:
+            if sid in presence.left:
+                del presence.left[sid]
+            else:
+                presence.joined[sid] = None
+        elif sid in presence.joined:
+            # Never announced
+            del presence.joined[sid]
+        else:
+            presence.left[sid] = None
+        self._changed[room] = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('presence_flush_failed')
+
+    async def flush(self):
+        changed, self._changed = self._changed, {}
+        for room in changed:
+            presence = self._rooms.get(room)
+            if presence is None:
+                continue
+            if presence.joined or presence.left:
+                presence.version += 1
+                delta = {
+                    'room': room,
+                    'epoch': presence.epoch,
+                    'version': presence.version,
+                    'joined': [self._member(sid) for sid in presence.joined],
+                    'left': list(presence.left),
+                }
+                presence.joined, presence.left = {}, {}
+                presence.deltas.append(delta)
+                self.deltas_sent += 1
+                await self.send(room, delta)
+            if room not in self.state.room_users:
+                # Empty: a room by this name starts over with a new epoch
+                del self._rooms[room]
+
+    def snapshot(self, room: str) -> Dict[str, Any]:
+        """Every member, at the current version"""
+        self.snapshots += 1
+        presence = self._rooms.get(room)
+        users = [self._member(sid) for sid in self.state.room_users.get(room, ())]
+        return {
+            'room': room,
+            'epoch': presence.epoch if presence is not None else None,
+            'version': presence.version if presence is not None else 0,
+            'users': users,
+            'count': len(users),
+        }
+
+    def since(self, room: str, epoch: Optional[str], version: int) -> Optional[List[Dict[str, Any]]]:
+        """Deltas after `version`, or None if a snapshot is needed instead"""
+        presence = self._rooms.get(room)
+        if presence is None or epoch != presence.epoch or version > presence.version:
+            return None
+        missing = presence.version - version
+        if missing > len(presence.deltas):
+            return None
+        return list(presence.deltas)[len(presence.deltas) - missing:] if missing else []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'tick_ms': self.tick * 1000,
+            'rooms': len(self._rooms),
+            'deltas_sent': self.deltas_sent,
+            'snapshots': self.snapshots,
+        }
+
+    def _member(self, sid: str) -> Dict[str, Any]:
+        user = self.state.active_users.get(sid) or {}
+        return {'id': sid, 'username': user.get('username') or 'Anonymous', 'isOnline': True}
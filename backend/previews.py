@@ -0,0 +1,273 @@
+"""Media previews, made off the event loop.
+
+Once an upload is stored, PreviewCache has a process pool decode it:
+images get a downscaled thumbnail, audio gets its duration and a short
+array of waveform peaks. Decoding is CPU-bound, so it runs in worker
+processes rather than on the event loop or its threads. Results are cached
+on disk by content (uploads/previews/ab/cd/<sha256>.json, next to the
+thumbnail), so a re-upload of the same file, or a restart, costs nothing.
+
+Thumbnails need Pillow (`pip install Pillow`); audio other than PCM WAV
+needs an ffmpeg binary on PATH. Without them those previews are skipped.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import wave
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from logs import get_logger
+from uploads import FILE_OPS, IO_POOL
+
+log = get_logger('previews')
+
+THUMBNAIL_SIZE = 320  # longest side, pixels
+WAVEFORM_BARS = 40
+AUDIO_SAMPLE_RATE = 8000  # decoded rate; plenty for peaks and duration
+DECODE_TIMEOUT = 60  # seconds ffmpeg may take
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+AUDIO_EXTENSIONS = {'.mp3', '.wav', '.ogg', '.oga', '.opus', '.m4a', '.aac', '.webm'}
+
+
+class ToolMissing(Exception):
+    """The library or binary a preview needs is not installed"""
+
+
+def preview_kind(key: str, content_type: str = '') -> Optional[str]:
+    if content_type.startswith('image/'):
+        return 'image'
+    if content_type.startswith('audio/'):
+        return 'audio'
+    if content_type:
+        return None
+    extension = Path(key).suffix.lower()
+    if extension in IMAGE_EXTENSIONS:
+        return 'image'
+    if extension in AUDIO_EXTENSIONS:
+        return 'audio'
+    return None
+
+
+# ----- worker processes -----
+
+def build_preview(source: str, kind: str, base: str, thumbnail_key: str) -> Optional[Dict[str, Any]]:
+    """Decode `source` and write its preview next to `base` (the cache path
+    without extension). None if a needed tool is missing; that result is
+    not cached, so installing it later helps."""
+    try:
+        if kind == 'image':
+            preview = _image_preview(source, base, thumbnail_key)
+        else:
+            preview = _audio_preview(source)
+    except ToolMissing:
+        return None
+    except FileNotFoundError:
+        # Deleted while waiting for a worker
+        return None
+    except Exception:
+        # Undecodable: remember that, rather than trying again on every request
+        preview = {}
+    preview['kind'] = kind
+    _write_atomic(base + '.json', json.dumps(preview).encode())
+    return preview
+
+
+def _image_preview(source: str, base: str, thumbnail_key: str) -> Dict[str, Any]:
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise ToolMissing('Pillow')
+    with Image.open(source) as image:
+        width, height = image.size
+        if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):  # rotated by 90 degrees
+            width, height = height, width
+        # JPEGs are decoded straight at a reduced scale
+        image.draft('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        thumbnail = ImageOps.exif_transpose(image)
+        thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        if thumbnail.mode in ('RGBA', 'LA') or 'transparency' in thumbnail.info:
+            thumbnail, extension, options = thumbnail.convert('RGBA'), '.png', {'optimize': True}
+        else:
+            thumbnail, extension, options = thumbnail.convert('RGB'), '.jpg', {'quality': 80}
+        tmp = base + '.tmp' + extension
+        thumbnail.save(tmp, **options)
+        os.replace(tmp, base + extension)
+        return {
+            'width': width,
+            'height': height,
+            'thumbnail': thumbnail_key + extension,
+            'thumbnail_width': thumbnail.width,
+            'thumbnail_height': thumbnail.height,
+        }
+
+
+def _audio_preview(source: str) -> Dict[str, Any]:
+    samples, rate = _decode_wav(source) or _decode_ffmpeg(source)
+    return {
+        'duration': round(len(samples) / rate, 2),
+        'waveform': waveform_peaks(samples, WAVEFORM_BARS),
+    }
+
+
+def _decode_wav(source: str):
+    """Mono 16-bit samples of a PCM WAV file, or None for anything else"""
+    try:
+        with wave.open(source, 'rb') as audio:
+            if audio.getsampwidth() != 2:
+                return None
+            channels, rate = audio.getnchannels(), audio.getframerate()
+            samples = array('h', audio.readframes(audio.getnframes()))
+    except (wave.Error, EOFError):
+        return None
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples[::channels], rate
+
+
+def _decode_ffmpeg(source: str):
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-v', 'error', '-i', source, '-f', 's16le', '-ac', '1',
+             '-ar', str(AUDIO_SAMPLE_RATE), '-'],
+            capture_output=True, timeout=DECODE_TIMEOUT, check=True)
+    except FileNotFoundError:
+        raise ToolMissing('ffmpeg')
+    data = result.stdout
+    samples = array('h', data[:len(data) - len(data) % 2])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples, AUDIO_SAMPLE_RATE
+
+
+def waveform_peaks(samples: array, bars: int) -> List[float]:
+    """Peak level of each of `bars` equal slices, scaled so the loudest is 1"""
+    if not samples:
+        return []
+    step = max(1, -(-len(samples) // bars))
+    peaks = [max(max(chunk), -min(chunk)) for chunk in
+             (samples[i:i + step] for i in range(0, len(samples), step))]
+    loudest = max(peaks) or 1
+    return [round(peak / loudest, 2) for peak in peaks]
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+# ----- event loop side -----
+
+class PreviewCache:
+    """Previews of stored uploads, built once per content in worker processes"""
+
+    def __init__(self, uploads_root: Path, workers: int = 2):
+        self.uploads_root = uploads_root
+        self.root = uploads_root / 'previews'
+        self.workers = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pending: Dict[str, asyncio.Future] = {}  # key -> preview being built
+        self.built = 0
+        self.cache_hits = 0
+        self.unavailable = 0
+
+    def get(self, key: str, content_type: str = '') -> asyncio.Future:
+        """The preview of the stored upload `key`, or None if it has none.
+
+        Building continues in the background when the caller stops waiting.
+        """
+        return asyncio.shield(self._build(key, content_type))
+
+    def start(self, key: str, content_type: str = ''):
+        """Have the preview of `key` built, without waiting for it"""
+        self._build(key, content_type)
+
+    def _build(self, key: str, content_type: str) -> asyncio.Future:
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = asyncio.ensure_future(self._load_or_build(key, content_type))
+            future.add_done_callback(lambda done: self._built(key, done))
+        return future
+
+    def _built(self, key: str, future: asyncio.Future):
+        self._pending.pop(key, None)
+        if not future.cancelled() and future.exception() is not None:
+            log.error('preview_failed', key=key, error=str(future.exception()))
+
+    def discard(self, key: str):
+        """Delete the cached preview of a file that was deleted"""
+        FILE_OPS.submit(self._remove, key)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'workers': self.workers,
+            'pending': len(self._pending),
+            'built': self.built,
+            'cache_hits': self.cache_hits,
+            'unavailable': self.unavailable,
+        }
+
+    async def _load_or_build(self, key: str, content_type: str) -> Optional[Dict[str, Any]]:
+        kind = preview_kind(key, content_type)
+        if kind is None:
+            return None
+        loop = asyncio.get_running_loop()
+        base = self.root / Path(key).with_suffix('')
+        cached = await loop.run_in_executor(IO_POOL, _read_cached, base)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached or None
+        await loop.run_in_executor(IO_POOL, lambda: base.parent.mkdir(parents=True, exist_ok=True))
+        thumbnail_key = 'previews/' + Path(key).with_suffix('').as_posix()
+        args = (str(self.uploads_root / key), kind, str(base), thumbnail_key)
+        try:
+            preview = await loop.run_in_executor(self._executor(), build_preview, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory on a huge image); start afresh next time
+            self._pool = None
+            preview = None
+        if preview is None:
+            self.unavailable += 1
+            return None
+        self.built += 1
+        # Only a kind: nothing could be decoded
+        return preview if len(preview) > 1 else None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Not forked: the server already runs threads (SQLite writer,
+            # file executors), whose locks a forked child could inherit held
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def _remove(self, key: str):
+        base = self.root / Path(key).with_suffix('')
+        for path in base.parent.glob(base.name + '.*'):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def _read_cached(base: Path) -> Optional[Dict[str, Any]]:
+    """Cached preview, {} for a file that had none to give, None if not cached"""
+    try:
+        preview = json.loads(base.with_suffix('.json').read_text())
+    except (OSError, ValueError):
+        return None
+    return preview if len(preview) > 1 else {}
@@ -0,0 +1,105 @@
+"""Per-connection rate limits for Socket.IO events.
+
+Every event a client sends belongs to a class (chat messages, typing,
+reactions, signaling, ...) and each connection has a token bucket per
+class: it holds up to `burst` tokens and refills at `rate` per second, and
+an event that finds its bucket empty is dropped before its handler runs.
+Dropping costs a dictionary lookup and a counter; nothing is logged, so a
+flooding client cannot turn its flood into log volume either.
+
+Limits are set per class with RATE_LIMITS, e.g. "message=5:10,typing=10:20"
+(rate per second : burst). A rate of 0 leaves the class unlimited.
+retry_after() tells how long a dropped event's class stays empty, for
+callers that let the client know; notice() gives it only for the first
+drop of each wait, so a flood is answered once rather than per event.
+"""
+import time
+from typing import Dict, Mapping, Optional, Tuple
+
+import metrics
+
+THROTTLED = metrics.registry.counter(
+    'socketio_throttled_total', 'Socket.IO events dropped by rate limits', ('class',))
+
+# class -> (tokens per second, bucket size)
+Limits = Dict[str, Tuple[float, float]]
+
+DEFAULT_CLASS = 'default'
+
+
+def parse_limits(spec: str, defaults: Limits) -> Limits:
+    """`defaults` with the classes listed in `spec` ("name=rate:burst,...") replaced"""
+    limits = dict(defaults)
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, _, value = item.partition('=')
+        rate, _, burst = value.partition(':')
+        limits[name.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+class RateLimiter:
+    """Token buckets per connection and event class"""
+
+    def __init__(self, limits: Limits, classes: Mapping[str, str]):
+        self.limits = limits
+        self.classes = classes  # event -> class; others are DEFAULT_CLASS
+        self._buckets: Dict[Tuple[str, str], list] = {}  # (sid, class) -> [tokens, as of, noticed until]
+        self.allowed = 0
+        self.throttled = 0
+
+    def allow(self, sid: str, event: str) -> bool:
+        """Take a token for `event` from the connection's bucket"""
+        name = self.classes.get(event, DEFAULT_CLASS)
+        limit = self.limits.get(name)
+        if limit is None or not limit[0]:
+            return True
+        rate, burst = limit
+        now = time.monotonic()
+        bucket = self._buckets.get((sid, name))
+        if bucket is None:
+            bucket = self._buckets[(sid, name)] = [burst, now, 0.0]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self.allowed += 1
+            return True
+        self.throttled += 1
+        THROTTLED.inc(name)
+        return False
+
+    def retry_after(self, sid: str, event: str) -> float:
+        """Seconds until the connection's bucket for `event` has a token again"""
+        name = self.classes.get(event, DEFAULT_CLASS)
+        limit = self.limits.get(name)
+        bucket = self._buckets.get((sid, name))
+        if limit is None or not limit[0] or bucket is None:
+            return 0.0
+        tokens = bucket[0] + (time.monotonic() - bucket[1]) * limit[0]
+        return max(0.0, (1 - tokens) / limit[0])
+
+    def notice(self, sid: str, event: str) -> Optional[float]:
+        """retry_after() for the first dropped event of a wait, None for the rest"""
+        bucket = self._buckets.get((sid, self.classes.get(event, DEFAULT_CLASS)))
+        now = time.monotonic()
+        if bucket is None or bucket[2] > now:
+            return None
+        wait = self.retry_after(sid, event)
+        bucket[2] = now + wait
+        return wait
+
+    def discard(self, sid: str):
+        """Forget the buckets of a connection that went away"""
+        for name in self.limits:
+            self._buckets.pop((sid, name), None)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'limits': {name: {'rate': rate, 'burst': burst} for name, (rate, burst) in self.limits.items()},
+            'buckets': len(self._buckets),
+            'allowed': self.allowed,
+            'throttled': self.throttled,
+        }
@@ -0,0 +1,102 @@
+"""Message reactions.
+
+Each user has at most one reaction per message. ReactionIndex keeps that
+choice keyed by (message, user), so adding, replacing and removing a
+reaction cost O(1) instead of scanning every emoji's user list, and
+reports each change as per-emoji deltas ({emoji, delta, count}) that can
+be broadcast instead of the message's whole reaction table.
+
+User lists stay in reaction order. Summaries name the users only for
+reactions with at most `inline` of them; larger ones are counts, and their
+users are fetched a page at a time when someone asks.
+"""
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# (emoji, +1 or -1, count after the change)
+Change = Tuple[str, int, int]
+
+
+class ReactionIndex:
+    """Reactions of every message, indexed by message and by user"""
+
+    def __init__(self):
+        self._choice: Dict[Tuple[str, str], str] = {}  # (message, user) -> emoji
+        self._users: Dict[str, Dict[str, Dict[str, None]]] = {}  # message -> emoji -> users
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._users
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def set(self, message_id: str, username: str, emoji: str) -> List[Change]:
+        """Make `emoji` the user's reaction to the message, replacing any other"""
+        previous = self._choice.get((message_id, username))
+        if previous == emoji:
+            return []
+        changes = []
+        if previous is not None:
+            changes.append(self._remove(message_id, username, previous))
+        self._choice[(message_id, username)] = emoji
+        users = self._users.setdefault(message_id, {}).setdefault(emoji, {})
+        users[username] = None
+        changes.append((emoji, 1, len(users)))
+        return changes
+
+    def remove(self, message_id: str, username: str, emoji: str) -> List[Change]:
+        """Take back the user's reaction, if it is `emoji`"""
+        if self._choice.get((message_id, username)) != emoji:
+            return []
+        return [self._remove(message_id, username, emoji)]
+
+    def choice(self, message_id: str, username: str) -> Optional[str]:
+        """The user's reaction to the message"""
+        return self._choice.get((message_id, username))
+
+    def discard(self, message_id: str):
+        """Forget every reaction to a message that is gone"""
+        for users in self._users.pop(message_id, {}).values():
+            for username in users:
+                self._choice.pop((message_id, username), None)
+
+    def load(self, message_id: str, reactions: Dict[str, Iterable[str]]):
+        """Replace a message's reactions with stored ones ({emoji: [users]})"""
+        self.discard(message_id)
+        for emoji, users in reactions.items():
+            for username in users:
+                self.set(message_id, username, emoji)
+
+    def lists(self, message_id: str) -> Dict[str, List[str]]:
+        """{emoji: [users]}, as stored"""
+        return {emoji: list(users) for emoji, users in self._users.get(message_id, {}).items()}
+
+    def summary(self, message_id: str, inline: int) -> List[Dict[str, Any]]:
+        """[{emoji, count, users}], without users for reactions over `inline`"""
+        summary = []
+        for emoji, users in self._users.get(message_id, {}).items():
+            entry: Dict[str, Any] = {'emoji': emoji, 'count': len(users)}
+            if len(users) <= inline:
+                entry['users'] = list(users)
+            summary.append(entry)
+        return summary
+
+    def users(self, message_id: str, emoji: str, offset: int, limit: int) -> Tuple[List[str], int]:
+        """A page of the users who reacted with `emoji`, and how many did"""
+        users = self._users.get(message_id, {}).get(emoji, {})
+        return list(islice(users, offset, offset + limit)), len(users)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'messages': len(self._users), 'reactions': len(self._choice)}
+
+    def _remove(self, message_id: str, username: str, emoji: str) -> Change:
+        del self._choice[(message_id, username)]
+        reactions = self._users[message_id]
+        users = reactions[emoji]
+        del users[username]
+        count = len(users)
+        if not count:
+            del reactions[emoji]
+            if not reactions:
+                del self._users[message_id]
+        return emoji, -1, count
@@ -0,0 +1,281 @@
+"""Garbage collection and disk quota for stored uploads.
+
+UploadCollector walks the upload directory in the background, one shard
+directory per step on the upload I/O pool, pausing between batches, so even
+a very large store never blocks startup or the event loop. Each pass:
+
+- deletes content-addressed files that no message references once they are
+  older than the orphan grace period (uploads that were never sent);
+- deletes leftover `.incoming` files from uploads that died mid-transfer;
+- with a quota set, evicts least recently used files until usage is back
+  under the low-water mark: files no message uses first, and files that
+  messages use only when deleting every unused one is not enough (those
+  messages are then flagged, see UploadStore.evict);
+- records usage statistics.
+
+"Used" is the later of a file's modification time (set on upload and on a
+deduplicated re-upload) and its access time, which each pass first sets for
+the files served since the previous one. Eviction
+needs to know how old the oldest few gigabytes are; instead of holding a
+million entries in memory, a pass adds up bytes per age bucket (buckets
+grow geometrically, about 5% of the age wide), and the next pass evicts
+the files in the buckets found that way: all of those in older buckets,
+and as many in the boundary bucket as the excess still calls for. A
+pass that finds the store over quota starts the next one right away.
+"""
+import asyncio
+import math
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from logs import get_logger
+from uploads import CONTENT_KEY_RE, IO_POOL, UploadStore
+
+log = get_logger('retention')
+
+# Directories under the upload root that are not stored files
+RESERVED = {'.incoming', '.sessions', 'previews'}
+SCAN_BATCH = 1000  # files between pauses
+SCAN_PAUSE = 0.01  # seconds
+INCOMING_MAX_AGE = 24 * 3600  # seconds before an unfinished upload file is removed
+QUOTA_LOW_WATER = 0.9  # evict down to this fraction of the quota
+AGE_BUCKETS_PER_E = 20  # age buckets per factor of e
+
+# (name, size, last used)
+FileEntry = Tuple[str, int, float]
+# Planned by a pass that found the store over quota, carried out by the next:
+# [evict all used before, evict up to `budget` bytes used before, budget]
+Eviction = List[float]
+
+
+class UploadCollector:
+    """Background orphan collection and LRU quota for an UploadStore"""
+
+    def __init__(self, store: UploadStore, orphan_grace: float = 24 * 3600.0,
+                 quota: int = 0, interval: float = 3600.0):
+        self.store = store
+        self.orphan_grace = orphan_grace
+        self.quota = quota  # bytes; 0 for no limit
+        self.interval = interval
+        self._used: Dict[str, float] = {}  # key -> last served, since the last pass began
+        # Eviction for unreferenced (False) and referenced (True) files
+        self._eviction: Optional[Dict[bool, Eviction]] = None
+        self._wake = asyncio.Event()
+        self.usage: Dict[str, Any] = {}
+        self.scans = 0
+        self.scanning = False
+        self.orphans_deleted = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.evicted_referenced = 0
+        self.incoming_deleted = 0
+
+    def touch(self, key: str):
+        """Note that a file was just used (served)"""
+        self._used[key] = time.time()
+
+    async def run(self):
+        while True:
+            again = False
+            try:
+                again = await self.collect()
+            except Exception:
+                log.exception('upload_collection_failed')
+            if not again:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wake.clear()
+
+    def wake(self):
+        """Start the next pass now"""
+        self._wake.set()
+
+    async def collect(self) -> bool:
+        """One incremental pass over the store. True if it planned an
+        eviction that the next pass should carry out right away."""
+        self.scanning = True
+        started = time.monotonic()
+        now = time.time()
+        eviction, self._eviction = self._eviction, None
+        plans = eviction or {}
+        used, self._used = self._used, {}
+        deleted_before = self.orphans_deleted + self.evicted_files
+
+        files = total = referenced = legacy = 0
+        # Bytes per age bucket of the files eviction may take, by whether
+        # messages use them
+        by_age: Dict[bool, Dict[int, int]] = {False: {}, True: {}}
+        oldest_use = None
+        pending = 0
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(IO_POOL, _mark_used, self.store.root, used)
+            await self._clean_incoming(now)
+            async for key, size, last_used in self._walk():
+                content = CONTENT_KEY_RE.match(key) is not None
+                refs = self.store.references(key) if content else 0
+                fresh = self.store.is_fresh(key)
+                plan = plans.get(refs > 0)
+                if fresh:
+                    pass
+                elif content and not refs and now - last_used > self.orphan_grace:
+                    self.store.delete(key)
+                    self.orphans_deleted += 1
+                    continue
+                elif plan is not None and (last_used < plan[0] or (plan[2] > 0 and last_used < plan[1])):
+                    if last_used >= plan[0]:
+                        plan[2] -= size
+                    if refs:
+                        self.store.evict(key)
+                        self.evicted_referenced += 1
+                    else:
+                        self.store.delete(key)
+                    self.evicted_files += 1
+                    self.evicted_bytes += size
+                    continue
+                files += 1
+                total += size
+                referenced += refs > 0
+                legacy += not content
+                if not fresh:
+                    bucket = int(math.log1p(max(0.0, now - last_used)) * AGE_BUCKETS_PER_E)
+                    ages = by_age[refs > 0]
+                    ages[bucket] = ages.get(bucket, 0) + size
+                if oldest_use is None or last_used < oldest_use:
+                    oldest_use = last_used
+                pending += 1
+                if pending >= SCAN_BATCH:
+                    pending = 0
+                    await asyncio.sleep(SCAN_PAUSE)
+        finally:
+            self.scanning = False
+
+        again = False
+        if self.quota and total > self.quota:
+            self._plan_eviction(by_age, total - int(self.quota * QUOTA_LOW_WATER), now)
+            # Once per overflow: a pass that already evicted waits its turn
+            again = eviction is None
+        self.scans += 1
+        self.usage = {
+            'files': files,
+            'bytes': total,
+            'referenced_files': referenced,
+            'legacy_files': legacy,
+            'oldest_use': oldest_use,
+            'scanned_at': now,
+            'scan_seconds': round(time.monotonic() - started, 3),
+        }
+        deleted = self.orphans_deleted + self.evicted_files - deleted_before
+        if deleted:
+            log.info('uploads_collected', deleted=deleted, files=files, bytes=total)
+        return again
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.usage,
+            'quota': self.quota,
+            'orphan_grace': self.orphan_grace,
+            'scans': self.scans,
+            'scanning': self.scanning,
+            'orphans_deleted': self.orphans_deleted,
+            'evicted_files': self.evicted_files,
+            'evicted_bytes': self.evicted_bytes,
+            'evicted_referenced': self.evicted_referenced,
+            'incoming_deleted': self.incoming_deleted,
+        }
+
+    def _plan_eviction(self, by_age: Dict[bool, Dict[int, int]], excess: int, now: float):
+        """Plan to free `excess` bytes: unreferenced files first, and
+        referenced ones only if all the unreferenced ones are not enough"""
+        unreferenced = sum(by_age[False].values())
+        if unreferenced >= excess:
+            self._eviction = {False: _oldest(by_age[False], excess, now)}
+        else:
+            everything = [math.inf, math.inf, 0]
+            self._eviction = {False: everything, True: _oldest(by_age[True], excess - unreferenced, now)}
+
+    async def _walk(self):
+        """Stored files as (key, size, last used), one directory at a time"""
+        loop = asyncio.get_running_loop()
+        root = self.store.root
+        top = await loop.run_in_executor(IO_POOL, _list_dir, root)
+        for name, size, modified in top.files:
+            yield name, size, modified
+        for first in top.dirs:
+            if first in RESERVED or first.startswith('.'):
+                continue
+            level = await loop.run_in_executor(IO_POOL, _list_dir, root / first)
+            for second in level.dirs:
+                leaf = await loop.run_in_executor(IO_POOL, _list_dir, root / first / second)
+                for name, size, modified in leaf.files:
+                    yield f"{first}/{second}/{name}", size, modified
+
+    async def _clean_incoming(self, now: float):
+        stale = await asyncio.get_running_loop().run_in_executor(
+            IO_POOL, _remove_older, self.store.tmp_dir, now - INCOMING_MAX_AGE)
+        self.incoming_deleted += stale
+
+
+def _oldest(by_age: Dict[int, int], excess: int, now: float) -> Eviction:
+    """Evict from the oldest age buckets until `excess` bytes are freed"""
+    freed = 0
+    for bucket in sorted(by_age, reverse=True):
+        if freed + by_age[bucket] >= excess:
+            # Bucket `bucket` holds ages from expm1(bucket / N) up to expm1((bucket + 1) / N)
+            older = now - math.expm1((bucket + 1) / AGE_BUCKETS_PER_E)
+            return [older, now - math.expm1(bucket / AGE_BUCKETS_PER_E), excess - freed]
+        freed += by_age[bucket]
+    return [math.inf, math.inf, 0]
+
+
+class DirListing:
+    __slots__ = ('files', 'dirs')
+
+    def __init__(self):
+        self.files: List[FileEntry] = []
+        self.dirs: List[str] = []
+
+
+def _list_dir(path: Path) -> DirListing:
+    listing = DirListing()
+    try:
+        entries = os.scandir(path)
+    except FileNotFoundError:
+        return listing
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    listing.dirs.append(entry.name)
+                elif entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                    info = entry.stat(follow_symlinks=False)
+                    listing.files.append((entry.name, info.st_size, max(info.st_mtime, info.st_atime)))
+            except FileNotFoundError:
+                pass
+    return listing
+
+
+def _mark_used(root: Path, used: Dict[str, float]):
+    """Record when files were served as their access time"""
+    for key, served in used.items():
+        path = root / key
+        try:
+            os.utime(path, (served, os.stat(path).st_mtime))
+        except FileNotFoundError:
+            pass
+
+
+def _remove_older(path: Path, cutoff: float) -> int:
+    removed = 0
+    for name, _, modified in _list_dir(path).files:
+        if modified < cutoff:
+            try:
+                os.unlink(path / name)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
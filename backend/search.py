@@ -0,0 +1,246 @@
+"""Incrementally maintained full-text index over room history.
+
+Every room has its own inverted index: term -> ascending list of document
+numbers, where documents are numbered in the order messages were indexed.
+Because that order is also message time order, walking postings from the
+end gives the newest matches first, and a query can stop as soon as it has
+filled a page.
+
+Removed documents are only dropped from the live document table; their
+postings stay behind as garbage and a room's postings are rebuilt once the
+garbage outweighs the live entries. A global budget on live postings evicts
+the oldest indexed messages first.
+"""
+import heapq
+import re
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+MAX_TERM_LENGTH = 32
+# A prefix never expands to more vocabulary terms than this; searches that
+# hit the cap say so (see SearchIndex.search)
+MAX_PREFIX_EXPANSION = 256
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased, de-duplicated terms of a text in order of appearance"""
+    seen = {}
+    for match in TOKEN_RE.finditer(text.lower()):
+        seen.setdefault(match.group()[:MAX_TERM_LENGTH], None)
+    return list(seen)
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    text = message.get('content') or ''
+    file_info = message.get('file')
+    if isinstance(file_info, dict) and file_info.get('filename'):
+        text = f"{text} {file_info['filename']}"
+    return text
+
+
+class RoomIndex:
+    """Inverted index for a single room"""
+
+    def __init__(self):
+        self.postings: Dict[str, List[int]] = {}
+        self.vocabulary: List[str] = []  # sorted, for prefix lookups
+        self.doc_of: Dict[str, int] = {}  # message_id -> doc
+        self.docs: Dict[int, Tuple[str, Tuple[str, ...]]] = {}  # doc -> (message_id, terms)
+        self.next_doc = 0
+        self.live_postings = 0
+        self.dead_postings = 0
+
+    def add(self, message_id: str, terms: List[str]) -> int:
+        doc = self.next_doc
+        self.next_doc += 1
+        self.doc_of[message_id] = doc
+        self.docs[doc] = (message_id, tuple(terms))
+        for term in terms:
+            self._add_posting(term, doc)
+        return doc
+
+    def update(self, message_id: str, terms: List[str]) -> int:
+        """Re-index an edited message, keeping its place in time order"""
+        doc = self.doc_of[message_id]
+        old_terms = self.docs[doc][1]
+        for term in set(old_terms) - set(terms):
+            postings = self.postings[term]
+            index = bisect_left(postings, doc)
+            if index < len(postings) and postings[index] == doc:
+                del postings[index]
+                self.live_postings -= 1
+        for term in terms:
+            if term not in old_terms:
+                self._add_posting(term, doc)
+        self.docs[doc] = (message_id, tuple(terms))
+        return len(terms) - len(old_terms)
+
+    def remove(self, message_id: str) -> int:
+        doc = self.doc_of.pop(message_id, None)
+        if doc is None:
+            return 0
+        _, terms = self.docs.pop(doc)
+        self.live_postings -= len(terms)
+        self.dead_postings += len(terms)
+        if self.dead_postings > self.live_postings:
+            self._compact()
+        return len(terms)
+
+    def search(self, query_terms: List[str], before: Optional[int] = None) -> Iterator[int]:
+        """Yield live documents matching every query term as a prefix, newest first"""
+        expansions = []
+        for term in query_terms:
+            lists = self._expand(term)
+            if not lists:
+                return
+            expansions.append(lists)
+        # Drive the walk from the rarest term and probe the others
+        expansions.sort(key=lambda lists: sum(len(postings) for postings in lists))
+        driver, others = expansions[0], expansions[1:]
+
+        previous = None
+        for doc in heapq.merge(*(self._descending(postings, before) for postings in driver),
+                               reverse=True):
+            if doc == previous:
+                continue
+            previous = doc
+            if doc not in self.docs:
+                continue
+            if all(any(_contains(postings, doc) for postings in lists) for lists in others):
+                yield doc
+
+    def _expand(self, prefix: str) -> List[List[int]]:
+        start = bisect_left(self.vocabulary, prefix)
+        lists = []
+        for index in range(start, min(start + MAX_PREFIX_EXPANSION, len(self.vocabulary))):
+            term = self.vocabulary[index]
+            if not term.startswith(prefix):
+                break
+            lists.append(self.postings[term])
+        return lists
+
+    def truncated(self, prefix: str) -> bool:
+        """Whether `prefix` matches more terms than a search expands it to"""
+        index = bisect_left(self.vocabulary, prefix) + MAX_PREFIX_EXPANSION
+        return index < len(self.vocabulary) and self.vocabulary[index].startswith(prefix)
+
+    @staticmethod
+    def _descending(postings: List[int], before: Optional[int]) -> Iterator[int]:
+        end = len(postings) if before is None else bisect_left(postings, before)
+        for index in range(end - 1, -1, -1):
+            yield postings[index]
+
+    def _add_posting(self, term: str, doc: int):
+        postings = self.postings.get(term)
+        if postings is None:
+            postings = self.postings[term] = []
+            insort(self.vocabulary, term)
+        if not postings or postings[-1] < doc:
+            postings.append(doc)
+        else:
+            insort(postings, doc)
+        self.live_postings += 1
+
+    def _compact(self):
+        postings: Dict[str, List[int]] = {}
+        for doc in sorted(self.docs):
+            for term in self.docs[doc][1]:
+                postings.setdefault(term, []).append(doc)
+        self.postings = postings
+        self.vocabulary = sorted(postings)
+        self.dead_postings = 0
+
+
+def _contains(postings: List[int], doc: int) -> bool:
+    index = bisect_left(postings, doc)
+    return index < len(postings) and postings[index] == doc
+
+
+class SearchIndex:
+    """Per-room inverted indexes sharing one memory budget"""
+
+    def __init__(self, max_postings: int = 2000000):
+        self.max_postings = max_postings
+        self._rooms: Dict[str, RoomIndex] = {}
+        self._room_of: Dict[str, str] = {}  # message_id -> room
+        # Indexing order across rooms, for evicting the oldest documents
+        self._order: Deque[Tuple[str, str]] = deque()
+        self.total_postings = 0
+        self.evicted = 0
+
+    def add(self, room: str, message: Dict[str, Any]):
+        message_id = message['id']
+        if message_id in self._room_of:
+            self.update(message)
+            return
+        terms = tokenize(message_text(message))
+        index = self._rooms.get(room)
+        if index is None:
+            index = self._rooms[room] = RoomIndex()
+        index.add(message_id, terms)
+        self._room_of[message_id] = room
+        self._order.append((room, message_id))
+        self.total_postings += len(terms)
+        self._enforce_budget()
+
+    def update(self, message: Dict[str, Any]):
+        room = self._room_of.get(message['id'])
+        if room is None:
+            return
+        terms = tokenize(message_text(message))
+        self.total_postings += self._rooms[room].update(message['id'], terms)
+        self._enforce_budget()
+
+    def remove(self, message_id: str):
+        room = self._room_of.pop(message_id, None)
+        if room is None:
+            return
+        index = self._rooms[room]
+        self.total_postings -= index.remove(message_id)
+        if not index.docs:
+            del self._rooms[room]
+
+    def search(self, room: str, query: str, limit: int,
+               before: Optional[int] = None) -> Tuple[List[str], Optional[int], bool]:
+        """Message ids matching `query`, newest first.
+
+        Returns at most `limit` ids, the cursor for the next page (None
+        when there are no more matches) and whether a term was a prefix of
+        more than MAX_PREFIX_EXPANSION words, in which case only messages
+        with the first of those words were searched. Every query term
+        matches as a prefix of a word in the message.
+        """
+        index = self._rooms.get(room)
+        terms = tokenize(query)
+        if index is None or not terms or limit <= 0:
+            return [], None, False
+        truncated = any(index.truncated(term) for term in terms)
+        message_ids = []
+        for doc in index.search(terms, before=before):
+            if len(message_ids) == limit:
+                return message_ids, previous_doc, truncated
+            message_ids.append(index.docs[doc][0])
+            previous_doc = doc
+        return message_ids, None, truncated
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'rooms': len(self._rooms),
+            'messages': len(self._room_of),
+            'postings': self.total_postings,
+            'terms': sum(len(index.postings) for index in self._rooms.values()),
+            'max_postings': self.max_postings,
+            'evicted': self.evicted,
+        }
+
+    def _enforce_budget(self):
+        while self.total_postings > self.max_postings and self._order:
+            room, message_id = self._order.popleft()
+            if self._room_of.get(message_id) == room:
+                self.remove(message_id)
+                self.evicted += 1
+        if len(self._order) > 2 * len(self._room_of) + 64:
+            self._order = deque(entry for entry in self._order
+                                if self._room_of.get(entry[1]) == entry[0])
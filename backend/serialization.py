@@ -0,0 +1,93 @@
+"""Encoding of what the server sends.
+
+- REST responses and Socket.IO's JSON packets are encoded with orjson when
+  it is installed (`pip install orjson`), and with the standard library's
+  json otherwise.
+- High-volume events can be sent with short keys to clients that ask for
+  the `compact` feature (see COMPACT_KEYS).
+"""
+import json
+from typing import Any
+
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Long key -> short key, for the events in COMPACT_EVENTS. Clients expand
+# every key found in the reverse table, at any depth; other keys are
+# unchanged, so expanding a payload that was sent with full keys is harmless.
+COMPACT_KEYS = {
+    'id': 'i',
+    'type': 'y',
+    'content': 'c',
+    'username': 'u',
+    'userId': 's',
+    'room': 'r',
+    'timestamp': 't',
+    'edited': 'e',
+    'edited_at': 'ea',
+    'file': 'f',
+    'replyTo': 'rt',
+    'messageId': 'm',
+    'messages': 'ms',
+    'reactions': 'rs',
+    'emoji': 'em',
+    'users': 'us',
+    'count': 'n',
+    'typing': 'ty',
+    'isPrivate': 'p',
+}
+COMPACT_EVENTS = ('message', 'message_batch', 'user_typing', 'reaction_updated')
+
+
+def compact(payload: Any) -> Any:
+    """`payload` with short keys, leaving out keys whose value is None"""
+    if isinstance(payload, dict):
+        return {COMPACT_KEYS.get(key, key): compact(value)
+                for key, value in payload.items() if value is not None}
+    if isinstance(payload, list):
+        return [compact(value) for value in payload]
+    return payload
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    return str(value)
+
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(value: Any) -> bytes:
+        return orjson.dumps(value, default=_default, option=ORJSON_OPTIONS)
+
+    loads = orjson.loads
+else:
+    def dumps(value: Any) -> bytes:
+        return json.dumps(value, default=_default, separators=(',', ':'),
+                          ensure_ascii=False).encode()
+
+    loads = json.loads
+
+
+class SocketIOJson:
+    """The json module interface python-socketio and python-engineio expect"""
+
+    @staticmethod
+    def dumps(value: Any, **kwargs) -> str:
+        return dumps(value).decode()
+
+    @staticmethod
+    def loads(value, **kwargs) -> Any:
+        return loads(value)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded with orjson, when available"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,98 @@
+"""Coalescing of trickle-ICE candidates.
+
+A browser gathers its ICE candidates over a few hundred milliseconds and
+sends each one as soon as it is found, so call setup produces bursts of
+small signaling messages. For recipients that support it, CandidateBatcher
+holds the candidates one peer sends another for a short window and hands
+them over as a single batch. An end-of-candidates marker (a null or empty
+candidate) flushes the batch right away.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from logs import get_logger
+
+log = get_logger('signaling')
+
+# Called with (sender, recipient, candidates)
+SendBatch = Callable[[str, str, List[Any]], Awaitable[None]]
+
+
+def is_end_of_candidates(candidate: Any) -> bool:
+    if candidate is None:
+        return True
+    if isinstance(candidate, dict):
+        return not candidate.get('candidate')
+    return not candidate
+
+
+class PendingBatch:
+    __slots__ = ('candidates', 'timer')
+
+    def __init__(self):
+        self.candidates: List[Any] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class CandidateBatcher:
+    """Per (sender, recipient) buffers of ICE candidates"""
+
+    def __init__(self, send: SendBatch, window: float = 0.03, max_batch: int = 64):
+        self.send = send
+        self.window = window
+        self.max_batch = max_batch
+        self._flushing: Set[asyncio.Task] = set()  # timed flushes in progress
+        self._pending: Dict[Tuple[str, str], PendingBatch] = {}
+        self.candidates = 0
+        self.batches = 0
+
+    async def add(self, sender: str, recipient: str, candidate: Any):
+        key = (sender, recipient)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = PendingBatch()
+            batch.timer = asyncio.get_running_loop().call_later(
+                self.window, self._flush_later, key)
+        batch.candidates.append(candidate)
+        self.candidates += 1
+        if is_end_of_candidates(candidate) or len(batch.candidates) >= self.max_batch:
+            await self._flush(key)
+
+    async def flush(self, sender: str):
+        """Send whatever `sender` has pending, e.g. before it renegotiates"""
+        for key in [key for key in self._pending if key[0] == sender]:
+            await self._flush(key)
+
+    def discard(self, sid: str):
+        """Drop batches from or to a socket that went away"""
+        for key in [key for key in self._pending if sid in key]:
+            batch = self._pending.pop(key)
+            batch.timer.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'window_ms': self.window * 1000,
+            'pending': len(self._pending),
+            'candidates': self.candidates,
+            'batches': self.batches,
+        }
+
+    def _flush_later(self, key: Tuple[str, str]):
+        """Flush from the window timer, keeping the task until it is done"""
+        task = asyncio.ensure_future(self._timed_flush(key))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _timed_flush(self, key: Tuple[str, str]):
+        try:
+            await self._flush(key)
+        except Exception:
+            log.exception('candidate_flush_failed', sender=key[0], recipient=key[1])
+
+    async def _flush(self, key: Tuple[str, str]):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        self.batches += 1
+        await self.send(key[0], key[1], batch.candidates)
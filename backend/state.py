@@ -0,0 +1,429 @@
+"""Connection state: users, room membership and stranger chat.
+
+Handlers read state straight from the dicts (`active_users`, `room_users`,
+`stranger_chat`) but change it only through the methods below, so the same
+handler code runs on two implementations:
+
+- LocalState keeps everything in this process. It is the default.
+- SharedState additionally replicates every change to the other server
+  processes over a message bus, so each worker holds a full copy of who is
+  online where. Each entry is owned by the process its socket is connected
+  to; when a process goes away, the entries it owned are dropped everywhere.
+"""
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from bus import Broker
+from logs import get_logger
+from matchmaking import Matchmaker
+
+log = get_logger('state')
+
+
+class StrangerChat:
+    def __init__(self):
+        # Users waiting for a stranger match, in general and interest queues
+        self.matchmaker = Matchmaker()
+
+        # Active stranger connections (paired users)
+        self.stranger_connections: Dict[str, str] = {}  # socket_id -> partner_socket_id
+
+        # Stranger user information
+        self.stranger_users: Dict[str, dict] = {}  # socket_id -> user_info
+
+        # Video call states
+        self.video_calls: Dict[str, dict] = {}  # room_id -> call_info
+
+        # Call each socket is in, derived from video_calls
+        self.call_rooms: Dict[str, str] = {}  # socket_id -> room_id
+
+    def call_partner(self, sid: str) -> Optional[str]:
+        """The other side of the video call `sid` is in, if any"""
+        call = self.video_calls.get(self.call_rooms.get(sid))
+        if call is None:
+            return None
+        return call['partner'] if call['initiator'] == sid else call['initiator']
+
+    def index_call(self, room_id: str, call: dict):
+        for sid in (call.get('initiator'), call.get('partner')):
+            if sid is not None:
+                self.call_rooms[sid] = room_id
+
+    def unindex_call(self, room_id: str, call: dict):
+        for sid in (call.get('initiator'), call.get('partner')):
+            # A newer call may have taken over the entry
+            if self.call_rooms.get(sid) == room_id:
+                del self.call_rooms[sid]
+
+
+# Handler called with the sids that vanished with a lost process and the
+# rooms they were in
+LostHandler = Callable[[Set[str], Set[str]], Awaitable[None]]
+# Called with (room, sid, joined) whenever room membership changes
+RoomListener = Callable[[str, str, bool], None]
+
+
+class LocalState:
+    """State for a single server process"""
+
+    def __init__(self):
+        self.node_id = 'local'
+        self.active_users: Dict[str, dict] = {}
+        # room -> members in join order (an ordered set); empty rooms are dropped
+        self.room_users: Dict[str, Dict[str, None]] = {}
+        self.stranger_chat = StrangerChat()
+        # Who is typing in a room: sid -> {'room', 'username'}, and by room
+        self.typing: Dict[str, dict] = {}
+        self.room_typing: Dict[str, Dict[str, str]] = {}  # room -> {sid: username}
+        self._tables: Dict[str, Dict[str, Any]] = {
+            'users': self.active_users,
+            'strangers': self.stranger_chat.stranger_users,
+            'connections': self.stranger_chat.stranger_connections,
+            'calls': self.stranger_chat.video_calls,
+            'typing': self.typing,
+        }
+        self._event_handlers: Dict[str, Callable[..., None]] = {}
+        self._lost_handler: Optional[LostHandler] = None
+        self._room_listeners: List[RoomListener] = []
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {'mode': 'local', 'node_id': self.node_id}
+
+    # ----- writes -----
+
+    def put(self, table: str, key: str, value: Any):
+        self._change('put', table, key, value)
+
+    def patch(self, table: str, key: str, **fields):
+        self._change('patch', table, key, fields)
+
+    def delete(self, table: str, key: str):
+        self._change('delete', table, key)
+
+    def join_room(self, room: str, sid: str):
+        self._change('join_room', room, sid)
+
+    def leave_room(self, room: str, sid: str):
+        self._change('leave_room', room, sid)
+
+    def enqueue_stranger(self, sid: str, interests: List[str]):
+        self._change('enqueue', sid, list(interests), uuid.uuid4().hex)
+
+    def dequeue_stranger(self, sid: str):
+        self._change('dequeue', sid)
+
+    async def claim(self, key: str, ttl: float = 30.0) -> bool:
+        """Settle a race with other processes; always won in a single process"""
+        return True
+
+    async def take_stranger(self, sid: str, interests: List[str]) -> Optional[str]:
+        """Remove and return a waiting partner for `sid`, interest queues first.
+
+        Call with `stranger_chat.matchmaker.lock` held.
+        """
+        matchmaker = self.stranger_chat.matchmaker
+        for candidate in matchmaker.candidates(interests):
+            if candidate == sid or candidate not in self.stranger_chat.stranger_users:
+                continue
+            token = matchmaker.token(candidate)
+            if token is None:
+                continue
+            try:
+                claimed = await self.claim(f"match:{candidate}:{token}")
+            except (OSError, asyncio.TimeoutError) as e:
+                # The broker is unreachable: wait in the queue instead
+                log.warning('match_claim_failed', error=str(e))
+                return None
+            if not claimed:
+                continue
+            # A replicated change may have requeued or removed it meanwhile
+            if matchmaker.token(candidate) != token:
+                continue
+            self.dequeue_stranger(candidate)
+            return candidate
+        return None
+
+    # ----- cross-process events -----
+
+    def on_event(self, name: str, handler: Callable[..., None]):
+        """Run `handler(*args)` when another process broadcasts `name`"""
+        self._event_handlers[name] = handler
+
+    def broadcast_event(self, name: str, *args):
+        """Tell the other processes about a change they keep a copy of"""
+        self._replicate([('event', name, args)])
+
+    def on_lost(self, handler: LostHandler):
+        self._lost_handler = handler
+
+    def on_room_change(self, listener: RoomListener):
+        """Call `listener(room, sid, joined)` on every membership change,
+        wherever it was made"""
+        self._room_listeners.append(listener)
+
+    # ----- applying changes -----
+
+    def _change(self, op: str, *args):
+        self._apply(op, args, self.node_id)
+        self._replicate([(op,) + args])
+
+    def _replicate(self, ops: List[Tuple]):
+        pass
+
+    def _apply(self, op: str, args: Tuple, origin: str):
+        getattr(self, f'_apply_{op}')(origin, *args)
+
+    def _apply_put(self, origin: str, table: str, key: str, value: Any):
+        entries = self._tables[table]
+        if table == 'calls':
+            if key in entries:
+                self.stranger_chat.unindex_call(key, entries[key])
+            self.stranger_chat.index_call(key, value)
+        elif table == 'typing':
+            if key in entries:
+                self._unindex_typing(key, entries[key])
+            self.room_typing.setdefault(value['room'], {})[key] = value['username']
+        entries[key] = value
+
+    def _apply_patch(self, origin: str, table: str, key: str, fields: Dict[str, Any]):
+        entry = self._tables[table].get(key)
+        if entry is not None:
+            entry.update(fields)
+
+    def _apply_delete(self, origin: str, table: str, key: str):
+        value = self._tables[table].pop(key, None)
+        if table == 'calls' and value is not None:
+            self.stranger_chat.unindex_call(key, value)
+        elif table == 'typing' and value is not None:
+            self._unindex_typing(key, value)
+
+    def _unindex_typing(self, sid: str, value: dict):
+        typers = self.room_typing.get(value['room'])
+        if typers is not None:
+            typers.pop(sid, None)
+            if not typers:
+                del self.room_typing[value['room']]
+
+    def _apply_join_room(self, origin: str, room: str, sid: str):
+        members = self.room_users.setdefault(room, {})
+        if sid not in members:
+            members[sid] = None
+            for listener in self._room_listeners:
+                listener(room, sid, True)
+
+    def _apply_leave_room(self, origin: str, room: str, sid: str):
+        members = self.room_users.get(room)
+        if members and sid in members:
+            del members[sid]
+            if not members:
+                del self.room_users[room]
+            for listener in self._room_listeners:
+                listener(room, sid, False)
+
+    def _apply_enqueue(self, origin: str, sid: str, interests: List[str], token: str):
+        self.stranger_chat.matchmaker.add(sid, interests, token)
+
+    def _apply_dequeue(self, origin: str, sid: str):
+        self.stranger_chat.matchmaker.remove(sid)
+
+    def _apply_event(self, origin: str, name: str, args: Tuple):
+        if origin == self.node_id:
+            return
+        handler = self._event_handlers.get(name)
+        if handler is not None:
+            handler(*args)
+
+
+class SharedState(LocalState):
+    """State replicated across processes through a message bus"""
+
+    CHANNEL = 'chat-state'
+    HEARTBEAT_INTERVAL = 5.0  # seconds
+    NODE_TIMEOUT = 15.0  # seconds without a heartbeat before a node is dropped
+
+    def __init__(self, broker: Broker, node_id: Optional[str] = None):
+        super().__init__()
+        self.broker = broker
+        self.node_id = node_id or uuid.uuid4().hex[:8]
+        self._owners: Dict[str, str] = {}  # sid -> node that owns it
+        self._nodes: Dict[str, float] = {}  # node -> last heartbeat (monotonic)
+        self._outbox: List[Tuple] = []
+        self._outbox_ready: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.published = 0
+        self.received = 0
+
+    async def start(self):
+        self._outbox_ready = asyncio.Event()
+        ready = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._receive_loop(ready)),
+            asyncio.create_task(self._send_loop()),
+            asyncio.create_task(self._heartbeat_loop()),
+        ]
+        await ready.wait()
+        # Ask the other nodes to replay what they own
+        await self._publish({'node': self.node_id, 'control': 'hello'})
+
+    async def stop(self):
+        await self._flush()
+        await self._publish({'node': self.node_id, 'control': 'bye'})
+        for task in self._tasks:
+            task.cancel()
+        await self.broker.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'mode': 'shared',
+            'node_id': self.node_id,
+            'nodes': sorted(self._nodes),
+            'published': self.published,
+            'received': self.received,
+            'pending': len(self._outbox),
+        }
+
+    async def claim(self, key: str, ttl: float = 30.0) -> bool:
+        return await self.broker.claim(key, self.node_id, ttl)
+
+    def _replicate(self, ops: List[Tuple]):
+        # Handlers never wait on the bus: changes are batched and sent by
+        # _send_loop on the next iteration of the event loop
+        self._outbox.extend(ops)
+        if self._outbox_ready is not None:
+            self._outbox_ready.set()
+
+    async def _publish(self, message: Dict[str, Any]):
+        await self.broker.publish(self.CHANNEL, json.dumps(message).encode())
+        self.published += 1
+
+    async def _flush(self):
+        if self._outbox:
+            ops, self._outbox = self._outbox, []
+            await self._publish({'node': self.node_id, 'ops': ops})
+
+    async def _send_loop(self):
+        while True:
+            await self._outbox_ready.wait()
+            self._outbox_ready.clear()
+            try:
+                await self._flush()
+            except Exception as e:
+                log.error('state_replicate_failed', error=str(e))
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+            try:
+                await self._publish({'node': self.node_id, 'control': 'heartbeat'})
+            except Exception as e:
+                log.warning('heartbeat_failed', error=str(e))
+            now = time.monotonic()
+            for node, last_seen in list(self._nodes.items()):
+                if now - last_seen > self.NODE_TIMEOUT:
+                    await self._drop_node(node)
+
+    async def _receive_loop(self, ready: asyncio.Event):
+        subscription = await self.broker.subscribe(self.CHANNEL)
+        ready.set()
+        try:
+            async for data in subscription:
+                try:
+                    await self._handle(json.loads(data))
+                except Exception as e:
+                    log.error('state_apply_failed', error=str(e))
+        finally:
+            subscription.close()
+
+    async def _handle(self, message: Dict[str, Any]):
+        node = message['node']
+        if node == self.node_id:
+            return
+        self.received += 1
+        control = message.get('control')
+        if node not in self._nodes and control not in ('hello', 'bye'):
+            # A node we had dropped, e.g. across a lost broker connection:
+            # everyone replays what they own
+            await self._publish({'node': self.node_id, 'control': 'hello'})
+        self._nodes[node] = time.monotonic()
+        if control == 'hello':
+            self._replicate(self._snapshot())
+        elif control == 'bye':
+            await self._drop_node(node)
+        elif control is None:
+            for op in message['ops']:
+                self._apply(op[0], op[1:], node)
+
+    def _apply_put(self, origin: str, table: str, key: str, value: Any):
+        super()._apply_put(origin, table, key, value)
+        if table in ('users', 'strangers'):
+            self._owners[key] = origin
+
+    def _apply_delete(self, origin: str, table: str, key: str):
+        super()._apply_delete(origin, table, key)
+        if (table in ('users', 'strangers') and key not in self.active_users
+                and key not in self.stranger_chat.stranger_users):
+            self._owners.pop(key, None)
+
+    def _snapshot(self) -> List[Tuple]:
+        """Operations that recreate everything this node owns"""
+        owned = {sid for sid, node in self._owners.items() if node == self.node_id}
+        ops: List[Tuple] = []
+        for table, entries in self._tables.items():
+            for key, value in entries.items():
+                if table == 'calls':
+                    if value.get('initiator') in owned:
+                        ops.append(('put', table, key, value))
+                elif key in owned:
+                    ops.append(('put', table, key, value))
+        for room, members in self.room_users.items():
+            for sid in members:
+                if sid in owned:
+                    ops.append(('join_room', room, sid))
+        matchmaker = self.stranger_chat.matchmaker
+        for sid in matchmaker.waiting():
+            if sid in owned:
+                ops.append(('enqueue', sid, matchmaker.interests(sid), matchmaker.token(sid)))
+        return ops
+
+    async def _drop_node(self, node: str):
+        """Forget everything owned by a node that left or stopped responding"""
+        self._nodes.pop(node, None)
+        lost = {sid for sid, owner in self._owners.items() if owner == node}
+        if not lost:
+            return
+        log.warning('node_lost', node=node, connections=len(lost))
+        rooms = set()
+        for room, members in list(self.room_users.items()):
+            for sid in lost.intersection(members):
+                self._apply_leave_room(node, room, sid)
+                rooms.add(room)
+        for sid in lost:
+            self._owners.pop(sid, None)
+            self._apply_dequeue(node, sid)
+            self.active_users.pop(sid, None)
+            self.stranger_chat.stranger_users.pop(sid, None)
+            self.stranger_chat.stranger_connections.pop(sid, None)
+            typing = self.typing.pop(sid, None)
+            if typing is not None:
+                self._unindex_typing(sid, typing)
+        for room_id, call in list(self.stranger_chat.video_calls.items()):
+            if call.get('initiator') in lost or call.get('partner') in lost:
+                del self.stranger_chat.video_calls[room_id]
+                self.stranger_chat.unindex_call(room_id, call)
+        if self._lost_handler is not None:
+            await self._lost_handler(lost, rooms)
+
+
+def create_state(broker: Optional[Broker]) -> LocalState:
+    if broker is None:
+        return LocalState()
+    return SharedState(broker)
@@ -0,0 +1,222 @@
+"""Pluggable persistence for chat history.
+
+The in-memory structures in main.py (message history, private
+conversations, reactions) are always the source of truth while the server
+runs. A storage backend only mirrors changes so they survive a restart:
+
+- MemoryStorage keeps nothing; it is the default and costs nothing.
+- SQLiteStorage queues every change and writes it from a background thread
+  in batches, so socket handlers never block on disk.
+"""
+import json
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from logs import get_logger
+
+log = get_logger('storage')
+
+
+class StoredState:
+    """Everything a backend restores at startup"""
+
+    def __init__(self):
+        # (room, message, created) tuples in insertion order
+        self.messages: List[Tuple[str, Dict[str, Any], float]] = []
+        self.private_conversations: Dict[str, List[Dict[str, Any]]] = {}
+        self.message_reactions: Dict[str, Dict[str, List[str]]] = {}
+
+
+class MemoryStorage:
+    """Default backend: state lives only in process memory"""
+
+    name = 'memory'
+
+    def load(self) -> StoredState:
+        return StoredState()
+
+    def save_message(self, room: str, message: Dict[str, Any]):
+        pass
+
+    def update_message(self, message: Dict[str, Any]):
+        pass
+
+    def delete_message(self, message_id: str):
+        pass
+
+    def save_private_message(self, conversation_key: str, message: Dict[str, Any]):
+        pass
+
+    def save_reactions(self, message_id: str, reactions: Dict[str, List[str]]):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {'backend': self.name}
+
+    def close(self):
+        pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    room TEXT NOT NULL,
+    created REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS private_messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reactions (
+    message_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+# Queued in place of an (sql, params) operation to stop the writer
+_STOP = None
+
+
+class SQLiteStorage(MemoryStorage):
+    """SQLite backend in WAL mode with a batched write-behind thread"""
+
+    name = 'sqlite'
+
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 0.05):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue: "queue.SimpleQueue[Optional[Tuple[str, tuple]]]" = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        connection.commit()
+        connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def load(self) -> StoredState:
+        state = StoredState()
+        connection = self._connect()
+        try:
+            for room, created, data in connection.execute(
+                    "SELECT room, created, data FROM messages ORDER BY seq"):
+                state.messages.append((room, json.loads(data), created))
+            for conversation, data in connection.execute(
+                    "SELECT conversation, data FROM private_messages ORDER BY seq"):
+                state.private_conversations.setdefault(conversation, []).append(json.loads(data))
+            for message_id, data in connection.execute(
+                    "SELECT message_id, data FROM reactions"):
+                state.message_reactions[message_id] = json.loads(data)
+        finally:
+            connection.close()
+        self._start_writer()
+        return state
+
+    # Payloads are serialized on the caller's side: the dicts keep being
+    # mutated by the handlers while the writer thread works through the queue.
+
+    def save_message(self, room: str, message: Dict[str, Any]):
+        self._put("INSERT OR REPLACE INTO messages (id, room, created, data) VALUES (?, ?, ?, ?)",
+                  (message['id'], room, time.time(), json.dumps(message)))
+
+    def update_message(self, message: Dict[str, Any]):
+        self._put("UPDATE messages SET data = ? WHERE id = ?",
+                  (json.dumps(message), message['id']))
+
+    def delete_message(self, message_id: str):
+        self._put("DELETE FROM messages WHERE id = ?", (message_id,))
+        self._put("DELETE FROM reactions WHERE message_id = ?", (message_id,))
+
+    def save_private_message(self, conversation_key: str, message: Dict[str, Any]):
+        self._put("INSERT INTO private_messages (conversation, data) VALUES (?, ?)",
+                  (conversation_key, json.dumps(message)))
+
+    def save_reactions(self, message_id: str, reactions: Dict[str, List[str]]):
+        if reactions:
+            self._put("INSERT OR REPLACE INTO reactions (message_id, data) VALUES (?, ?)",
+                      (message_id, json.dumps(reactions)))
+        else:
+            self._put("DELETE FROM reactions WHERE message_id = ?", (message_id,))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'backend': self.name,
+            'path': self.path,
+            'pending': self._queue.qsize(),
+            'written': self.written,
+            'batches': self.batches,
+            'errors': self.errors,
+        }
+
+    def close(self):
+        """Flush everything still queued and stop the writer"""
+        if self._writer is None:
+            return
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._writer = None
+
+    def _put(self, sql: str, params: tuple):
+        self._queue.put((sql, params))
+
+    def _start_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name='sqlite-writer', daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        connection = self._connect()
+        stopping = False
+        while not stopping:
+            operation = self._queue.get()
+            if operation is _STOP:
+                break
+            batch = [operation]
+            # Give bursts a moment to pile up, then take whatever is queued
+            time.sleep(self.flush_interval)
+            while len(batch) < self.batch_size:
+                try:
+                    operation = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if operation is _STOP:
+                    stopping = True
+                    break
+                batch.append(operation)
+            self._write_batch(connection, batch)
+        connection.close()
+
+    def _write_batch(self, connection: sqlite3.Connection, batch: List[Tuple[str, tuple]]):
+        try:
+            with connection:
+                for sql, params in batch:
+                    connection.execute(sql, params)
+            self.written += len(batch)
+            self.batches += 1
+        except sqlite3.Error as e:
+            self.errors += 1
+            log.error('sqlite_write_failed', dropped=len(batch), error=str(e))
+
+
+def create_storage(backend: str, sqlite_path: str) -> MemoryStorage:
+    if backend == 'sqlite':
+        return SQLiteStorage(sqlite_path)
+    if backend != 'memory':
+        raise ValueError(f"Unknown storage backend: {backend}")
+    return MemoryStorage()
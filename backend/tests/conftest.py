@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# The server modules are imported by plain name, as main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def server(tmp_path_factory, monkeypatch):
+    """main, with 'sid1' (alice) in room 'lobby'"""
+    # main.py creates its upload directory in the working directory
+    monkeypatch.chdir(tmp_path_factory.getbasetemp())
+    import main
+    main.state.put('users', 'sid1', {'username': 'alice', 'room': 'lobby'})
+    yield main
+    main.state.delete('users', 'sid1')
@@ -0,0 +1,129 @@
+import asyncio
+import base64
+import json
+import os
+import socket
+
+import socketio
+import uvicorn
+
+from backpressure import OutboundGuard, WebSocketTransports
+from bus import LocalClientManager
+
+
+def frame(text):
+    """A masked websocket text frame, as a client sends it"""
+    data = text.encode()
+    mask = os.urandom(4)
+    header = bytes([0x81])
+    if len(data) < 126:
+        header += bytes([0x80 | len(data)])
+    else:
+        header += bytes([0x80 | 126]) + len(data).to_bytes(2, 'big')
+    return header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(data))
+
+
+async def stalled_client(port):
+    """Connect over websocket, join room 'r', then never read again"""
+    conn = socket.socket()
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    conn.setblocking(False)
+    loop = asyncio.get_running_loop()
+    await loop.sock_connect(conn, ('127.0.0.1', port))
+    key = base64.b64encode(os.urandom(16)).decode()
+    await loop.sock_sendall(conn, (
+        'GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\nHost: test\r\n'
+        'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+        f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n').encode())
+    await loop.sock_recv(conn, 65536)
+    await loop.sock_sendall(conn, frame('40'))
+    await loop.sock_sendall(conn, frame('42' + json.dumps(['join', 'r'])))
+    return conn
+
+
+async def until(condition, timeout=10.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.05)
+
+
+def make_server():
+    """A Socket.IO server guarded like main's, with low limits"""
+    sio = socketio.AsyncServer(async_mode='asgi', client_manager=LocalClientManager())
+    guard = OutboundGuard(sio, high_water=20, hard_limit=100, tick=0.05, close_timeout=0.2)
+    sio.manager.outbound = guard
+    guard.transports = WebSocketTransports(socketio.ASGIApp(sio))
+    disconnected = []
+
+    @sio.event
+    async def join(sid, room):
+        await sio.enter_room(sid, room)
+
+    @sio.event
+    async def disconnect(sid):
+        disconnected.append(sid)
+
+    return sio, guard, disconnected
+
+
+async def serve(sio):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    config = uvicorn.Config(sio.manager.outbound.transports, log_level='warning', lifespan='off')
+    server = uvicorn.Server(config)
+    task = asyncio.ensure_future(server.serve(sockets=[sock]))
+    await until(lambda: server.started)
+    return server, task, sock.getsockname()[1]
+
+
+def test_client_that_never_reads_is_disconnected():
+    async def scenario():
+        sio, guard, disconnected = make_server()
+        server, task, port = await serve(sio)
+        conn = await stalled_client(port)
+        try:
+            await until(lambda: sio.manager.has_members('/', 'r'))
+            for _ in range(guard.hard_limit * 2):
+                await sio.emit('message', {'content': 'x' * 65536}, room='r')
+                await asyncio.sleep(0)
+            await until(lambda: disconnected)
+            assert guard.disconnected == 1
+            assert not sio.manager.has_members('/', 'r')
+            # its websocket is closed at once; the session and its queue go
+            # once the server gives up on the close handshake (websockets
+            # waits up to twice its 10s close timeout)
+            await until(lambda: not guard.transports._sends, timeout=1)
+            await until(lambda: not sio.eio.sockets, timeout=30)
+            assert guard.stats()['deepest_queue'] == 0
+        finally:
+            conn.close()
+            server.should_exit = True
+            await task
+
+    asyncio.run(scenario())
+
+
+def test_collapsible_events_wait_for_a_slow_client():
+    async def scenario():
+        sio, guard, disconnected = make_server()
+        server, task, port = await serve(sio)
+        conn = await stalled_client(port)
+        try:
+            await until(lambda: sio.manager.has_members('/', 'r'))
+            eio_sid = next(iter(sio.eio.sockets))
+            while guard.depth(eio_sid) < guard.high_water:
+                await sio.emit('message', {'content': 'x' * 65536}, room='r')
+            depth = guard.depth(eio_sid)
+            for count in range(50):
+                await sio.emit('room_users', {'room': 'r', 'users': list(range(count))}, room='r')
+            assert guard.depth(eio_sid) <= depth
+            assert guard.collapsed == 50
+            assert len(guard._deferred[eio_sid]) == 1
+            assert not disconnected
+        finally:
+            conn.close()
+            server.should_exit = True
+            await task
+
+    asyncio.run(scenario())
@@ -0,0 +1,91 @@
+from history import HistoryStore, MessageIdGenerator, RoomHistory
+
+
+def message(message_id, room='lobby'):
+    return {'id': message_id, 'room': room, 'content': f"message {message_id}"}
+
+
+def fill(store, room, count, start=0, now=0.0):
+    for number in range(start, start + count):
+        store.append(room, message(f"{number:06d}", room), now=now)
+
+
+def ids(messages):
+    return [entry['id'] for entry in messages]
+
+
+def test_ids_sort_in_creation_order():
+    generator = MessageIdGenerator()
+    generated = [generator.next() for _ in range(1000)]
+    assert generated == sorted(generated)
+    assert len(set(generated)) == len(generated)
+
+
+def test_ids_keep_counting_when_clock_goes_back(monkeypatch):
+    generator = MessageIdGenerator(suffix='-a')
+    monkeypatch.setattr('history.time.time', lambda: 2000.0)
+    first = generator.next()
+    monkeypatch.setattr('history.time.time', lambda: 1000.0)
+    second = generator.next()
+    assert first < second
+    assert second.endswith('-a')
+
+
+def test_room_cap_evicts_oldest():
+    evicted = []
+    store = HistoryStore(max_per_room=3, max_total=100)
+    store.add_listener(lambda entry, reason: evicted.append((entry['id'], reason)))
+    fill(store, 'lobby', 5)
+    assert ids(store.recent('lobby', 10)) == ['000002', '000003', '000004']
+    assert evicted == [('000000', 'evicted'), ('000001', 'evicted')]
+    assert '000000' not in store
+
+
+def test_global_cap_evicts_oldest_across_rooms():
+    store = HistoryStore(max_per_room=10, max_total=4)
+    fill(store, 'a', 2, start=0)
+    fill(store, 'b', 3, start=2)
+    assert len(store) == 4
+    assert ids(store.recent('a', 10)) == ['000001']
+    assert ids(store.recent('b', 10)) == ['000002', '000003', '000004']
+
+
+def test_max_age_expires_messages():
+    store = HistoryStore(max_per_room=10, max_total=100, max_age=60)
+    fill(store, 'lobby', 2, now=0.0)
+    fill(store, 'lobby', 1, start=2, now=50.0)
+    assert store.expire(now=100.0) == 2
+    assert ids(store.recent('lobby', 10)) == ['000002']
+    assert store.expire(now=200.0) == 1
+    assert store.room('lobby') is None
+
+
+def test_delete_leaves_tombstone_that_is_skipped():
+    store = HistoryStore(max_per_room=10, max_total=100)
+    fill(store, 'lobby', 4)
+    assert store.delete('000001')['id'] == '000001'
+    assert store.delete('000001') is None
+    assert ids(store.recent('lobby', 10)) == ['000000', '000002', '000003']
+    assert store.get('000001') is None
+
+
+def test_tombstones_are_compacted():
+    count = RoomHistory.COMPACT_MIN_SLOTS * 2
+    store = HistoryStore(max_per_room=count, max_total=count)
+    fill(store, 'lobby', count)
+    for number in range(0, count, 2):
+        store.delete(f"{number:06d}")
+    history = store.room('lobby')
+    # Half the ring died, so it was rebuilt without the tombstones
+    assert len(history._ids) < count
+    assert history._tombstones == len(history._ids) - len(history)
+    assert ids(history.messages()) == [f"{number:06d}" for number in range(1, count, 2)]
+
+
+def test_update_tracks_size_of_edited_message():
+    store = HistoryStore()
+    fill(store, 'lobby', 1)
+    before = store.stats()['bytes']
+    store.get('000000')['content'] = 'x' * 1000
+    store.update('000000')
+    assert store.stats()['bytes'] > before
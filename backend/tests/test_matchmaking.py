@@ -0,0 +1,92 @@
+import random
+
+from matchmaking import BatchMatcher, Matchmaker, QueueEntry, TrendingInterests
+
+
+def test_candidates_in_queue_order_interests_first():
+    matchmaker = Matchmaker()
+    matchmaker.add('plain', [], 't1')
+    matchmaker.add('music', ['music'], 't2')
+    matchmaker.add('both', ['music', 'games'], 't3')
+    assert list(matchmaker.candidates(['games'])) == ['both', 'plain']
+    assert list(matchmaker.candidates(['music'])) == ['music', 'both', 'plain']
+    assert list(matchmaker.candidates([])) == ['plain']
+    assert matchmaker.depths() == {'general': 1, 'music': 2, 'games': 1}
+
+
+def test_cancel_leaves_every_queue_at_once():
+    matchmaker = Matchmaker()
+    matchmaker.add('a', ['music', 'games'], 't1')
+    matchmaker.add('b', ['music'], 't2')
+    assert matchmaker.remove('a')
+    assert not matchmaker.remove('a')
+    assert 'a' not in matchmaker
+    assert list(matchmaker.candidates(['games', 'music'])) == ['b']
+    # The games queue had nobody else and is gone
+    assert matchmaker.depths() == {'music': 1}
+
+
+def test_requeue_replaces_entry_and_token():
+    matchmaker = Matchmaker()
+    matchmaker.add('a', ['music'], 't1')
+    matchmaker.add('a', [], 't2')
+    assert matchmaker.token('a') == 't2'
+    assert matchmaker.interests('a') == []
+    assert list(matchmaker.candidates(['music'])) == ['a']
+    assert len(matchmaker) == 1
+
+
+def test_dead_entries_are_skipped_and_swept():
+    matchmaker = Matchmaker()
+    matchmaker.add('keep', [], 'keep')
+    for number in range(Matchmaker.COMPACT_MIN_STALE * 3):
+        matchmaker.add(f"s{number}", [], str(number))
+    for number in range(Matchmaker.COMPACT_MIN_STALE * 3):
+        matchmaker.remove(f"s{number}")
+    assert list(matchmaker.candidates([])) == ['keep']
+    assert len(matchmaker._queues['']) < Matchmaker.COMPACT_MIN_STALE
+    assert matchmaker._stale <= Matchmaker.COMPACT_MIN_STALE
+
+
+def test_candidates_skip_entries_cancelled_while_iterating():
+    matchmaker = Matchmaker()
+    for sid in ('a', 'b', 'c'):
+        matchmaker.add(sid, [], sid)
+    seen = []
+    for sid in matchmaker.candidates([]):
+        seen.append(sid)
+        matchmaker.remove('b')
+    assert seen == ['a', 'c']
+
+
+def entry(sid, interests, queued_at=0.0):
+    queued = QueueEntry(sid, tuple(interests), sid)
+    queued.queued_at = queued_at
+    return queued
+
+
+def test_batch_pairs_by_overlap():
+    matcher = BatchMatcher(random_after=5.0, rng=random.Random(1))
+    pool = [entry('a', ['music', 'games']), entry('b', ['music']),
+            entry('c', ['music', 'games']), entry('d', ['art'])]
+    pairs = matcher.plan(pool, now=1.0)
+    assert ('a', 'c') in pairs
+    assert all('d' not in pair for pair in pairs)
+
+
+def test_batch_pairs_at_random_after_waiting():
+    matcher = BatchMatcher(random_after=5.0, rng=random.Random(1))
+    pool = [entry('a', ['art']), entry('b', ['music']), entry('c', [])]
+    assert matcher.plan(pool, now=1.0) == []
+    pairs = matcher.plan(pool, now=10.0)
+    assert len(pairs) == 1
+    assert sorted(pairs[0]) == ['a', 'b']
+
+
+def test_trending_interests_decay():
+    trending = TrendingInterests(half_life=10.0)
+    origin = trending._origin
+    trending.record(['music', 'games'], now=origin)
+    trending.record(['music'], now=origin + 10)
+    top = trending.top(2, now=origin + 10)
+    assert top == [{'interest': 'music', 'score': 1.5}, {'interest': 'games', 'score': 0.5}]
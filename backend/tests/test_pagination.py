@@ -0,0 +1,66 @@
+from history import HistoryStore
+
+
+def store_with(count, room='lobby'):
+    store = HistoryStore(max_per_room=1000, max_total=1000)
+    for number in range(count):
+        message_id = f"{number:06d}"
+        store.append(room, {'id': message_id, 'room': room}, now=0.0)
+    return store
+
+
+def ids(messages):
+    return [int(entry['id']) for entry in messages]
+
+
+def test_without_cursor_returns_newest_page():
+    page, has_more = store_with(10).page('lobby', 3)
+    assert ids(page) == [7, 8, 9]
+    assert has_more
+
+
+def test_before_pages_backwards_to_the_start():
+    store = store_with(10)
+    page, has_more = store.page('lobby', 4, before='000004')
+    assert ids(page) == [0, 1, 2, 3]
+    assert not has_more
+    page, has_more = store.page('lobby', 2, before='000004')
+    assert ids(page) == [2, 3]
+    assert has_more
+
+
+def test_after_pages_forwards_to_the_end():
+    store = store_with(10)
+    page, has_more = store.page('lobby', 3, after='000005')
+    assert ids(page) == [6, 7, 8]
+    assert has_more
+    page, has_more = store.page('lobby', 3, after='000006')
+    assert ids(page) == [7, 8, 9]
+    assert not has_more
+
+
+def test_cursor_need_not_exist():
+    store = store_with(10)
+    store.delete('000005')
+    page, _ = store.page('lobby', 2, before='000005')
+    assert ids(page) == [3, 4]
+    page, _ = store.page('lobby', 2, after='000005')
+    assert ids(page) == [6, 7]
+    # Ids between existing ones work too
+    page, _ = store.page('lobby', 1, after='0000035')
+    assert ids(page) == [4]
+
+
+def test_deleted_messages_are_skipped_and_not_counted_as_more():
+    store = store_with(6)
+    store.delete('000000')
+    store.delete('000001')
+    page, has_more = store.page('lobby', 2, before='000004')
+    assert ids(page) == [2, 3]
+    assert not has_more
+
+
+def test_unknown_room_and_empty_limit():
+    store = store_with(3)
+    assert store.page('elsewhere', 10) == ([], False)
+    assert store.page('lobby', 0) == ([], False)
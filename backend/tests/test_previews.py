@@ -0,0 +1,64 @@
+import asyncio
+import hashlib
+import wave
+
+from previews import PreviewCache
+from uploads import content_key
+
+KEY = content_key(hashlib.sha256(b'wav').hexdigest(), '.wav')
+
+
+def write_wav(path, seconds=1, rate=8000):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with wave.open(str(path), 'wb') as audio:
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(rate)
+        audio.writeframes(b'\x00\x10' * rate * seconds)
+
+
+def test_audio_preview_is_built_in_a_worker_and_cached(tmp_path):
+    write_wav(tmp_path / KEY)
+    cache = PreviewCache(tmp_path, workers=1)
+
+    async def scenario():
+        cache.start(KEY, 'audio/wav')
+        first = await cache.get(KEY, 'audio/wav')
+        again = await cache.get(KEY, 'audio/wav')
+        return first, again
+
+    try:
+        first, again = asyncio.run(scenario())
+    finally:
+        cache.close()
+    assert first['kind'] == 'audio' and first['duration'] == 1.0
+    assert again == first
+    assert cache.stats()['built'] == 1 and cache.stats()['cache_hits'] == 1
+
+
+def test_file_messages_get_their_preview_pushed(server, monkeypatch):
+    sent = []
+
+    async def emit(event, data=None, **kwargs):
+        sent.append((event, data, kwargs.get('room')))
+
+    async def preview():
+        return {'kind': 'audio', 'duration': 1.0, 'waveform': [1.0]}
+
+    monkeypatch.setattr(server.sio, 'emit', emit)
+    monkeypatch.setattr(server.previews, 'get', lambda key, content_type='': asyncio.ensure_future(preview()))
+    file_info = server.make_file_info(KEY, 'hi.wav', 'audio/wav', 16000)
+
+    async def scenario():
+        await server.send_file_message('sid1', {'file': file_info})
+        await asyncio.gather(*server.background_tasks)
+
+    asyncio.run(scenario())
+    (message,), _ = server.message_history.page('lobby', 1)
+    try:
+        assert 'preview' not in file_info
+        assert message['file']['duration'] == 1.0
+        pushed = [(data, room) for event, data, room in sent if event == 'file_preview']
+        assert pushed == [({'messageId': message['id'], 'room': 'lobby', 'file': message['file']}, 'lobby')]
+    finally:
+        server.message_history.delete(message['id'])
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+import ratelimit
+from ratelimit import RateLimiter, parse_limits
+
+CLASSES = {'send_message': 'message', 'end_video_call': 'teardown'}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_parse_limits_overrides_defaults():
+    limits = parse_limits('message=1:3, typing=2,,', {'message': (5, 10), 'default': (10, 20)})
+    assert limits == {'message': (1.0, 3.0), 'typing': (2.0, 2.0), 'default': (10, 20)}
+
+
+def test_burst_then_refill(clock):
+    limiter = RateLimiter({'message': (2, 3)}, CLASSES)
+    assert [limiter.allow('a', 'send_message') for _ in range(4)] == [True, True, True, False]
+    assert limiter.retry_after('a', 'send_message') == pytest.approx(0.5)
+    clock[0] += 0.25
+    assert not limiter.allow('a', 'send_message')
+    clock[0] += 0.25
+    assert limiter.allow('a', 'send_message')
+    # Refill stops at the burst size
+    clock[0] += 100
+    assert [limiter.allow('a', 'send_message') for _ in range(4)] == [True, True, True, False]
+    assert limiter.stats()['throttled'] == 3
+
+
+def test_buckets_are_per_connection_and_class(clock):
+    limiter = RateLimiter({'message': (1, 1), 'teardown': (1, 1), 'default': (1, 1)}, CLASSES)
+    assert limiter.allow('a', 'send_message')
+    assert not limiter.allow('a', 'send_message')
+    assert limiter.allow('b', 'send_message')
+    assert limiter.allow('a', 'end_video_call')
+    # Events without a class share the default bucket
+    assert limiter.allow('a', 'ping')
+    assert not limiter.allow('a', 'pong')
+
+
+def test_zero_rate_and_unknown_class_are_unlimited(clock):
+    limiter = RateLimiter({'message': (0, 0)}, CLASSES)
+    assert all(limiter.allow('a', 'send_message') for _ in range(100))
+    assert all(limiter.allow('a', 'end_video_call') for _ in range(100))
+    assert limiter.retry_after('a', 'send_message') == 0.0
+    assert limiter.stats()['buckets'] == 0
+
+
+def test_discard_forgets_a_connection(clock):
+    limiter = RateLimiter({'message': (1, 1)}, CLASSES)
+    limiter.allow('a', 'send_message')
+    limiter.discard('a')
+    assert limiter.stats()['buckets'] == 0
+    assert limiter.allow('a', 'send_message')
+
+
+def test_notice_once_per_wait(clock):
+    limiter = RateLimiter({'message': (2, 1)}, CLASSES)
+    assert limiter.allow('a', 'send_message')
+    notices = [limiter.notice('a', 'send_message')
+               for _ in range(100) if not limiter.allow('a', 'send_message')]
+    assert notices[0] == pytest.approx(0.5)
+    assert notices[1:] == [None] * 99
+    clock[0] += 0.5
+    assert limiter.allow('a', 'send_message')
+    assert not limiter.allow('a', 'send_message')
+    assert limiter.notice('a', 'send_message') == pytest.approx(0.5)
+
+
+def test_a_flood_gets_a_single_throttled_ack(server, monkeypatch):
+    sent = []
+
+    async def emit(event, data=None, **kwargs):
+        sent.append((event, data))
+
+    monkeypatch.setattr(server.sio, 'emit', emit)
+    monkeypatch.setattr(server.rate_limiter, 'limits', {'message': (0.001, 1)})
+    handler = server.sio.handlers['/']['send_message']
+    try:
+        for _ in range(50):
+            asyncio.run(handler('sid1', {'message': 'spam'}))
+        throttled = [data for event, data in sent if event == 'throttled']
+        assert len(throttled) == 1 and throttled[0]['event'] == 'send_message'
+    finally:
+        server.rate_limiter.discard('sid1')
+        (message,), _ = server.message_history.page('lobby', 1)
+        server.message_history.delete(message['id'])
@@ -0,0 +1,56 @@
+import asyncio
+
+from reactions import ReactionIndex
+
+
+def test_set_replaces_and_remove_reports_deltas():
+    index = ReactionIndex()
+    assert index.set('m1', 'alice', '👍') == [('👍', 1, 1)]
+    assert index.set('m1', 'alice', '👍') == []
+    assert index.set('m1', 'alice', '❤️') == [('👍', -1, 0), ('❤️', 1, 1)]
+    assert index.remove('m1', 'alice', '👍') == []
+    assert index.remove('m1', 'alice', '❤️') == [('❤️', -1, 0)]
+    assert 'm1' not in index
+    assert index.stats() == {'messages': 0, 'reactions': 0}
+
+
+def test_summary_and_user_pages():
+    index = ReactionIndex()
+    for user in ('a', 'b', 'c'):
+        index.set('m1', user, '👍')
+    index.set('m1', 'd', '🎉')
+    assert index.summary('m1', inline=2) == [{'emoji': '👍', 'count': 3},
+                                              {'emoji': '🎉', 'count': 1, 'users': ['d']}]
+    assert index.users('m1', '👍', 1, 5) == (['b', 'c'], 3)
+    index.discard('m1')
+    assert index.choice('m1', 'a') is None
+
+
+def test_reactions_need_a_message_in_history(server):
+    message_id = server.message_ids.next()
+    server.message_history.append('lobby', {'id': message_id, 'room': 'lobby', 'content': 'hi'})
+    try:
+        for data in ({'messageId': 'made-up', 'emoji': '👍', 'room': 'lobby'},
+                     {'messageId': message_id, 'emoji': '👍', 'room': 'elsewhere'}):
+            asyncio.run(server.add_reaction('sid1', data))
+        assert 'made-up' not in server.message_reactions
+        assert message_id not in server.message_reactions
+
+        asyncio.run(server.add_reaction('sid1', {'messageId': message_id, 'emoji': '👍', 'room': 'lobby'}))
+        assert server.message_reactions.lists(message_id) == {'👍': ['alice']}
+    finally:
+        server.message_history.delete(message_id)
+    # Leaving history takes the reactions along
+    assert message_id not in server.message_reactions
+
+
+def test_replies_can_have_reactions(server):
+    asyncio.run(server.send_reply('sid1', {'replyToId': 'm0', 'replyToUsername': 'bob',
+                                            'replyToContent': 'hello', 'message': 'hi bob'}))
+    (reply,), _ = server.message_history.page('lobby', 1)
+    try:
+        assert reply['content'] == 'hi bob' and reply['replyTo']['messageId'] == 'm0'
+        asyncio.run(server.add_reaction('sid1', {'messageId': reply['id'], 'emoji': '🎉', 'room': 'lobby'}))
+        assert server.message_reactions.lists(reply['id']) == {'🎉': ['alice']}
+    finally:
+        server.message_history.delete(reply['id'])
@@ -0,0 +1,81 @@
+import asyncio
+import hashlib
+import os
+import time
+
+from retention import UploadCollector
+from uploads import FILE_OPS, UploadStore, content_key
+
+
+def put(store, name, size, age):
+    """A stored file of `size` bytes last used `age` seconds ago"""
+    key = content_key(hashlib.sha256(name.encode()).hexdigest(), '.bin')
+    path = store.path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'x' * size)
+    used = time.time() - age
+    os.utime(path, (used, used))
+    return key
+
+
+def use(store, key, message_id):
+    store.reference({'id': message_id, 'file': {'unique_filename': key}})
+
+
+def collect_until_settled(collector):
+    async def passes():
+        while await collector.collect():
+            pass
+    asyncio.run(passes())
+    FILE_OPS.submit(lambda: None).result()
+
+
+def existing(store, keys):
+    return {key for key in keys if store.path(key).exists()}
+
+
+def collector_for(tmp_path, quota):
+    store = UploadStore(tmp_path, fresh_grace=0.0)
+    return store, UploadCollector(store, orphan_grace=10 ** 9, quota=quota)
+
+
+def test_quota_evicts_unreferenced_files_first(tmp_path):
+    store, collector = collector_for(tmp_path, quota=3000)
+    in_use = put(store, 'in use', 1000, age=50000)
+    use(store, in_use, 'm1')
+    unused = [put(store, f"unused {number}", 1000, age=1000 * (number + 1)) for number in range(3)]
+    collect_until_settled(collector)
+
+    # Down to 90% of the quota by dropping the oldest unused files, even
+    # though the file in use is older still
+    assert existing(store, [in_use] + unused) == {in_use, unused[0]}
+    assert store.references(in_use) == 1
+    assert collector.stats()['evicted_referenced'] == 0
+
+
+def test_referenced_files_go_once_no_orphans_remain(tmp_path):
+    store, collector = collector_for(tmp_path, quota=1500)
+    flagged = []
+    store.add_eviction_listener(lambda key, message_ids: flagged.append((key, message_ids)))
+    old = put(store, 'old', 1000, age=50000)
+    recent = put(store, 'recent', 1000, age=100)
+    unused = put(store, 'unused', 1000, age=10)
+    use(store, old, 'm1')
+    use(store, old, 'm2')
+    use(store, recent, 'm3')
+    collect_until_settled(collector)
+
+    assert existing(store, [old, recent, unused]) == {recent}
+    assert flagged == [(old, {'m1', 'm2'})]
+    # The evicted file is no longer counted as used
+    assert store.references(old) == 0
+    assert store.references(recent) == 1
+    assert collector.stats()['evicted_referenced'] == 1
+
+
+def test_under_quota_nothing_is_evicted(tmp_path):
+    store, collector = collector_for(tmp_path, quota=10000)
+    keys = [put(store, f"file {number}", 1000, age=100) for number in range(3)]
+    collect_until_settled(collector)
+    assert existing(store, keys) == set(keys)
+    assert collector.stats()['bytes'] == 3000
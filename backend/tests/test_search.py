@@ -0,0 +1,77 @@
+import search
+from search import SearchIndex, tokenize
+
+
+def message(number, content, room='lobby'):
+    return {'id': f"{number:06d}", 'room': room, 'content': content}
+
+
+def index_with(*contents):
+    index = SearchIndex()
+    for number, content in enumerate(contents):
+        index.add('lobby', message(number, content))
+    return index
+
+
+def test_tokenize_lowercases_and_deduplicates():
+    assert tokenize('Hello hello, World!') == ['hello', 'world']
+
+
+def test_every_term_matches_as_prefix_newest_first():
+    index = index_with('hello world', 'help me', 'world peace', 'hello there')
+    assert index.search('lobby', 'hel', 10) == (['000003', '000001', '000000'], None, False)
+    assert index.search('lobby', 'hel wor', 10) == (['000000'], None, False)
+    assert index.search('lobby', 'nothing', 10) == ([], None, False)
+    assert index.search('elsewhere', 'hel', 10) == ([], None, False)
+
+
+def test_pages_with_before_cursor():
+    index = index_with(*(f"note {number}" for number in range(5)))
+    first, cursor, _ = index.search('lobby', 'note', 2)
+    assert first == ['000004', '000003']
+    second, cursor, _ = index.search('lobby', 'note', 2, before=cursor)
+    assert second == ['000002', '000001']
+    third, cursor, _ = index.search('lobby', 'note', 2, before=cursor)
+    assert third == ['000000']
+    assert cursor is None
+
+
+def test_edit_reindexes_in_place():
+    index = index_with('apple pie', 'banana split')
+    index.update(message(0, 'cherry pie'))
+    assert index.search('lobby', 'apple', 10)[0] == []
+    assert index.search('lobby', 'cherry', 10)[0] == ['000000']
+    assert index.search('lobby', 'pie', 10)[0] == ['000000']
+    # Re-adding an indexed message is an edit too
+    index.add('lobby', message(1, 'banana bread'))
+    assert index.search('lobby', 'split', 10)[0] == []
+    assert index.stats()['messages'] == 2
+
+
+def test_delete_and_compaction():
+    index = index_with(*(f"word{number} common" for number in range(10)))
+    for number in range(6):
+        index.remove(f"{number:06d}")
+    assert index.search('lobby', 'common', 10)[0] == ['000009', '000008', '000007', '000006']
+    room = index._rooms['lobby']
+    # Garbage outweighed the live postings, so the room was rebuilt
+    assert room.dead_postings == 0
+    assert 'word0' not in room.postings
+
+
+def test_budget_evicts_oldest_messages():
+    index = SearchIndex(max_postings=4)
+    for number in range(3):
+        index.add('lobby', message(number, f"one{number} two{number}"))
+    assert index.stats()['postings'] <= 4
+    assert index.search('lobby', 'one0', 10)[0] == []
+    assert index.search('lobby', 'one2', 10)[0] == ['000002']
+
+
+def test_short_prefix_reports_truncation(monkeypatch):
+    monkeypatch.setattr(search, 'MAX_PREFIX_EXPANSION', 3)
+    index = index_with('aa', 'ab', 'ac', 'ad', 'ba')
+    message_ids, _, truncated = index.search('lobby', 'a', 10)
+    assert truncated
+    assert message_ids == ['000002', '000001', '000000']
+    assert index.search('lobby', 'ad', 10) == (['000003'], None, False)
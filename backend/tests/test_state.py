@@ -0,0 +1,277 @@
+import asyncio
+import pickle
+import time
+
+import pytest
+
+from bus import BrokerClientManager, BrokerServer, MemoryBroker, SocketBroker
+from state import LocalState, SharedState
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def eventually(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'condition not reached'
+        await asyncio.sleep(0.01)
+
+
+class Cluster:
+    """Several SharedState nodes on one broker, as separate workers would be"""
+
+    def __init__(self, kind, tmp_path):
+        self.kind = kind
+        self.address = f"unix://{tmp_path}/broker.sock"
+        self.memory = MemoryBroker()
+        self.server = None
+        self.nodes = []
+
+    async def __aenter__(self):
+        if self.kind == 'socket':
+            self.server = asyncio.create_task(BrokerServer().serve(self.address))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for node in self.nodes:
+            for task in node._tasks:
+                task.cancel()
+            await node.broker.close()
+        if self.server is not None:
+            self.server.cancel()
+
+    async def node(self, node_id):
+        broker = self.memory if self.kind == 'memory' else SocketBroker(self.address)
+        node = SharedState(broker, node_id)
+        await node.start()
+        self.nodes.append(node)
+        return node
+
+
+brokers = pytest.mark.parametrize('kind', ['memory', 'socket'])
+
+
+def test_local_state_tracks_rooms_and_matches():
+    state = LocalState()
+    changes = []
+    state.on_room_change(lambda room, sid, joined: changes.append((room, sid, joined)))
+    state.join_room('lobby', 'a')
+    state.join_room('lobby', 'a')
+    state.leave_room('lobby', 'a')
+    assert changes == [('lobby', 'a', True), ('lobby', 'a', False)]
+    assert 'lobby' not in state.room_users
+
+    async def match():
+        state.put('strangers', 'x', {})
+        state.put('strangers', 'y', {})
+        state.enqueue_stranger('x', [])
+        assert await state.take_stranger('x', []) is None
+        return await state.take_stranger('y', [])
+
+    assert run(match()) == 'x'
+    assert 'x' not in state.stranger_chat.matchmaker
+
+
+@brokers
+def test_room_joins_and_leaves_replicate(kind, tmp_path):
+    async def scenario():
+        async with Cluster(kind, tmp_path) as cluster:
+            a = await cluster.node('a')
+            b = await cluster.node('b')
+            a.put('users', 'sid1', {'username': 'alice', 'room': None})
+            a.join_room('lobby', 'sid1')
+            b.join_room('lobby', 'sid2')
+            await eventually(lambda: set(b.room_users.get('lobby', ())) == {'sid1', 'sid2'})
+            await eventually(lambda: set(a.room_users.get('lobby', ())) == {'sid1', 'sid2'})
+            assert b.active_users['sid1']['username'] == 'alice'
+
+            a.leave_room('lobby', 'sid1')
+            await eventually(lambda: list(b.room_users['lobby']) == ['sid2'])
+            b.leave_room('lobby', 'sid2')
+            await eventually(lambda: 'lobby' not in a.room_users)
+
+    run(scenario())
+
+
+@brokers
+def test_late_node_gets_a_snapshot(kind, tmp_path):
+    async def scenario():
+        async with Cluster(kind, tmp_path) as cluster:
+            a = await cluster.node('a')
+            a.put('users', 'sid1', {'username': 'alice'})
+            a.join_room('lobby', 'sid1')
+            await asyncio.sleep(0.05)
+            b = await cluster.node('b')
+            await eventually(lambda: 'sid1' in b.room_users.get('lobby', ()))
+
+    run(scenario())
+
+
+@brokers
+def test_a_waiting_stranger_is_claimed_once(kind, tmp_path):
+    async def scenario():
+        async with Cluster(kind, tmp_path) as cluster:
+            nodes = [await cluster.node(name) for name in ('a', 'b', 'c')]
+            owner, first, second = nodes
+            owner.put('strangers', 'waiting', {'interests': []})
+            owner.enqueue_stranger('waiting', [])
+            first.put('strangers', 'searcher1', {'interests': []})
+            second.put('strangers', 'searcher2', {'interests': []})
+            await eventually(lambda: all('waiting' in node.stranger_chat.matchmaker
+                                         and 'searcher1' in node.stranger_chat.stranger_users
+                                         and 'searcher2' in node.stranger_chat.stranger_users
+                                         for node in nodes))
+            taken = await asyncio.gather(first.take_stranger('searcher1', []),
+                                         second.take_stranger('searcher2', []))
+            assert sorted(taken, key=str) == [None, 'waiting']
+            await eventually(lambda: all('waiting' not in node.stranger_chat.matchmaker
+                                         for node in nodes))
+
+    run(scenario())
+
+
+@brokers
+def test_entries_of_a_silent_node_are_dropped(kind, tmp_path, monkeypatch):
+    monkeypatch.setattr(SharedState, 'HEARTBEAT_INTERVAL', 0.05)
+    monkeypatch.setattr(SharedState, 'NODE_TIMEOUT', 0.3)
+
+    async def scenario():
+        async with Cluster(kind, tmp_path) as cluster:
+            a = await cluster.node('a')
+            b = await cluster.node('b')
+            lost = []
+
+            async def on_lost(sids, rooms):
+                lost.append((sids, rooms))
+
+            a.on_lost(on_lost)
+            b.put('users', 'sid2', {'username': 'bob'})
+            b.put('strangers', 'sid3', {'interests': []})
+            b.enqueue_stranger('sid3', [])
+            b.join_room('lobby', 'sid2')
+            a.join_room('lobby', 'sid1')
+            await eventually(lambda: 'sid2' in a.room_users.get('lobby', ())
+                             and 'sid3' in a.stranger_chat.matchmaker)
+
+            # The node dies without saying goodbye
+            for task in b._tasks:
+                task.cancel()
+            await eventually(lambda: lost, timeout=5.0)
+            assert lost == [({'sid2', 'sid3'}, {'lobby'})]
+            assert list(a.room_users['lobby']) == ['sid1']
+            assert 'sid2' not in a.active_users
+            assert 'sid3' not in a.stranger_chat.matchmaker
+            assert 'b' not in a.stats()['nodes']
+
+    run(scenario())
+
+
+def test_broker_with_a_secret_drops_clients_without_it(tmp_path):
+    address = f"unix://{tmp_path}/broker.sock"
+
+    async def scenario():
+        server = asyncio.create_task(BrokerServer('s3cret').serve(address))
+        good, bad = SocketBroker(address, 's3cret'), SocketBroker(address, 'guess')
+        try:
+            subscription = await good.subscribe('news')
+            await bad.publish('news', b'forged')
+            await good.publish('news', b'real')
+            assert await asyncio.wait_for(subscription.__anext__(), 1.0) == b'real'
+            await eventually(lambda: bad._read_task.done())
+        finally:
+            await good.close()
+            await bad.close()
+            server.cancel()
+
+    run(scenario())
+
+
+def test_reachable_broker_needs_a_secret():
+    with pytest.raises(ValueError):
+        run(BrokerServer().serve('tcp://0.0.0.0:0'))
+
+
+def test_client_manager_only_accepts_json():
+    async def scenario():
+        broker = MemoryBroker()
+        manager = BrokerClientManager(broker)
+        messages = manager._listen()
+        first = asyncio.ensure_future(messages.__anext__())
+        await asyncio.sleep(0)
+        await broker.publish('socketio', pickle.dumps({'method': 'emit'}))
+        await broker.publish('socketio', b'{"method": "emit", "event": "hi"}')
+        assert await asyncio.wait_for(first, 1.0) == {'method': 'emit', 'event': 'hi'}
+        await messages.aclose()
+
+    run(scenario())
+
+
+def test_claims_fail_when_the_broker_does_not_answer(tmp_path, monkeypatch):
+    monkeypatch.setattr(SocketBroker, 'CLAIM_TIMEOUT', 0.2)
+    path = tmp_path / 'mute.sock'
+
+    async def scenario():
+        connections = []
+
+        async def mute(reader, writer):
+            connections.append(writer)
+            await reader.read()
+
+        server = await asyncio.start_unix_server(mute, str(path))
+        broker = SocketBroker(f"unix://{path}")
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await broker.claim('k', 'a', 1.0)
+            claim = asyncio.ensure_future(broker.claim('k', 'a', 1.0))
+            await eventually(lambda: broker._pending)
+            connections[0].close()
+            with pytest.raises(ConnectionError):
+                await claim
+        finally:
+            await broker.close()
+            server.close()
+
+    run(scenario())
+
+
+def test_socket_broker_reconnects_and_resubscribes(tmp_path, monkeypatch):
+    monkeypatch.setattr(SharedState, 'HEARTBEAT_INTERVAL', 0.05)
+
+    async def scenario():
+        async with Cluster('socket', tmp_path) as cluster:
+            a = await cluster.node('a')
+            b = await cluster.node('b')
+            a.put('users', 'sid1', {'username': 'alice'})
+            await eventually(lambda: 'sid1' in b.active_users)
+
+            a.broker._writer.transport.abort()
+            await eventually(lambda: a.broker._writer is not None and not a.broker._read_task.done())
+            # Subscribed again once b's heartbeats come through
+            received = a.received
+            await eventually(lambda: a.received > received)
+            b.join_room('lobby', 'sid2')
+            await eventually(lambda: 'sid2' in a.room_users.get('lobby', ()))
+
+            b.put('strangers', 'waiting', {'interests': []})
+            b.enqueue_stranger('waiting', [])
+            a.put('strangers', 'searcher', {'interests': []})
+            await eventually(lambda: 'waiting' in a.stranger_chat.matchmaker)
+            assert await a.take_stranger('searcher', []) == 'waiting'
+
+    run(scenario())
+
+
+def test_a_failed_claim_leaves_the_searcher_waiting():
+    class Unreachable(MemoryBroker):
+        async def claim(self, key, owner, ttl):
+            raise ConnectionError('broker connection lost')
+
+    async def scenario():
+        state = SharedState(Unreachable(), 'a')
+        state.put('strangers', 'x', {})
+        state.enqueue_stranger('x', [])
+        return await state.take_stranger('y', [])
+
+    assert run(scenario()) is None
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from uploads import FILE_OPS, UploadError, UploadStore, content_key, file_key, receive_file
+
+SHA = hashlib.sha256(b'hello').hexdigest()
+KEY = content_key(SHA, '.txt')
+
+
+def settle():
+    """Wait for queued moves and deletions"""
+    FILE_OPS.submit(lambda: None).result()
+
+
+def stored(tmp_path, fresh_grace=0.0):
+    store = UploadStore(tmp_path, fresh_grace=fresh_grace)
+    source = tmp_path / 'upload.part'
+    source.write_bytes(b'hello')
+    key, existed = asyncio.run(store.add(source, SHA, '.txt'))
+    assert (key, existed) == (KEY, False)
+    return store
+
+
+def message(message_id, key=KEY):
+    return {'id': message_id, 'file': {'unique_filename': key}}
+
+
+def test_content_keys():
+    assert KEY == f"{SHA[:2]}/{SHA[2:4]}/{SHA}.txt"
+    assert content_key(SHA, '.not allowed') == f"{SHA[:2]}/{SHA[2:4]}/{SHA}"
+    assert file_key(message('m1')) == KEY
+    assert file_key(message('m1', key='../../etc/passwd')) is None
+    assert file_key({'id': 'm1'}) is None
+
+
+def test_identical_uploads_share_a_file(tmp_path):
+    store = stored(tmp_path)
+    again = tmp_path / 'again.part'
+    again.write_bytes(b'hello')
+    assert asyncio.run(store.add(again, SHA, '.txt')) == (KEY, True)
+    assert not again.exists()
+    assert store.stats()['deduplicated'] == 1
+
+
+def test_file_is_deleted_with_its_last_message(tmp_path):
+    store = stored(tmp_path)
+    deleted = []
+    store.add_listener(deleted.append)
+    store.reference(message('m1'))
+    store.reference(message('m2'))
+    store.reference(message('m2'))
+    assert store.references(KEY) == 2
+
+    store.release(message('m1'))
+    settle()
+    assert store.path(KEY).exists()
+    store.release(message('m2'))
+    settle()
+    assert not store.path(KEY).exists()
+    assert deleted == [KEY]
+    assert store.references(KEY) == 0
+    # Releasing again is harmless
+    store.release(message('m2'))
+    assert store.stats()['deleted'] == 1
+
+
+def test_fresh_upload_survives_release(tmp_path):
+    store = stored(tmp_path, fresh_grace=3600.0)
+    store.reference(message('m1'))
+    store.release(message('m1'))
+    settle()
+    assert store.path(KEY).exists()
+    assert store.is_fresh(KEY)
+
+
+def test_messages_without_stored_file_are_ignored(tmp_path):
+    store = stored(tmp_path)
+    store.reference({'id': 'm1', 'content': 'hi'})
+    store.release({'id': 'm1', 'content': 'hi'})
+    assert store.stats()['referenced_files'] == 0
+    assert store.path(KEY).exists()
+
+
+def test_file_messages_page_in_the_order_they_were_sent(server):
+    room = 'lobby'
+    asyncio.run(server.send_message('sid1', {'message': 'one'}))
+    asyncio.run(server.send_file_message('sid1', {'message': 'two', 'file': {'filename': 'a.txt'}}))
+    asyncio.run(server.send_message('sid1', {'message': 'three'}))
+    page, _ = server.message_history.page(room, 3)
+    try:
+        assert [entry['content'] for entry in page] == ['one', 'two', 'three']
+        assert page[1]['type'] == 'file'
+        older, _ = server.message_history.page(room, 3, before=page[2]['id'])
+        assert [entry['content'] for entry in older] == ['one', 'two']
+    finally:
+        for entry in page:
+            server.message_history.delete(entry['id'])
+
+
+def upload_body(*chunks):
+    async def body():
+        for chunk in chunks:
+            yield chunk
+    return body()
+
+
+def test_truncated_upload_is_rejected(tmp_path):
+    headers = {'content-type': 'multipart/form-data; boundary=xyz'}
+    body = (b'--xyz\r\nContent-Disposition: form-data; name="file"; filename="a.txt"\r\n'
+            b'Content-Type: text/plain\r\n\r\nhello')
+
+    part = asyncio.run(receive_file(headers, upload_body(body, b'\r\n--xyz--\r\n'), 'file',
+                                    tmp_path, lambda _: 1024))
+    assert part.filename == 'a.txt'
+    asyncio.run(part.writer.abort())
+
+    for chunks in [(body,), (b'garbage',), (body[:20], b'\x00' * 10)]:
+        with pytest.raises(UploadError) as error:
+            asyncio.run(receive_file(headers, upload_body(*chunks), 'file', tmp_path, lambda _: 1024))
+        assert error.value.status_code == 400
+    assert not list(tmp_path.iterdir())
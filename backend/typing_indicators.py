@@ -0,0 +1,124 @@
+"""Coalesced typing indicators.
+
+Clients report typing_start and typing_stop far more often than the
+picture actually changes: every keystroke after a pause starts typing
+again. TypingTracker keeps who is typing in each room in shared state
+(`state.typing`), with an expiry in case the stop never comes, and once per
+tick tells the broadcaster about each room whose set of typers changed
+since the last tick. Repeated starts, and a start and stop within the same
+tick, cost nothing.
+
+Every process runs the same tick over its replicated copy of the table and
+delivers only to its own sockets, so with several workers each client
+still hears about a change once.
+
+Private typing goes to a single recipient and is sent right away, but only
+when the state of that pair changes.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from logs import get_logger
+
+log = get_logger('typing')
+
+# Called with (room, typers now, typers at the last broadcast), each sid -> username
+SendRoom = Callable[[str, Dict[str, str], Dict[str, str]], Awaitable[None]]
+# Called with (sender, recipient, typing)
+SendPrivate = Callable[[str, str, bool], Awaitable[None]]
+
+
+class TypingTracker:
+    """Who is typing, per room and per private pair"""
+
+    def __init__(self, state, send_room: SendRoom, send_private: SendPrivate,
+                 timeout: float = 5.0, tick: float = 0.25):
+        self.state = state
+        self.send_room = send_room
+        self.send_private = send_private
+        self.timeout = timeout
+        self.tick = tick
+        self._expires: Dict[str, float] = {}  # sid -> deadline, for typers connected here
+        self._private: Dict[Tuple[str, str], float] = {}  # (sender, recipient) -> deadline
+        self._sent: Dict[str, Dict[str, str]] = {}  # room -> typers at the last broadcast
+        self.reports = 0
+        self.broadcasts = 0
+
+    def start(self, sid: str, room: str, username: str):
+        self.reports += 1
+        self._expires[sid] = time.monotonic() + self.timeout
+        entry = {'room': room, 'username': username}
+        if self.state.typing.get(sid) != entry:
+            self.state.put('typing', sid, entry)
+
+    def stop(self, sid: str):
+        self.reports += 1
+        self._expires.pop(sid, None)
+        if sid in self.state.typing:
+            self.state.delete('typing', sid)
+
+    async def start_private(self, sid: str, recipient: str):
+        self.reports += 1
+        key = (sid, recipient)
+        typing = key in self._private
+        self._private[key] = time.monotonic() + self.timeout
+        if not typing:
+            await self.send_private(sid, recipient, True)
+
+    async def stop_private(self, sid: str, recipient: str):
+        self.reports += 1
+        if self._private.pop((sid, recipient), None) is not None:
+            await self.send_private(sid, recipient, False)
+
+    async def discard(self, sid: str):
+        """Forget a socket that went away"""
+        self._expires.pop(sid, None)
+        if sid in self.state.typing:
+            self.state.delete('typing', sid)
+        for key in [key for key in self._private if sid in key]:
+            del self._private[key]
+            if key[0] == sid:
+                await self.send_private(sid, key[1], False)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('typing_flush_failed')
+
+    async def flush(self):
+        """Expire stale typers and broadcast the rooms that changed"""
+        now = time.monotonic()
+        for sid in [sid for sid, deadline in self._expires.items() if deadline <= now]:
+            del self._expires[sid]
+            if sid in self.state.typing:
+                self.state.delete('typing', sid)
+        for key in [key for key, deadline in self._private.items() if deadline <= now]:
+            del self._private[key]
+            await self.send_private(key[0], key[1], False)
+
+        current = self.state.room_typing
+        for room in set(current).union(self._sent):
+            # A copy: sending yields, and typers may change meanwhile
+            typers = dict(current.get(room, {}))
+            sent = self._sent.get(room, {})
+            if typers == sent:
+                continue
+            if typers:
+                self._sent[room] = typers
+            else:
+                del self._sent[room]
+            self.broadcasts += 1
+            await self.send_room(room, typers, sent)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'tick_ms': self.tick * 1000,
+            'typing': len(self.state.typing),
+            'private_typing': len(self._private),
+            'reports': self.reports,
+            'broadcasts': self.broadcasts,
+        }
@@ -0,0 +1,568 @@
+"""Streaming, content-addressed file uploads.
+
+Uploaded bytes are never collected in memory: the multipart body is parsed
+as it arrives and the file part is written, in batches, to a temporary file
+on a small thread pool, hashed on the way. The size limit is checked against
+the bytes actually received, so an oversized upload is cut off as soon as it
+crosses the limit. A failed upload leaves nothing behind.
+
+Finished files are named after their SHA-256 and sharded two levels deep
+(`ab/cd/abcd...ef.png`), so identical uploads share one file. UploadStore
+counts the messages in history that point at each file and deletes a file
+once the last of them is gone.
+
+Large files can also be sent as a resumable upload (ResumableUploads): a
+session on disk that takes the file in chunks and survives restarts.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+
+# Disk writes and hashing run here, off the event loop
+IO_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix='upload-io')
+# Moves into and deletions from the content store run one at a time, in the
+# order they were requested, so a deletion never overtakes a later upload
+# of the same content
+FILE_OPS = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-files')
+
+# Received data is handed to the pool once this much has accumulated
+WRITE_BATCH_SIZE = 256 * 1024
+
+
+class UploadError(Exception):
+    """Upload rejected; carries the HTTP status to answer with"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class UploadWriter:
+    """Temporary file that hashes what is written and enforces a size limit"""
+
+    def __init__(self, tmp_dir: Path, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.path = tmp_dir / f"{uuid.uuid4().hex}.part"
+        self._hash = hashlib.sha256()
+        self._file = None
+        self._buffer = bytearray()
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise UploadError(413, f"File too large. Maximum size is {self.max_size // (1024 * 1024)}MB.")
+        self._buffer += data
+        if len(self._buffer) >= WRITE_BATCH_SIZE:
+            await self._drain()
+
+    async def finish(self) -> str:
+        """Flush and close the file; returns its sha256"""
+        await self._drain()
+        await _run(self._close)
+        return self._hash.hexdigest()
+
+    async def abort(self):
+        await _run(self._abort)
+
+    async def _drain(self):
+        if self._buffer:
+            data, self._buffer = bytes(self._buffer), bytearray()
+            await _run(self._write, data)
+
+    def _write(self, data: bytes):
+        if self._file is None:
+            self._file = open(self.path, 'wb')
+        self._file.write(data)
+        self._hash.update(data)
+
+    def _close(self):
+        if self._file is None:
+            self._file = open(self.path, 'wb')
+        self._file.close()
+
+    def _abort(self):
+        if self._file is not None:
+            self._file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+async def _run(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(IO_POOL, function, *args)
+
+
+class FilePart:
+    """The file field of a multipart upload"""
+
+    def __init__(self, filename: Optional[str], content_type: str, writer: UploadWriter):
+        self.filename = filename
+        self.content_type = content_type
+        self.writer = writer
+
+
+async def receive_file(headers: Dict[str, str], body: AsyncIterator[bytes], field: str,
+                       tmp_dir: Path, max_size: Callable[[str], int], allowed_types=None) -> FilePart:
+    """Stream the `field` file of a multipart/form-data body to a temporary
+    file. `max_size` maps the file's content type to its size limit. The
+    caller stores or aborts `part.writer`."""
+    content_type, params = parse_options_header(headers.get('content-type', ''))
+    boundary = params.get(b'boundary')
+    if content_type != b'multipart/form-data' or not boundary:
+        raise UploadError(400, "Expected a multipart/form-data upload.")
+
+    # Parser callbacks only collect; the awaits happen between chunks
+    part_headers: Dict[bytes, bytes] = {}
+    header_field = bytearray()
+    header_value = bytearray()
+    current: Dict[str, Optional[FilePart]] = {'part': None}
+    pending = bytearray()
+    result: Dict[str, Optional[FilePart]] = {'part': None}
+    ended = []
+
+    def on_part_begin():
+        part_headers.clear()
+        current['part'] = None
+
+    def on_header_field(data, start, end):
+        header_field.extend(data[start:end])
+
+    def on_header_value(data, start, end):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        part_headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part_headers.get(b'content-disposition', b''))
+        if disposition.get(b'name', b'').decode('latin-1') != field or result['part'] is not None:
+            return
+        filename = disposition.get(b'filename')
+        part_type = part_headers.get(b'content-type', b'application/octet-stream').decode('latin-1')
+        if allowed_types is not None and part_type not in allowed_types:
+            raise UploadError(400, f"File type '{part_type}' not allowed.")
+        part = FilePart(filename.decode('utf-8', 'replace') if filename else None, part_type,
+                        UploadWriter(tmp_dir, max_size(part_type)))
+        current['part'] = result['part'] = part
+
+    def on_part_data(data, start, end):
+        if current['part'] is not None:
+            pending.extend(data[start:end])
+
+    def on_end():
+        ended.append(True)
+
+    parser = MultipartParser(boundary, {
+        'on_part_begin': on_part_begin,
+        'on_header_field': on_header_field,
+        'on_header_value': on_header_value,
+        'on_header_end': on_header_end,
+        'on_headers_finished': on_headers_finished,
+        'on_part_data': on_part_data,
+        'on_end': on_end,
+    })
+
+    try:
+        async for chunk in body:
+            parser.write(chunk)
+            if pending:
+                await result['part'].writer.write(bytes(pending))
+                pending.clear()
+        parser.finalize()
+        # a body cut short before its closing boundary parses without error
+        if not ended:
+            raise UploadError(400, "Malformed multipart upload.")
+    except MultipartParseError:
+        if result['part'] is not None:
+            await result['part'].writer.abort()
+        raise UploadError(400, "Malformed multipart upload.")
+    except BaseException:
+        if result['part'] is not None:
+            await result['part'].writer.abort()
+        raise
+
+    if result['part'] is None:
+        raise UploadError(400, f"Missing '{field}' file field.")
+    return result['part']
+
+
+# Key (and path under the upload directory) of a content-addressed file
+CONTENT_KEY_RE = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(\.[A-Za-z0-9]{1,10})?$')
+EXTENSION_RE = re.compile(r'^\.[A-Za-z0-9]{1,10}$')
+
+
+def content_key(sha256: str, extension: str) -> str:
+    if not EXTENSION_RE.match(extension):
+        extension = ''
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{extension.lower()}"
+
+
+def file_key(message: Dict[str, Any]) -> Optional[str]:
+    """Content key of the file a message points at, if it is a stored upload.
+
+    File info comes from clients, so anything that is not a well-formed key
+    (older uuid names, paths) is ignored rather than trusted, and so are
+    files the quota evicted while messages still used them.
+    """
+    file_info = message.get('file')
+    if not isinstance(file_info, dict) or file_info.get('expired'):
+        return None
+    key = file_info.get('unique_filename')
+    if isinstance(key, str) and CONTENT_KEY_RE.match(key):
+        return key
+    return None
+
+
+class UploadStore:
+    """Content-addressed upload files, reference counted by messages.
+
+    A file is deleted when released by its last message, unless it was
+    uploaded within `fresh_grace` seconds, since the uploader is probably
+    about to send it. Files that were never sent are left to the collector
+    (see retention.py).
+    """
+
+    def __init__(self, root: Path, fresh_grace: float = 3600.0):
+        self.root = root
+        self.tmp_dir = root / '.incoming'
+        self.fresh_grace = fresh_grace
+        self._refs: Dict[str, Set[str]] = {}  # key -> ids of messages using it
+        self._fresh: Dict[str, float] = {}  # key -> upload time, oldest first
+        self._listeners: List[Callable[[str], None]] = []
+        self._eviction_listeners: List[Callable[[str, Set[str]], None]] = []
+        self.uploads = 0
+        self.deduplicated = 0
+        self.deleted = 0
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    def add_listener(self, listener: Callable[[str], None]):
+        """Call `listener(key)` whenever a stored file is deleted"""
+        self._listeners.append(listener)
+
+    def add_eviction_listener(self, listener: Callable[[str, Set[str]], None]):
+        """Call `listener(key, message_ids)` when a file is evicted while
+        messages still use it"""
+        self._eviction_listeners.append(listener)
+
+    async def store(self, writer: UploadWriter, extension: str) -> Tuple[str, bool]:
+        """Put a finished upload in place; returns its key and whether an
+        identical file was already stored"""
+        sha256 = await writer.finish()
+        return await self.add(writer.path, sha256, extension)
+
+    async def add(self, source: Path, sha256: str, extension: str) -> Tuple[str, bool]:
+        """Move a complete file with the given hash into the store"""
+        key = content_key(sha256, extension)
+        # Marked before moving, so a release from here on keeps the file
+        now = time.monotonic()
+        self._fresh.pop(key, None)
+        self._fresh[key] = now
+        self._prune_fresh(now)
+        created = await asyncio.get_running_loop().run_in_executor(
+            FILE_OPS, _move_into, source, self.path(key))
+        self.uploads += 1
+        if not created:
+            self.deduplicated += 1
+        return key, not created
+
+    def reference(self, message: Dict[str, Any]):
+        key = file_key(message)
+        if key is not None:
+            self._refs.setdefault(key, set()).add(message['id'])
+
+    def release(self, message: Dict[str, Any]):
+        key = file_key(message)
+        users = self._refs.get(key) if key is not None else None
+        if users is None:
+            return
+        users.discard(message['id'])
+        if users:
+            return
+        del self._refs[key]
+        if not self.is_fresh(key):
+            self.delete(key)
+
+    def delete(self, key: str):
+        self.deleted += 1
+        FILE_OPS.submit(_unlink, self.path(key))
+        for listener in self._listeners:
+            listener(key)
+
+    def evict(self, key: str):
+        """Delete a file even if messages still use it; they are released
+        and the eviction listeners told which ones they were"""
+        users = self._refs.pop(key, set())
+        self.delete(key)
+        if users:
+            for listener in self._eviction_listeners:
+                listener(key, users)
+
+    def references(self, key: str) -> int:
+        return len(self._refs.get(key, ()))
+
+    def is_fresh(self, key: str) -> bool:
+        uploaded = self._fresh.get(key)
+        return uploaded is not None and time.monotonic() - uploaded < self.fresh_grace
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'referenced_files': len(self._refs),
+            'uploads': self.uploads,
+            'deduplicated': self.deduplicated,
+            'deleted': self.deleted,
+        }
+
+    def _prune_fresh(self, now: float):
+        while self._fresh:
+            key, uploaded = next(iter(self._fresh.items()))
+            if now - uploaded < self.fresh_grace:
+                break
+            del self._fresh[key]
+
+
+def _move_into(source: Path, destination: Path) -> bool:
+    """Move `source` to `destination`, or drop it if that content is
+    already there"""
+    if destination.exists():
+        os.unlink(source)
+        # Uploaded again: counts as recent use for the collector
+        os.utime(destination)
+        return False
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(source, destination)
+    return True
+
+
+def _unlink(path: Path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+SESSION_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class UploadSession:
+    """A resumable upload: metadata plus the bytes received so far"""
+
+    def __init__(self, session_id: str, filename: str, content_type: str, size: int,
+                 created: float, directory: Path):
+        self.id = session_id
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size  # declared total
+        self.created = created
+        self.data_path = directory / f"{session_id}.part"
+        self.meta_path = directory / f"{session_id}.json"
+        self.offset = 0  # bytes on disk
+        self.lock = asyncio.Lock()
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'upload_id': self.id,
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'offset': self.offset,
+        }
+
+
+class ResumableUploads:
+    """Upload sessions that survive dropped connections and restarts.
+
+    A client creates a session, sends the file in chunks, each at the offset
+    the server reports, and completes it. Sessions live on disk (metadata
+    next to the partial data), so after a restart or on another worker a
+    client can ask for the current offset and carry on.
+    """
+
+    def __init__(self, directory: Path, ttl: float = 24 * 3600.0):
+        self.directory = directory
+        self.ttl = ttl
+        self._sessions: Dict[str, UploadSession] = {}
+        self.completed = 0
+        self.expired = 0
+
+    async def create(self, filename: str, content_type: str, size: int) -> UploadSession:
+        session = UploadSession(uuid.uuid4().hex, filename, content_type, size,
+                                time.time(), self.directory)
+        await _run(self._create_files, session)
+        self._sessions[session.id] = session
+        return session
+
+    async def get(self, session_id: str) -> Optional[UploadSession]:
+        """The session with its current offset, loading it from disk if it
+        was created before a restart or by another worker"""
+        if not SESSION_ID_RE.match(session_id):
+            return None
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = await _run(self._load, session_id)
+            if session is None:
+                return None
+            session = self._sessions.setdefault(session_id, session)
+        else:
+            offset = await _run(_file_size, session.data_path)
+            if offset is None:
+                self._sessions.pop(session_id, None)
+                return None
+            session.offset = offset
+        return session
+
+    async def append(self, session: UploadSession, offset: int, body: AsyncIterator[bytes]) -> int:
+        """Write a chunk starting at `offset`; returns the new offset.
+
+        Whatever arrived before a dropped connection is kept, so the client
+        resumes from the offset the server reports.
+        """
+        if session.lock.locked():
+            raise UploadError(409, "Another chunk for this upload is in progress.")
+        async with session.lock:
+            handle = await _run(_open_append, session.data_path)
+            try:
+                session.offset = await _run(_tell, handle)
+                if offset != session.offset:
+                    raise UploadError(409, f"Expected offset {session.offset}.")
+                buffer = bytearray()
+                async for chunk in body:
+                    if session.offset + len(buffer) + len(chunk) > session.size:
+                        raise UploadError(413, "Chunk goes past the declared upload size.")
+                    buffer += chunk
+                    if len(buffer) >= WRITE_BATCH_SIZE:
+                        session.offset += await _run(_write_out, handle, bytes(buffer))
+                        buffer.clear()
+                if buffer:
+                    session.offset += await _run(_write_out, handle, bytes(buffer))
+            finally:
+                await _run(handle.close)
+        return session.offset
+
+    async def complete(self, session: UploadSession, store: UploadStore, extension: str) -> Tuple[str, bool]:
+        """Hash the finished file and move it into the content store"""
+        if session.lock.locked():
+            raise UploadError(409, "A chunk for this upload is still in progress.")
+        async with session.lock:
+            session.offset = await _run(_file_size, session.data_path) or 0
+            if session.offset != session.size:
+                raise UploadError(409, f"Upload incomplete: {session.offset} of {session.size} bytes.")
+            sha256 = await _run(_hash_file, session.data_path)
+            result = await store.add(session.data_path, sha256, extension)
+            await _run(_unlink, session.meta_path)
+            self._sessions.pop(session.id, None)
+            self.completed += 1
+            return result
+
+    async def cancel(self, session: UploadSession):
+        self._sessions.pop(session.id, None)
+        await _run(self._remove_files, session.id)
+
+    async def expire(self, now: Optional[float] = None) -> int:
+        """Remove sessions older than the ttl, including ones from before a restart"""
+        now = time.time() if now is None else now
+        expired = await _run(self._expired_ids, now)
+        for session_id in expired:
+            session = self._sessions.get(session_id)
+            if session is not None and session.lock.locked():
+                continue
+            self._sessions.pop(session_id, None)
+            await _run(self._remove_files, session_id)
+        self.expired += len(expired)
+        return len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'open_sessions': len(self._sessions),
+            'completed': self.completed,
+            'expired': self.expired,
+            'ttl': self.ttl,
+        }
+
+    # ----- disk, on the I/O pool -----
+
+    def _create_files(self, session: UploadSession):
+        session.data_path.touch()
+        meta = session.to_json()
+        meta['created'] = session.created
+        tmp = session.meta_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, session.meta_path)
+
+    def _load(self, session_id: str) -> Optional[UploadSession]:
+        try:
+            meta = json.loads((self.directory / f"{session_id}.json").read_text())
+        except (OSError, ValueError):
+            return None
+        session = UploadSession(session_id, meta['filename'], meta['content_type'], meta['size'],
+                                meta['created'], self.directory)
+        offset = _file_size(session.data_path)
+        if offset is None:
+            return None
+        session.offset = offset
+        return session
+
+    def _expired_ids(self, now: float):
+        # Measured from the last chunk written, not from creation
+        expired = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            session_id = entry.name[:-len('.json')]
+            touched = entry.stat().st_mtime
+            data = self.directory / f"{session_id}.part"
+            if data.exists():
+                touched = max(touched, data.stat().st_mtime)
+            if now - touched > self.ttl:
+                expired.append(session_id)
+        return expired
+
+    def _remove_files(self, session_id: str):
+        _unlink(self.directory / f"{session_id}.part")
+        _unlink(self.directory / f"{session_id}.json")
+
+
+def _file_size(path: Path) -> Optional[int]:
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+
+def _open_append(path: Path):
+    return open(path, 'ab')
+
+
+def _tell(handle) -> int:
+    return handle.seek(0, os.SEEK_END)
+
+
+def _write_out(handle, data: bytes) -> int:
+    handle.write(data)
+    handle.flush()
+    return len(data)
+
+
+def _hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()